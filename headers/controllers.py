@@ -0,0 +1,109 @@
+"""Feedback controllers of WMLock.
+
+Each controller is a pure step function
+
+    output, state = step(state, error, dt, limits, setpoint, p_gain, i_time, **params)
+
+that returns the feedback output for one wavemeter reading and the next controller state,
+without changing the state it was given. error is the frequency minus the setpoint in GHz,
+dt the integration time step in s (0 for the first step after a reset), and limits the
+(min, max) feedback output the piezo can follow. The output is in V of piezo, relative to the
+piezo offset at lock start.
+
+All controllers hold the slow part of the output in state["integral"]. When the output is
+beyond limits, the integral is clamped to the limit (see anti_windup), so it does not wind up
+while the piezo is railed, and a feedforward step can be applied by adding to it.
+"""
+import inspect
+import math
+
+
+def initial_state() -> dict:
+    return {"integral": 0.0}
+
+
+def anti_windup(state: dict, output: float, limits: tuple) -> dict:
+    """Clamps the integral to the limit that output is beyond."""
+    if output < limits[0] and state["integral"] < limits[0]:
+        state = dict(state, integral=limits[0])
+    elif output > limits[1] and state["integral"] > limits[1]:
+        state = dict(state, integral=limits[1])
+    return state
+
+
+def _integrate(state: dict, error: float, dt: float, p_gain: float, i_time: float) -> float:
+    return state["integral"] + error * p_gain * dt / i_time
+
+
+def pi_step(state, error, dt, limits, setpoint, p_gain, i_time):
+    """PI controller, output = p_gain * (error + integral of error / i_time)."""
+    integral = _integrate(state, error, dt, p_gain, i_time)
+    output = error * p_gain + integral
+    return output, anti_windup(dict(state, integral=integral), output, limits)
+
+
+def pid_step(state, error, dt, limits, setpoint, p_gain, i_time, d_time=0.0, d_filter_time=0.1):
+    """PID controller with the derivative low-pass filtered with d_filter_time.
+
+    The derivative acts on the measured frequency rather than on the error, so setpoint
+    changes do not kick the output.
+    """
+    integral = _integrate(state, error, dt, p_gain, i_time)
+    measurement = error + setpoint
+    derivative = state.get("derivative", 0.0)
+    previous_measurement = state.get("previous_measurement")
+    if previous_measurement is not None and dt > 0:
+        raw_derivative = (measurement - previous_measurement) / dt
+        derivative += dt / (d_filter_time + dt) * (raw_derivative - derivative)
+    output = p_gain * (error + d_time * derivative) + integral
+    state = dict(state, integral=integral, derivative=derivative, previous_measurement=measurement)
+    return output, anti_windup(state, output, limits)
+
+
+def setpoint_weighted_pi_step(state, error, dt, limits, setpoint, p_gain, i_time, setpoint_weight=0.5):
+    """PI controller with the proportional term acting on only setpoint_weight of a setpoint change.
+
+    A setpoint change then moves the output gently through the integral, while disturbances
+    see the full proportional gain.
+    """
+    integral = _integrate(state, error, dt, p_gain, i_time)
+    reference_setpoint = state.get("reference_setpoint", setpoint)
+    output = p_gain * (error + (1 - setpoint_weight) * (setpoint - reference_setpoint)) + integral
+    state = dict(state, integral=integral, reference_setpoint=reference_setpoint)
+    return output, anti_windup(state, output, limits)
+
+
+def lead_lag_step(state, error, dt, limits, setpoint, p_gain, i_time, lead_time=0.0, lag_time=0.0):
+    """PI controller with a lead-lag filter (1 + s lead_time) / (1 + s lag_time) on the proportional term."""
+    integral = _integrate(state, error, dt, p_gain, i_time)
+    previous_error = state.get("previous_error", error)
+    filtered = state.get("filtered_error", error)
+    if dt > 0:
+        filtered = ((dt + lead_time) * error - lead_time * previous_error + lag_time * filtered) / (dt + lag_time)
+    output = p_gain * filtered + integral
+    state = dict(state, integral=integral, previous_error=error, filtered_error=filtered)
+    return output, anti_windup(state, output, limits)
+
+
+# parameters with a bound other than [0, inf)
+PARAM_BOUNDS = {"setpoint_weight": (0, 1)}
+
+CONTROLLERS = {
+    "pi": pi_step,
+    "pid": pid_step,
+    "setpoint_weighted_pi": setpoint_weighted_pi_step,
+    "lead_lag": lead_lag_step,
+}
+
+
+def check_params(controller: str, params: dict):
+    """Raises ValueError if controller is unknown or params are not valid for it."""
+    if controller not in CONTROLLERS:
+        raise ValueError(f"Unknown controller {controller}, choose from {', '.join(CONTROLLERS)}.")
+    names = list(inspect.signature(CONTROLLERS[controller]).parameters)[7:]
+    for name, value in params.items():
+        if name not in names:
+            raise ValueError(f"Controller {controller} has no parameter {name}.")
+        low, high = PARAM_BOUNDS.get(name, (0, math.inf))
+        if not math.isfinite(value) or not low <= value <= high:
+            raise ValueError(f"{name} must be a finite number from {low} to {high}.")
@@ -0,0 +1,129 @@
+"""Binary flight recorder of the lock feedback loop.
+
+FlightRecorder writes one fixed-size record per feedback iteration to a ring file that is
+memory-mapped, so a record costs a copy into the page cache and no system call. The file
+keeps the latest capacity records and survives a crash of the lock process. It is
+continued when the lock restarts with the same file.
+
+read_flight_record opens a file, also while the lock writes to it, as a numpy structured
+array of RECORD_DTYPE in the order of recording:
+
+    records = read_flight_record("wm_lock_422.rec")
+    hops = records[(records["flags"] & FLAG_MODE_HOPPED) != 0]
+"""
+import os
+import sys
+
+import numpy as np
+
+
+MAGIC = b"WMLOCKFR"
+VERSION = 2
+HEADER_SIZE = 64  # bytes before the first record
+HEADER_DTYPE = np.dtype(
+    [("magic", "S8"), ("version", "<u4"), ("record_size", "<u4"), ("capacity", "<u8"), ("count", "<u8")]
+)
+RECORD_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),  # s
+        ("seq", "<u8"),  # wavemeter reading sequence number
+        ("freq_GHz", "<f8"),  # NaN for wavemeter errors
+        ("wm_error", "<i4"),  # 0, wlmConst measurement error code (Err...) or WM_ERROR_REQUEST
+        ("setpoint_GHz", "<f8"),
+        ("error_GHz", "<f8"),  # NaN if the reading was not used by the feedback
+        ("p_term_V", "<f8"),
+        ("i_term_V", "<f8"),
+        ("feedback_output_V", "<f8"),
+        ("piezo_V", "<f8"),
+        ("current_mA", "<f8"),
+        ("flags", "<u4"),
+    ]
+)
+
+WM_ERROR_REQUEST = 1  # wm_error of a failed wavemeter request, the wlmConst codes are negative
+
+FLAG_WM_GOOD = 1
+FLAG_LOCK_ON = 2
+FLAG_PIEZO_RAILED = 4
+FLAG_CURRENT_RAILED = 8
+FLAG_MODE_HOPPED = 16
+FLAG_RELOCKING = 32  # a reading taken while searching for a relock point
+
+
+def _check_header(header, path: str, capacity: int = None):
+    if header["magic"] != MAGIC or header["version"] != VERSION or header["record_size"] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a flight record of this version.")
+    if capacity is not None and header["capacity"] != capacity:
+        raise ValueError(f"{path} holds {header['capacity']} records, not {capacity}. Use another file or delete it.")
+
+
+class FlightRecorder:
+    """Ring file of fixed-size RECORD_DTYPE records, written by one thread."""
+
+    def __init__(self, path: str, capacity: int = 1000000):
+        """
+        Args:
+            path: ring file, continued if it exists with the same capacity.
+            capacity: number of records kept, RECORD_DTYPE.itemsize bytes each.
+        """
+        self.path = path
+        self.capacity = capacity
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(HEADER_SIZE + capacity * RECORD_DTYPE.itemsize)
+            header = np.memmap(path, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+            header[0] = (MAGIC, VERSION, RECORD_DTYPE.itemsize, capacity, 0)
+            header.flush()
+            del header
+        self._header = np.memmap(path, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+        _check_header(self._header[0], path, capacity)
+        self._records = np.memmap(path, dtype=RECORD_DTYPE, mode="r+", offset=HEADER_SIZE, shape=(capacity,))
+        self._count = int(self._header[0]["count"])
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def record(self, t, seq, freq_GHz, wm_error, setpoint_GHz, error_GHz, p_term_V, i_term_V, feedback_output_V, piezo_V, current_mA, flags):
+        """Appends a record, overwriting the oldest one if the file is full."""
+        self._records[self._count % self.capacity] = (
+            t, seq, freq_GHz, wm_error, setpoint_GHz, error_GHz, p_term_V, i_term_V, feedback_output_V, piezo_V, current_mA, flags
+        )
+        self._count += 1
+        self._header["count"] = self._count  # after the record, so readers never see a partial one
+
+    def flush(self):
+        """Writes the records to the disk. Not needed to keep them across a crash of the process."""
+        self._records.flush()
+        self._header.flush()
+
+    def close(self):
+        self.flush()
+        self._records = None  # the file is unmapped when the memmaps are released
+        self._header = None
+
+
+def read_flight_record(path: str, last: int = None) -> np.ndarray:
+    """Returns a copy of the records of a ring file, oldest first.
+
+    Args:
+        path: ring file written by FlightRecorder.
+        last: only return the latest last records.
+    """
+    header = np.memmap(path, dtype=HEADER_DTYPE, mode="r", shape=(1,))[0]
+    _check_header(header, path)
+    capacity, count = int(header["capacity"]), int(header["count"])
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(capacity,))
+    size = min(count, capacity) if last is None else min(count, capacity, last)
+    indices = np.arange(count - size, count) % capacity
+    return np.array(records[indices])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Prints the latest records: python flight_recorder.py <ring file>")
+        sys.exit(1)
+    records = read_flight_record(sys.argv[1], last=20)
+    names = RECORD_DTYPE.names
+    print(" ".join(f"{name:>17}" for name in names))
+    for record in records:
+        print(" ".join(f"{record[name]:17.12g}" for name in names))
@@ -0,0 +1,258 @@
+"""Vectorized simulation of the PI feedback of WMLock for sweeping the gains.
+
+simulate_batch steps thousands of (p_gain, i_time) pairs at once through the feedback of
+WMLock._get_feedback_output and _set_piezo_output / _set_current_output: the integral with
+its time step capped at max_integral_time_step, the clamp of the integral while the output
+is beyond the piezo range, and the clamp of the piezo and current outputs to their ranges.
+All pairs see the same laser frequency trace, taken from a wm_simulator.LaserModel or a
+lock_simulator.ReplayLaser, so they are compared on the same noise. sweep_gains runs a grid
+of gains in chunks on a process pool and returns a table ranked by rms error and settling
+time:
+
+    table = sweep_gains(WMLockConfig422(), LaserModel(710962.7), -np.logspace(-2, 1, 40), np.logspace(-2, 1, 40))
+    print(format_table(table))
+
+Relocks and feedforward are not modeled: a pair whose error leaves the mode hop free range
+is marked mode_hopped and holds its outputs from then on. Use LockSimulator to check the
+chosen gains with the full lock.
+"""
+import concurrent.futures
+import os
+
+import numpy as np
+
+from wm_lock import WMLockConfig
+from wm_simulator import LaserModel
+
+
+TABLE_DTYPE = np.dtype(
+    [
+        ("p_gain", float),
+        ("i_time", float),
+        ("rms_error_GHz", float),
+        ("max_error_GHz", float),
+        ("settling_time", float),
+        ("railed_fraction", float),
+        ("mode_hopped", bool),
+    ]
+)
+
+
+def laser_trace(laser, duration: float, measurement_period: float = 0.05, exposure_ms: float = 10):
+    """Returns the times (s) and frequencies (GHz) of the free running laser, NaN for wavemeter errors.
+
+    The piezo and current offsets of laser are set to zero.
+    """
+    laser.piezo_V = 0.0
+    laser.current_mA = 0.0
+    times = np.arange(1, int(round(duration / measurement_period)) + 1) * measurement_period
+    freqs_GHz = np.array([laser.measure(t, exposure_ms) for t in times])
+    freqs_GHz[freqs_GHz <= 0] = np.nan
+    return times, freqs_GHz
+
+
+def _settle_config(config_data: dict, settle_threshold_GHz: float, settle_time: float):
+    feedforward_config = config_data.get("feedforward", {})
+    if settle_threshold_GHz is None:
+        settle_threshold_GHz = feedforward_config.get("settle_threshold_GHz", 0.01)
+    if settle_time is None:
+        settle_time = feedforward_config.get("settle_time", 1)
+    return settle_threshold_GHz, settle_time
+
+
+def simulate_batch(
+    config_data: dict,
+    p_gains: np.ndarray,
+    i_times: np.ndarray,
+    times: np.ndarray,
+    freqs_GHz: np.ndarray,
+    setpoints_GHz: np.ndarray,
+    piezo_GHz_per_V: float,
+    current_GHz_per_mA: float,
+    piezo_voltage: float = 37.5,
+    settle_threshold_GHz: float = None,
+    settle_time: float = None,
+) -> np.ndarray:
+    """Simulates the lock with every pair of p_gains and i_times at once.
+
+    The lock turns on at times[0] with the piezo at piezo_voltage and the current output
+    at zero, where the laser has the frequencies freqs_GHz.
+
+    Args:
+        config_data: WMLockConfig.data of the lock, its feedback gains are not used.
+        p_gains, i_times: gains of each simulated lock, of equal length.
+        times, freqs_GHz: wavemeter readings of the free running laser, see laser_trace.
+        setpoints_GHz: frequency setpoint at each reading.
+        piezo_GHz_per_V, current_GHz_per_mA: tuning coefficients of the laser.
+        piezo_voltage: piezo voltage at the start.
+        settle_threshold_GHz, settle_time: the lock has settled once the error stays below
+            settle_threshold_GHz for at least settle_time s. Default those of the feedforward config.
+
+    Returns:
+        unsorted table with TABLE_DTYPE, one row per pair. settling_time is the longest
+        time to settle after the start and after every setpoint change, inf if it did not
+        settle. rms_error_GHz and max_error_GHz are of the readings after settling.
+    """
+    if config_data["feedback"].get("controller", "pi") != "pi":
+        raise ValueError("simulate_batch only models the pi controller, use LockSimulator for the others.")
+    settle_threshold_GHz, settle_time = _settle_config(config_data, settle_threshold_GHz, settle_time)
+    p_gains = np.asarray(p_gains, dtype=float)
+    i_times = np.asarray(i_times, dtype=float)
+    piezo_range = (config_data["piezo"]["min_voltage"], config_data["piezo"]["max_voltage"])
+    current_range = config_data["current"]["max_tuning_range_mA"]
+    bias_slope = config_data["current"]["bias_slope_mA_per_V"]
+    max_time_step = config_data["feedback"]["max_integral_time_step"]
+    mode_hop_range_GHz = config_data["wm"]["mode_hop_range_GHz"]
+    limits = (piezo_range[0] - piezo_voltage, piezo_range[1] - piezo_voltage)
+
+    size = len(p_gains)
+    integral = np.zeros(size)
+    piezo_V = np.full(size, float(piezo_voltage))
+    current_mA = np.zeros(size)
+    mode_hopped = np.zeros(size, dtype=bool)
+    railed = np.zeros(size)
+    errors_GHz = np.full((len(times), size), np.nan)
+    last_time = None
+    for k, t in enumerate(times):
+        if np.isnan(freqs_GHz[k]):
+            continue  # wavemeter error, the lock holds its outputs
+        error_GHz = (
+            freqs_GHz[k]
+            + piezo_GHz_per_V * (piezo_V - piezo_voltage)
+            + current_GHz_per_mA * current_mA
+            - setpoints_GHz[k]
+        )
+        errors_GHz[k] = error_GHz
+        mode_hopped |= np.abs(error_GHz) >= mode_hop_range_GHz
+        time_step = 0 if last_time is None else min(t - last_time, max_time_step)
+        last_time = t
+
+        new_integral = integral + error_GHz * p_gains * time_step / i_times
+        output = error_GHz * p_gains + new_integral
+        new_integral = np.where((output < limits[0]) & (new_integral < limits[0]), limits[0], new_integral)
+        new_integral = np.where((output > limits[1]) & (new_integral > limits[1]), limits[1], new_integral)
+        desired_V = piezo_voltage + output
+        railed += ((desired_V < piezo_range[0]) | (desired_V > piezo_range[1])) & ~mode_hopped
+        integral = np.where(mode_hopped, integral, new_integral)
+        piezo_V = np.where(mode_hopped, piezo_V, np.clip(desired_V, *piezo_range))
+        if bias_slope != 0:
+            desired_mA = np.clip(output * bias_slope, -current_range, current_range)
+            current_mA = np.where(mode_hopped, current_mA, desired_mA)
+
+    table = np.zeros(size, dtype=TABLE_DTYPE)
+    table["p_gain"] = p_gains
+    table["i_time"] = i_times
+    table["railed_fraction"] = railed / max(np.count_nonzero(~np.isnan(freqs_GHz)), 1)
+    table["mode_hopped"] = mode_hopped
+    _settling_metrics(table, times, errors_GHz, setpoints_GHz, settle_threshold_GHz, settle_time)
+    table["settling_time"][mode_hopped] = np.inf
+    return table
+
+
+def _settling_metrics(table, times, errors_GHz, setpoints_GHz, settle_threshold_GHz, settle_time):
+    abs_errors_GHz = np.abs(errors_GHz)
+    bad = abs_errors_GHz >= settle_threshold_GHz  # False for wavemeter errors
+    changes = np.flatnonzero(np.diff(setpoints_GHz)) + 1
+    starts = np.concatenate([[0], changes])
+    ends = np.concatenate([changes, [len(times)]])
+    settling_time = np.zeros(len(table))
+    settled = np.zeros(errors_GHz.shape, dtype=bool)
+    for start, end in zip(starts, ends):
+        segment_bad = bad[start:end]
+        any_bad = segment_bad.any(axis=0)
+        last_bad = end - 1 - np.argmax(segment_bad[::-1], axis=0)
+        settled_index = np.where(any_bad, last_bad + 1, start)
+        settled_time = np.where(any_bad, times[last_bad], times[start])
+        segment_time = np.where(times[end - 1] - settled_time >= settle_time, settled_time - times[start], np.inf)
+        settling_time = np.maximum(settling_time, segment_time)
+        rows = np.arange(start, end)[:, None]
+        settled[start:end] = (rows >= settled_index) & np.isfinite(segment_time)
+    table["settling_time"] = settling_time
+    settled &= ~np.isnan(errors_GHz)
+    counts = settled.sum(axis=0)
+    squares = np.where(settled, abs_errors_GHz, 0) ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        table["rms_error_GHz"] = np.where(counts > 0, np.sqrt(squares.sum(axis=0) / counts), np.nan)
+    table["max_error_GHz"] = np.where(counts > 0, np.where(settled, abs_errors_GHz, 0).max(axis=0), np.nan)
+
+
+def rank(table: np.ndarray) -> np.ndarray:
+    """Sorts the table by rms error, then settling time. Pairs that mode hopped or never settled come last."""
+    rms_error = np.where(np.isnan(table["rms_error_GHz"]), np.inf, table["rms_error_GHz"])
+    return table[np.lexsort((table["settling_time"], rms_error, table["mode_hopped"]))]
+
+
+def sweep_gains(
+    config: WMLockConfig,
+    laser,
+    p_gains,
+    i_times,
+    duration: float = 300,
+    setpoints: dict = None,
+    measurement_period: float = 0.05,
+    piezo_voltage: float = 37.5,
+    settle_threshold_GHz: float = None,
+    settle_time: float = None,
+    processes: int = None,
+    chunk_size: int = 1000,
+) -> np.ndarray:
+    """Simulates every combination of p_gains and i_times, and returns the ranked table.
+
+    Args:
+        config: lock configuration.
+        laser: LaserModel or ReplayLaser, its frequency trace is taken once for all gains.
+        p_gains, i_times: gains to combine.
+        duration: simulated time in s.
+        setpoints: time in s from the start -> new frequency setpoint in GHz.
+        measurement_period: time between wavemeter readings in s.
+        piezo_voltage: piezo voltage at the start.
+        settle_threshold_GHz, settle_time: see simulate_batch.
+        processes: worker processes, default the number of CPUs. Grids of up to chunk_size
+            combinations, or processes=1, run in this process.
+        chunk_size: combinations simulated by each worker task.
+    """
+    config_data = config.data
+    p_grid, i_grid = np.meshgrid(np.asarray(p_gains, dtype=float), np.asarray(i_times, dtype=float))
+    p_grid, i_grid = p_grid.ravel(), i_grid.ravel()
+    times, freqs_GHz = laser_trace(laser, duration, measurement_period)
+    setpoints_GHz = np.full(len(times), float(config_data["wm"]["freq_setpoint_GHz"]))
+    for t, setpoint_GHz in sorted((setpoints or {}).items()):
+        setpoints_GHz[times >= t] = setpoint_GHz
+    args = (times, freqs_GHz, setpoints_GHz, laser.piezo_GHz_per_V, laser.current_GHz_per_mA, piezo_voltage, settle_threshold_GHz, settle_time)
+
+    if processes is None:
+        processes = os.cpu_count()
+    if processes == 1 or len(p_grid) <= chunk_size:
+        return rank(simulate_batch(config_data, p_grid, i_grid, *args))
+    chunks = range(0, len(p_grid), chunk_size)
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(simulate_batch, config_data, p_grid[i:i + chunk_size], i_grid[i:i + chunk_size], *args) for i in chunks]
+        return rank(np.concatenate([future.result() for future in futures]))
+
+
+def format_table(table: np.ndarray, rows: int = 20) -> str:
+    """Text table of the first rows of a ranked table."""
+    lines = [f"{'p_gain':>10} {'i_time':>10} {'rms_GHz':>10} {'max_GHz':>10} {'settle_s':>10} {'railed':>8} {'hopped':>7}"]
+    for row in table[:rows]:
+        lines.append(
+            f"{row['p_gain']:10.4g} {row['i_time']:10.4g} {row['rms_error_GHz']:10.4g} {row['max_error_GHz']:10.4g}"
+            f" {row['settling_time']:10.4g} {row['railed_fraction']:8.3f} {str(row['mode_hopped']):>7}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from wm_lock_422 import WMLockConfig422
+
+    config = WMLockConfig422()
+    setpoint_GHz = config.data["wm"]["freq_setpoint_GHz"]
+    laser = LaserModel(setpoint_GHz + 0.2, drift_GHz_per_s=1e-3, seed=0)
+    table = sweep_gains(
+        config,
+        laser,
+        -np.logspace(-2, 1, 40),
+        np.logspace(-2, 1, 40),
+        setpoints={150: setpoint_GHz + 1},
+        settle_threshold_GHz=0.05,
+    )
+    print(format_table(table))
@@ -0,0 +1,203 @@
+"""Latency probes and counters of the lock loop, with a text metrics endpoint.
+
+LockMetrics keeps a rolling window of durations for each probed stage of the feedback loop
+and a set of counters:
+
+    with metrics.probe("piezo_write"):
+        piezo.set_voltage(axis, voltage)
+    metrics.increment("piezo_writes_skipped")
+
+summary returns p50 / p95 / p99 / max of each stage over its window. MetricsServer serves
+the metrics of one or more locks as plain text over HTTP, in the Prometheus text format:
+
+    wm_lock_latency_seconds{lock="wm_lock_422",stage="wm_reading_age",quantile="0.99"} 0.0031
+    wm_lock_piezo_writes_total{lock="wm_lock_422"} 1234
+"""
+import http.server
+import threading
+import time
+
+import numpy as np
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyWindow:
+    """Durations in s of the latest size calls of a stage."""
+
+    def __init__(self, size: int = 1000):
+        self._durations = np.zeros(size)
+        self.count = 0  # calls since the start
+
+    def add(self, duration: float):
+        self._durations[self.count % len(self._durations)] = duration
+        self.count += 1
+
+    def durations(self) -> np.ndarray:
+        return self._durations[: min(self.count, len(self._durations))].copy()
+
+
+class _Probe:
+    """Times a with block into a LatencyWindow. Used by one thread at a time."""
+
+    def __init__(self, window: LatencyWindow):
+        self._window = window
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._window.add(time.perf_counter() - self._start)
+
+
+class ReadingAge:
+    """Age of wavemeter readings on receipt, from their timestamps on the clock of the wavemeter computer.
+
+    The two clocks are not synchronized, so the age is measured from the youngest reading: the
+    clock offset is the smallest difference of receipt time and timestamp seen, which may grow
+    by max_drift per s to follow a drift of the clocks. It starts over when the difference jumps
+    by more than max_jump s, e.g. after a restart of the wavemeter software.
+    """
+
+    def __init__(self, max_drift: float = 1e-4, max_jump: float = 60):
+        self.max_drift = max_drift
+        self.max_jump = max_jump
+        self._offset = None
+        self._last_receipt = None
+
+    def age(self, receipt: float, timestamp: float) -> float:
+        """Returns the age in s of a reading with timestamp (s) received at receipt (s)."""
+        difference = receipt - timestamp
+        if self._offset is None or abs(difference - self._offset) > self.max_jump:
+            self._offset = difference
+        else:
+            self._offset = min(difference, self._offset + self.max_drift * max(receipt - self._last_receipt, 0))
+        self._last_receipt = receipt
+        return difference - self._offset
+
+
+class LockMetrics:
+    """Latency windows of the probed stages and counters of one lock.
+
+    The probes are written by the feedback thread and read by others. A summary taken while
+    a probe is written may miss or include that one duration.
+    """
+
+    def __init__(self, window_size: int = 1000):
+        """
+        Args:
+            window_size: number of latest durations of each stage used for the quantiles.
+        """
+        self.window_size = window_size
+        self._windows = {}
+        self._probes = {}
+        self.counters = {}
+
+    def _window(self, stage: str) -> LatencyWindow:
+        window = self._windows.get(stage)
+        if window is None:
+            window = self._windows[stage] = LatencyWindow(self.window_size)
+        return window
+
+    def probe(self, stage: str) -> _Probe:
+        """Returns the context manager that times stage."""
+        probe = self._probes.get(stage)
+        if probe is None:
+            probe = self._probes[stage] = _Probe(self._window(stage))
+        return probe
+
+    def add(self, stage: str, duration: float):
+        """Adds a duration in s of stage that was not timed by a probe."""
+        self._window(stage).add(duration)
+
+    def increment(self, counter: str, value: int = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def summary(self) -> dict:
+        """Returns {"latency_ms": {stage: {"count", "p50", "p95", "p99", "max"}}, "counters": {counter: value}}.
+
+        count is the number of calls since the start, the times in ms are over the latest window_size calls.
+        """
+        latency = {}
+        for stage, window in list(self._windows.items()):
+            durations = 1e3 * window.durations()
+            stage_summary = {"count": window.count}
+            if len(durations):
+                for quantile, value in zip(QUANTILES, np.quantile(durations, QUANTILES)):
+                    stage_summary[f"p{round(100 * quantile)}"] = float(value)
+                stage_summary["max"] = float(durations.max())
+            latency[stage] = stage_summary
+        return {"latency_ms": latency, "counters": dict(self.counters)}
+
+
+def metrics_text(metrics_by_lock: dict) -> str:
+    """Metrics of each lock name in the Prometheus text format."""
+    lines = [
+        "# HELP wm_lock_latency_seconds Latency of the stages of the lock feedback loop.",
+        "# TYPE wm_lock_latency_seconds summary",
+    ]
+    counter_lines = []
+    for name, metrics in metrics_by_lock.items():
+        summary = metrics.summary()
+        for stage, stage_summary in summary["latency_ms"].items():
+            labels = f'lock="{name}",stage="{stage}"'
+            for quantile in QUANTILES:
+                key = f"p{round(100 * quantile)}"
+                if key in stage_summary:
+                    lines.append(f'wm_lock_latency_seconds{{{labels},quantile="{quantile}"}} {stage_summary[key] / 1e3:.6g}')
+            if "max" in stage_summary:
+                lines.append(f'wm_lock_latency_seconds_max{{{labels}}} {stage_summary["max"] / 1e3:.6g}')
+            lines.append(f"wm_lock_latency_seconds_count{{{labels}}} {stage_summary['count']}")
+        for counter, value in summary["counters"].items():
+            counter_lines.append(f'wm_lock_{counter}_total{{lock="{name}"}} {value}')
+    return "\n".join(lines + counter_lines) + "\n"
+
+
+class MetricsServer:
+    """Serves metrics_text of the locks at http://<host>:<port>/metrics from a background thread."""
+
+    def __init__(self, metrics_by_lock: dict, port: int, host: str = ""):
+        """
+        Args:
+            metrics_by_lock: lock name -> LockMetrics, read on every request.
+            port: HTTP port.
+            host: interface to listen on, all by default.
+        """
+        self.metrics_by_lock = metrics_by_lock
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics_text(server.metrics_by_lock).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
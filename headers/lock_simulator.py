@@ -0,0 +1,354 @@
+"""Offline simulation of WMLock, faster than real time.
+
+LockSimulator runs the feedback of a real WMLock against a simulated laser, without the
+wavemeter server, the HEROs or the devices. The lock reads a SimulatedWavemeter that
+advances a simulated clock by one measurement period per reading, so a run takes only the
+CPU time of the lock and the laser model:
+
+    simulator = LockSimulator(WMLockConfig422(), LaserModel(710962.7, drift_GHz_per_s=1e-3))
+    print(simulator.run(600, setpoints={300: 710963.7}))
+
+The laser is a wm_simulator.LaserModel, or a ReplayLaser that replays a recorded frequency
+trace. run returns the settling time after the start and after every setpoint change, the
+rms error once settled, the number of relocks and the time spent relocking, and the CPU
+time per lock iteration. The trace of the last run is kept in LockSimulator.trace.
+
+The tuning map file of a relock config is read but never written by the simulation, and the
+flight record file of the config is not opened. Pass flight_record_path to record the
+simulation to a file of its own.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+from wm_lock import WMLock, WMLockConfig
+import wlmConst
+from wm_simulator import LaserModel
+
+
+TRACE_COLUMNS = ("time", "freq_GHz", "setpoint_GHz", "piezo_V", "current_mA", "mode_hopped")
+
+
+class SimClock:
+    """Simulated time in s, read by calling it."""
+
+    def __init__(self, t: float = 0.0):
+        self.t = t
+
+    def __call__(self) -> float:
+        return self.t
+
+    def advance(self, dt: float):
+        self.t += dt
+
+
+class ReplayLaser:
+    """Replays a recorded frequency trace, with the piezo and current tuning of the lock added.
+
+    Record the trace with the lock off, so it holds the free running drift and noise of the
+    laser. The trace is interpolated between samples and held at its ends. Samples that are
+    NaN are replayed as a wavemeter ErrNoSignal.
+    """
+
+    def __init__(
+        self,
+        times: np.ndarray,
+        freqs_GHz: np.ndarray,
+        piezo_GHz_per_V: float = 0.6,
+        current_GHz_per_mA: float = -0.4,
+    ):
+        """
+        Args:
+            times: sample times in s, increasing. The replay starts at the first one.
+            freqs_GHz: recorded frequencies.
+            piezo_GHz_per_V, current_GHz_per_mA: tuning coefficients of the laser.
+        """
+        self.times = np.asarray(times, dtype=float) - times[0]
+        self.freqs_GHz = np.asarray(freqs_GHz, dtype=float)
+        self.piezo_GHz_per_V = piezo_GHz_per_V
+        self.current_GHz_per_mA = current_GHz_per_mA
+        self.piezo_V = 0.0  # offsets from the operating point, set by the simulated actuators
+        self.current_mA = 0.0
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        """Loads a trace of (time in s, frequency in GHz) rows from a .npy or a comma separated text file."""
+        if path.endswith(".npy"):
+            data = np.load(path)
+        else:
+            data = np.loadtxt(path, delimiter=",", ndmin=2)
+        return cls(data[:, 0], data[:, 1], **kwargs)
+
+    @property
+    def duration(self) -> float:
+        return self.times[-1]
+
+    def measure(self, t: float, exposure_ms: float) -> float:
+        """Returns the frequency in GHz at time t (s), or a negative wavemeter error code."""
+        freq_GHz = np.interp(t, self.times, self.freqs_GHz)
+        if np.isnan(freq_GHz):
+            return wlmConst.ErrNoSignal
+        return freq_GHz + self.piezo_GHz_per_V * self.piezo_V + self.current_GHz_per_mA * self.current_mA
+
+
+class SimulatedWavemeter:
+    """Stands in for the WM client of a lock. Every reading advances the clock by one measurement period."""
+
+    timeout = 1.0
+
+    def __init__(self, laser, clock: SimClock, measurement_period: float = 0.05, exposure_ms: float = 10, on_reading=None):
+        """
+        Args:
+            laser: LaserModel or ReplayLaser measured.
+            clock: simulated clock, advanced by the readings.
+            measurement_period: time between readings in s.
+            exposure_ms: exposure passed to the laser model.
+            on_reading: called with (time, frequency in GHz or error string) of every reading.
+        """
+        self.laser = laser
+        self.clock = clock
+        self.measurement_period = measurement_period
+        self.exposure_ms = exposure_ms
+        self.on_reading = on_reading
+        self._seq = 0
+
+    def wait_new_frequency(self, channel: int, last_seq: int = 0, timeout: float = 1.0, rpc_timeout: float = None):
+        self.clock.advance(self.measurement_period)
+        value = self.laser.measure(self.clock(), self.exposure_ms)
+        freq_GHz = value if value > 0 else wlmConst.meas_error_to_str(int(value))
+        self._seq += 1
+        if self.on_reading is not None:
+            self.on_reading(self.clock(), freq_GHz)
+        return [self._seq, self.clock() * 1000, freq_GHz]
+
+    def get_update_interval(self, channel: int) -> dict:
+        return {"mean": self.measurement_period, "max": self.measurement_period, "measured": self.measurement_period}
+
+    def close(self):
+        pass
+
+
+class SimulatedPiezo:
+    """Stands in for PiezoControl, tuning the lasers on its axes."""
+
+    def __init__(self, lasers: dict, voltage: float = 37.5, max_voltage: float = 150):
+        """
+        Args:
+            lasers: axis -> laser model.
+            voltage: starting voltage of all axes, where the piezo offset of the lasers is zero.
+            max_voltage: global voltage limit.
+        """
+        self.lasers = lasers
+        self._zero_voltage = voltage
+        self._voltages = {channel: voltage for channel in ["x", "y", "z"]}
+        self._ranges = {channel: [0, max_voltage] for channel in ["x", "y", "z"]}
+
+    @property
+    def channel_ranges(self) -> dict:
+        return {channel: tuple(limits) for channel, limits in self._ranges.items()}
+
+    def set_min_voltage(self, channel: str, voltage: float):
+        self._ranges[channel][0] = voltage
+
+    def set_max_voltage(self, channel: str, voltage: float):
+        self._ranges[channel][1] = voltage
+
+    def get_voltage(self, channel: str) -> float:
+        return self._voltages[channel]
+
+    def set_voltage(self, channel: str, voltage: float):
+        min_value, max_value = self._ranges[channel]
+        self._voltages[channel] = min(max(voltage, min_value), max_value)
+        if channel in self.lasers:
+            self.lasers[channel].piezo_V = self._voltages[channel] - self._zero_voltage
+
+
+class SimulatedCurrent:
+    """Stands in for ECDLCurrentControl, tuning the lasers on its channels."""
+
+    def __init__(self, lasers: dict, mA_per_V: float):
+        """
+        Args:
+            lasers: function generator channel -> laser model.
+            mA_per_V: laser current change per volt of function generator output.
+        """
+        self.lasers = lasers
+        self.mA_per_V = mA_per_V
+        self._outputs = {channel: 0.0 for channel in lasers}
+
+    def get_output(self, channel: int) -> float:
+        return self._outputs[channel]
+
+    def set_output(self, channel: int, voltage: float):
+        self._outputs[channel] = min(max(voltage, -10), 10)
+        self.lasers[channel].current_mA = self._outputs[channel] * self.mA_per_V
+
+
+class LockSimulator:
+    """Runs a WMLock offline against a simulated laser, see the module docstring."""
+
+    def __init__(
+        self,
+        config: WMLockConfig,
+        laser=None,
+        measurement_period: float = 0.05,
+        piezo_voltage: float = 37.5,
+        flight_record_path: str = None,
+    ):
+        """
+        Args:
+            config: lock configuration.
+            laser: LaserModel or ReplayLaser, by default a LaserModel at the setpoint.
+            measurement_period: time between wavemeter readings in s.
+            piezo_voltage: piezo voltage at the start.
+            flight_record_path: ring file for a flight record of the simulation, None for none.
+                Must not be the file of the running lock.
+        """
+        data = config.data
+        if laser is None:
+            laser = LaserModel(data["wm"]["freq_setpoint_GHz"])
+        self.laser = laser
+        self.clock = SimClock()
+        current_config = data["current"]
+        mA_per_V = current_config["max_controller_range_mA"] / current_config["attenuation_factor"] / 10
+        self.piezo = SimulatedPiezo({data["piezo"]["axis"]: laser}, piezo_voltage)
+        self.current = SimulatedCurrent({current_config["channel"]: laser}, mA_per_V)
+        self.wm = SimulatedWavemeter(laser, self.clock, measurement_period, on_reading=self._on_reading)
+        self.trace = np.zeros((0, len(TRACE_COLUMNS)))
+        self._rows = []
+        self._end_time = np.inf
+
+        self.lock = WMLock.__new__(WMLock)  # the lock without its HERO
+        self.lock._init_lock(config, self.wm, None, None, self.clock)
+        self.lock.config = dict(data)  # keeps the flight record of the real lock out of the simulation
+        recorder_config = self.lock.config.pop("flight_recorder", None)
+        if flight_record_path is not None:
+            if recorder_config is not None and os.path.abspath(flight_record_path) == os.path.abspath(recorder_config["path"]):
+                raise ValueError(f"{flight_record_path} is the flight record of the lock, use another file.")
+            capacity = 1000000 if recorder_config is None else recorder_config["capacity"]
+            self.lock.config["flight_recorder"] = {"path": flight_record_path, "capacity": capacity}
+        self.lock.piezo = self.piezo
+        self.lock.current = self.current
+        self.lock._setup()
+
+    def _on_reading(self, t: float, freq_GHz):
+        if t >= self._end_time:
+            self.lock._stop.set()  # also ends a relock in progress
+        lock = self.lock
+        self._rows.append(
+            (
+                t,
+                freq_GHz if isinstance(freq_GHz, float) else np.nan,
+                lock.get_frequency_setpoint(),
+                lock._piezo_output,
+                lock._current_output,
+                lock._mode_hopped,
+            )
+        )
+
+    def run(
+        self,
+        duration: float,
+        setpoints: dict = None,
+        lock_on: bool = True,
+        settle_threshold_GHz: float = None,
+        settle_time: float = None,
+    ) -> dict:
+        """Runs the lock for duration s of simulated time.
+
+        Args:
+            duration: simulated time in s.
+            setpoints: time in s from the start of the run -> new frequency setpoint in GHz.
+            lock_on: turn the lock on at the start.
+            settle_threshold_GHz, settle_time: the lock has settled once the error stays below
+                settle_threshold_GHz for at least settle_time s. Default those of the lock config.
+
+        Returns:
+            dict of
+                settling_times: s from the start and from every setpoint change until the lock
+                    settled for the rest of the run or the next change, None if it did not settle.
+                rms_error_GHz, max_error_GHz: of the readings after settling.
+                relocks, relock_time: number of relocks and s spent relocking.
+                readings: number of wavemeter readings, one per lock iteration.
+                cpu_per_iteration_us: process CPU time per lock iteration.
+                speedup: simulated time / wall time.
+        """
+        start_time = self.clock()
+        self._end_time = start_time + duration
+        self._rows = []
+        changes = sorted((start_time + t, setpoint) for t, setpoint in (setpoints or {}).items())
+        segment_starts = [start_time]
+        relocks = self.lock.metrics.counters.get("relocks", 0)
+        relock_time = self.lock._relock_time
+        if lock_on and not self.lock.get_lock_state():
+            self.lock.set_lock_state(True)
+
+        cpu_time = 0
+        wall_time = time.perf_counter()
+        while self.clock() < self._end_time:
+            while changes and changes[0][0] <= self.clock():
+                self.lock.set_frequency_setpoint(changes.pop(0)[1])
+                segment_starts.append(self.clock())
+            cpu_start = time.process_time()
+            self.lock._feedback_step()
+            cpu_time += time.process_time() - cpu_start
+        wall_time = time.perf_counter() - wall_time
+        self.lock._stop.clear()
+
+        self.trace = np.array(self._rows, dtype=float).reshape(-1, len(TRACE_COLUMNS))
+        if settle_threshold_GHz is None:
+            settle_threshold_GHz = self.lock._settle_threshold_GHz
+        if settle_time is None:
+            settle_time = self.lock._settle_time
+        metrics = self._settling_metrics(segment_starts, settle_threshold_GHz, settle_time)
+        metrics.update(
+            {
+                "relocks": self.lock.metrics.counters.get("relocks", 0) - relocks,
+                "relock_time": self.lock._relock_time - relock_time,
+                "readings": len(self.trace),
+                "cpu_per_iteration_us": 1e6 * cpu_time / max(len(self.trace), 1),
+                "speedup": duration / wall_time,
+            }
+        )
+        return metrics
+
+    def _settling_metrics(self, segment_starts: list, settle_threshold_GHz: float, settle_time: float) -> dict:
+        t, freq_GHz, setpoint_GHz = self.trace[:, 0], self.trace[:, 1], self.trace[:, 2]
+        error_GHz = np.abs(freq_GHz - setpoint_GHz)
+        good = error_GHz < settle_threshold_GHz  # False for NaN
+        settled = np.zeros(len(t), dtype=bool)
+        settling_times = []
+        for start, end in zip(segment_starts, segment_starts[1:] + [self._end_time]):
+            segment = (t > start) & (t <= end)
+            bad_times = t[segment & ~good]
+            settled_at = bad_times[-1] if len(bad_times) else start
+            if end - settled_at < settle_time:
+                settling_times.append(None)
+                continue
+            settling_times.append(float(settled_at - start))
+            settled |= segment & (t > settled_at)
+        if settled.any():
+            rms_error_GHz = float(np.sqrt(np.mean(error_GHz[settled] ** 2)))
+            max_error_GHz = float(np.max(error_GHz[settled]))
+        else:
+            rms_error_GHz = max_error_GHz = None
+        return {"settling_times": settling_times, "rms_error_GHz": rms_error_GHz, "max_error_GHz": max_error_GHz}
+
+
+if __name__ == "__main__":
+    from wm_lock_422 import WMLockConfig422
+
+    config = WMLockConfig422()
+    setpoint_GHz = config.data["wm"]["freq_setpoint_GHz"]
+    if len(sys.argv) > 1:
+        laser = ReplayLaser.from_file(sys.argv[1])
+        duration = laser.duration
+    else:
+        laser = LaserModel(setpoint_GHz + 0.2, drift_GHz_per_s=1e-3, seed=0)
+        duration = 600
+    simulator = LockSimulator(config, laser)
+    metrics = simulator.run(duration, setpoints={duration / 2: setpoint_GHz + 1}, settle_threshold_GHz=0.05)
+    for key, value in metrics.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+
+OPERATING_POINT_COLUMNS = ("time", "setpoint_GHz", "piezo_V", "current_mA", "hop_low_piezo_V", "hop_high_piezo_V")
+
+
+def _operating_point_dict(row) -> dict:
+    """Operating point row to a dict, with None for unknown mode hop boundaries."""
+    return {column: (None if np.isnan(value) else float(value)) for column, value in zip(OPERATING_POINT_COLUMNS, row)}
+
+
+class TuningMap:
+    """Operating points of a laser learned from locked operation and past relocks.
+
+    While the laser is locked, the lock adds samples (time, piezo output, current output,
+    frequency) regularly, so the map holds points where the laser was in a good mode. After
+    every relock it adds the jump (time, piezo and current outputs where the mode hop was
+    detected, outputs where it relocked). As the laser drifts the same way between mode hops,
+    the latest jumps predict the next relock point well.
+
+    On a mode hop the relock search tries, in this order, the present outputs moved by the
+    latest relock jumps, the latest locked points near the setpoint, and a grid around the
+    first prediction, closest points first.
+
+    For every setpoint it also keeps an operating point: the latest locked piezo and current
+    outputs and the piezo outputs of the latest mode hops below and above them, so the lock
+    can start from a known good point after a restart or a large setpoint change. The map
+    is saved to a .npz file and loaded again on restart.
+    """
+
+    def __init__(self, path: str = None, max_samples: int = 10000, max_relocks: int = 100, clock=time.time):
+        """
+        Args:
+            path: .npz file of the map, None to keep it in memory only. ".npz" is appended if missing,
+                as np.savez does.
+            max_samples: number of locked samples kept, older samples are dropped.
+            max_relocks: number of relock jumps kept.
+            clock: function returning the time in s of new samples.
+        """
+        if path is not None and not path.endswith(".npz"):
+            path += ".npz"
+        self.path = path
+        self._clock = clock
+        self.max_samples = max_samples
+        self.max_relocks = max_relocks
+        self._lock = threading.Lock()
+        self._samples = np.zeros((0, 4))  # rows of time, piezo_V, current_mA, freq_GHz
+        self._relocks = np.zeros((0, 5))  # rows of time, from piezo_V, from current_mA, to piezo_V, to current_mA
+        self._operating_points = {}  # setpoint_GHz -> row of OPERATING_POINT_COLUMNS
+        self._saved = True
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                self._samples = data["samples"][-max_samples:]
+                self._relocks = data["relocks"][-max_relocks:]
+                if "operating_points" in data:
+                    self._operating_points = {row[1]: row for row in data["operating_points"]}
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def samples(self) -> np.ndarray:
+        """(N, 4) array of time, piezo output (V), current output (mA), frequency (GHz), oldest first."""
+        return self._samples
+
+    @property
+    def relocks(self) -> np.ndarray:
+        """(N, 5) array of time, piezo and current outputs before and after each relock, oldest first."""
+        return self._relocks
+
+    def add_sample(self, piezo_V: float, current_mA: float, freq_GHz: float, t: float = None):
+        if t is None:
+            t = self._clock()
+        with self._lock:
+            self._samples = np.vstack([self._samples[-(self.max_samples - 1):], [t, piezo_V, current_mA, freq_GHz]])
+            self._saved = False
+
+    def add_relock(self, from_piezo_V: float, from_current_mA: float, to_piezo_V: float, to_current_mA: float, t: float = None):
+        if t is None:
+            t = self._clock()
+        with self._lock:
+            self._relocks = np.vstack(
+                [self._relocks[-(self.max_relocks - 1):], [t, from_piezo_V, from_current_mA, to_piezo_V, to_current_mA]]
+            )
+            self._saved = False
+
+    def update_operating_point(self, setpoint_GHz: float, piezo_V: float, current_mA: float, t: float = None):
+        """Sets the latest locked outputs at setpoint_GHz."""
+        if t is None:
+            t = self._clock()
+        setpoint_GHz = round(setpoint_GHz, 3)
+        with self._lock:
+            row = self._operating_points.get(setpoint_GHz)
+            hop_low_V, hop_high_V = (np.nan, np.nan) if row is None else row[4:]
+            self._operating_points[setpoint_GHz] = np.array([t, setpoint_GHz, piezo_V, current_mA, hop_low_V, hop_high_V])
+            self._saved = False
+
+    def add_mode_hop(self, setpoint_GHz: float, piezo_V: float, tolerance_GHz: float = 0.1):
+        """Records that the laser hopped at piezo output piezo_V while locked at setpoint_GHz.
+
+        The hop is a lower boundary if piezo_V is below the median piezo output of the locked
+        samples within tolerance_GHz of the setpoint, otherwise an upper one.
+        """
+        setpoint_GHz = round(setpoint_GHz, 3)
+        with self._lock:
+            row = self._operating_points.get(setpoint_GHz)
+            if row is None:
+                return
+            locked = self._samples[np.abs(self._samples[:, 3] - setpoint_GHz) < tolerance_GHz]
+            center = np.median(locked[:, 1]) if len(locked) else row[2]
+            row = row.copy()
+            row[4 if piezo_V < center else 5] = piezo_V
+            self._operating_points[setpoint_GHz] = row
+            self._saved = False
+
+    def operating_point(self, setpoint_GHz: float, tolerance_GHz: float) -> dict:
+        """Returns the operating point of the recorded setpoint closest to setpoint_GHz, None if none is within tolerance_GHz."""
+        setpoints = np.array(list(self._operating_points))
+        if len(setpoints) == 0:
+            return None
+        nearest = setpoints[np.argmin(np.abs(setpoints - setpoint_GHz))]
+        if abs(nearest - setpoint_GHz) > tolerance_GHz:
+            return None
+        return _operating_point_dict(self._operating_points[nearest])
+
+    def operating_points(self) -> list:
+        """Returns the operating points of all recorded setpoints, sorted by setpoint."""
+        return [_operating_point_dict(self._operating_points[setpoint]) for setpoint in sorted(self._operating_points)]
+
+    def save(self):
+        """Writes the map to path if it changed since the last save."""
+        if self.path is None or self._saved:
+            return
+        with self._lock:
+            samples, relocks = self._samples, self._relocks
+            operating_points = np.array(list(self._operating_points.values())).reshape(-1, len(OPERATING_POINT_COLUMNS))
+            self._saved = True
+        np.savez(self.path, samples=samples, relocks=relocks, operating_points=operating_points)
+
+    def predictions(
+        self,
+        freq_GHz: float,
+        piezo_V: float,
+        current_mA: float,
+        tolerance_GHz: float,
+        n: int = 3,
+        min_age_s: float = 10,
+    ) -> list:
+        """Returns up to 2 * n (piezo output, current output) predicted to relock at freq_GHz, best first.
+
+        Args:
+            freq_GHz: frequency to relock to.
+            piezo_V, current_mA: outputs where the mode hop was detected.
+            tolerance_GHz: locked samples closer than this to freq_GHz are used.
+            n: number of relock jumps and of locked points to use.
+            min_age_s: locked samples taken less than this before now are skipped, they
+                are at the edge of the mode that just hopped.
+        """
+        points = [(piezo_V + jump[3] - jump[1], current_mA + jump[4] - jump[2]) for jump in self._relocks[::-1][:n]]
+        samples = self._samples
+        near = samples[(np.abs(samples[:, 3] - freq_GHz) < tolerance_GHz) & (samples[:, 0] < self._clock() - min_age_s)]
+        for sample in near[::-1]:
+            if len(points) == 2 * n:
+                break
+            point = (sample[1], sample[2])
+            if all(abs(point[0] - other[0]) > 0.1 or abs(point[1] - other[1]) > 0.01 for other in points):
+                points.append(point)
+        return points
+
+    def search(
+        self,
+        freq_GHz: float,
+        piezo_V: float,
+        current_mA: float,
+        tolerance_GHz: float,
+        piezo_step_V: float = 0.5,
+        current_step_mA: float = 0.05,
+        piezo_steps: int = 2,
+        current_steps: int = 6,
+    ):
+        """Yields (piezo output, current output) to try for a relock, best first.
+
+        The predictions come first, then the points of a grid around the first prediction
+        in order of distance, with current steps counting half as much as piezo steps.
+        Yields nothing if the map has no prediction.
+        """
+        points = self.predictions(freq_GHz, piezo_V, current_mA, tolerance_GHz)
+        yield from points
+        if not points:
+            return
+        steps = [
+            (i, j)
+            for i in range(-piezo_steps, piezo_steps + 1)
+            for j in range(-current_steps, current_steps + 1)
+            if (i, j) != (0, 0)
+        ]
+        steps.sort(key=lambda step: 2 * abs(step[0]) + abs(step[1]))
+        for i, j in steps:
+            yield points[0][0] + i * piezo_step_V, points[0][1] + j * current_step_mA
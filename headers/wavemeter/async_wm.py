@@ -0,0 +1,111 @@
+"""
+asyncio client for the wavemeter server.
+
+Unlike WM, which uses REQ sockets and has to wait for every reply before sending
+the next request, AsyncWM sends all requests on one DEALER socket and matches the
+replies to their requests by request id, so any number of requests can be in
+flight at once. It can be awaited from asyncio or tornado code:
+
+    wm = AsyncWM()
+    frequencies = await wm.read_frequencies([3, 4, 5, 7, 8])
+    linewidth = await wm.read_linewidth(3)
+
+Any remote WM method can be awaited as an attribute of AsyncWM, or with
+call(name, *args, **kwargs). Like on WM, the rpc_timeout keyword sets the time
+to wait for the reply, and all other arguments, including timeout, are passed to
+the remote method:
+
+    reading = await wm.wait_new_frequency(3, seq, timeout=5, rpc_timeout=7)
+"""
+import asyncio
+import itertools
+
+import zmq
+import zmq.asyncio
+
+import wm_protocol
+from wm_protocol import WMTimeoutError
+from wavemeter import SNAPSHOT_QUANTITIES
+
+
+class AsyncWM:
+    def __init__(self, port=9000, host="192.168.0.103", timeout=2.0):
+        """
+        port, host: address of the wavemeter server.
+        timeout: default time (s) to wait for each reply before raising WMTimeoutError.
+        """
+        self.timeout = timeout
+        self.socket = zmq.asyncio.Context.instance().socket(zmq.DEALER)
+        self.socket.connect("tcp://%s:%s" % (host, port))
+        self._request_ids = itertools.count(1)
+        self._pending = {}  # request id -> (method id, future)
+        self._receiver = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+        for method, future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self.socket.close(linger=0)
+
+    async def _receive(self):
+        """ Resolves the futures of incoming replies """
+        while True:
+            frames = await self.socket.recv_multipart(copy=False)
+            if len(frames) and len(frames[0].buffer) == 0:
+                frames = frames[1:]  # empty delimiter added by the ROUTER envelope
+            try:
+                request_id = wm_protocol.HEADER.unpack(frames[0].buffer)[4]
+            except Exception:
+                continue
+            method, future = self._pending.pop(request_id, (None, None))
+            if future is None or future.done():
+                continue  # reply to a request that already timed out
+            try:
+                future.set_result(wm_protocol.decode_reply(frames, method, request_id))
+            except Exception as e:
+                future.set_exception(e)
+
+    async def call(self, name, *args, rpc_timeout=None, **kwargs):
+        """ Calls the remote WM method name and returns its reply, waiting up to rpc_timeout (s, default self.timeout) """
+        timeout = self.timeout if rpc_timeout is None else rpc_timeout
+        request_id = next(self._request_ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (wm_protocol.method_id(name), future)
+        if self._receiver is None or self._receiver.done():
+            self._receiver = asyncio.ensure_future(self._receive())
+        try:
+            await self.socket.send_multipart([b""] + wm_protocol.encode_request(name, args, kwargs, request_id))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise WMTimeoutError("No reply to %s within %.3g s" % (name, timeout)) from None
+        finally:
+            self._pending.pop(request_id, None)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def remote(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
+        remote.__name__ = name
+        return remote
+
+    async def read_snapshot(self, channels=range(1, 9), quantities=SNAPSHOT_QUANTITIES, rpc_timeout=None):
+        """ Same as WM.read_snapshot """
+        quantities = list(quantities)
+        for quantity in quantities:
+            if quantity not in SNAPSHOT_QUANTITIES:
+                raise ValueError("Unknown snapshot quantity %s" % quantity)
+        return await self.call("_read_snapshot", [int(channel) for channel in channels], quantities, rpc_timeout=rpc_timeout)
+
+    async def read_frequencies(self, channels, rpc_timeout=None):
+        """ Reads the frequencies of several channels with all requests in flight at once """
+        return await asyncio.gather(*[self.call("read_frequency", channel, rpc_timeout=rpc_timeout) for channel in channels])
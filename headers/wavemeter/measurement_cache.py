@@ -0,0 +1,90 @@
+"""
+Latest wavemeter readings kept on the server, fed by the DLL event thread.
+
+Each reading of a channel holds every snapshot quantity (frequency, wavelength,
+power, linewidth, error) measured for that measurement, the DLL timestamp in ms
+and the next sequence number of that channel, so clients can ask for "a reading
+newer than the one I have". While the event thread runs, reads are answered from
+here and the number of DLL calls does not depend on the number of clients.
+"""
+import threading
+
+
+def frequency_reading(reading):
+    """ Returns [seq, timestamp, frequency] of a reading, the reply of wait_new_frequency """
+    return [reading["seq"], reading["timestamp"], reading["frequency"]]
+
+
+def frequency_snapshot(readings):
+    """ Returns {"seq", "timestamp", "frequency"} of several readings (None for none), the reply of wait_new_snapshot """
+    snapshot = {"seq": [], "timestamp": [], "frequency": []}
+    for reading in readings:
+        for quantity in snapshot:
+            snapshot[quantity].append(None if reading is None else reading[quantity])
+    return snapshot
+
+
+class MeasurementCache:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._latest = {}  # channel -> reading dict, replaced (never modified) on update
+        self._intervals = {}  # channel -> running average of the time between readings in ms
+        self.live = False  # True while the event thread keeps the cache up to date
+
+    def update(self, channel, timestamp, readings):
+        """ Stores the quantities of a new measurement of channel and returns its sequence number """
+        with self._condition:
+            previous = self._latest.get(channel, {"seq": 0})
+            seq = previous["seq"] + 1
+            if "timestamp" in previous and timestamp > previous["timestamp"]:
+                dt = timestamp - previous["timestamp"]
+                interval = self._intervals.get(channel)
+                self._intervals[channel] = dt if interval is None else 0.9 * interval + 0.1 * dt
+            self._latest[channel] = dict(readings, seq=seq, timestamp=timestamp)
+            self._condition.notify_all()
+        return seq
+
+    def get(self, channel):
+        """ Returns the latest reading of channel, or None if the cache is not live or has no reading """
+        if not self.live:
+            return None
+        return self._latest.get(channel)
+
+    def interval(self, channel):
+        """ Returns the recent average time in s between readings of channel, None before two readings """
+        interval = self._intervals.get(channel)
+        return None if interval is None else 1e-3 * interval
+
+    def newer(self, channel, last_seq):
+        """
+        Returns the latest reading of channel if it is not the reading last_seq,
+        otherwise None.
+
+        Any other sequence number counts as newer, so clients that kept a sequence
+        number from before a server restart do not wait forever.
+        """
+        latest = self._latest.get(channel)
+        if latest is None or latest["seq"] == last_seq:
+            return None
+        return latest
+
+    def wait_newer(self, channel, last_seq, timeout):
+        """ Like newer, but waits up to timeout (s) for a new reading """
+        with self._condition:
+            self._condition.wait_for(lambda: self.newer(channel, last_seq) is not None, timeout)
+            return self.newer(channel, last_seq)
+
+    def newer_any(self, channels, last_seqs):
+        """
+        Returns the latest readings of channels (None for a channel without one) if
+        the reading of any channel is newer than its entry of last_seqs, otherwise None.
+        """
+        if not any(self.newer(channel, last_seq) is not None for channel, last_seq in zip(channels, last_seqs)):
+            return None
+        return [self._latest.get(channel) for channel in channels]
+
+    def wait_newer_any(self, channels, last_seqs, timeout):
+        """ Like newer_any, but waits up to timeout (s) for a new reading """
+        with self._condition:
+            self._condition.wait_for(lambda: self.newer_any(channels, last_seqs) is not None, timeout)
+            return self.newer_any(channels, last_seqs)
@@ -0,0 +1,157 @@
+"""
+Time-slicing of the fiber switch between the channels of several locks.
+
+Left alone, the switch measures every channel in use in turn, so the update rate
+of each lock depends on how many other channels happen to be in use and on their
+exposure times. The arbiter instead enables one channel at a time for a slot of
+`dwell` measurements. Slots are handed out by smooth weighted round robin, so a
+channel with share 2 gets twice the slots of a channel with share 1, spread
+evenly over the round, and the longest gap between two readings of a channel is
+bounded by the shares of the others. Channels without a share are not measured.
+
+Within its slot a channel whose manual exposure gives a LowSignal or BigSignal
+reading has its exposure stepped up or down, so the next slot gives a usable
+reading instead of another error.
+"""
+import ctypes
+import threading
+import time
+
+import wlmConst
+
+
+# exposure factor of one adaptation step
+EXPOSURE_STEP = 1.5
+
+# switch channels the arbiter takes over
+SWITCH_CHANNELS = range(1, 9)
+
+
+class SwitchArbiter:
+    def __init__(self, dll, shares, dwell=2, max_slot_s=0.5, exposure_ms=(1, 2000)):
+        """
+        dll: wlmData DLL (or wm_simulator.SimulatedDLL) of the wavemeter.
+        shares: channel -> share of the measurements, e.g. {3: 2, 5: 1}.
+        dwell: measurements per slot, more measurements per slot spend less time switching.
+        max_slot_s: a slot ends after this time even without dwell measurements, so
+            a channel without light cannot hold the switch.
+        exposure_ms: (min, max) exposure of the adaptation, None to leave exposures alone.
+        """
+        self.dll = dll
+        self.dwell = dwell
+        self.max_slot_s = max_slot_s
+        self.exposure_ms = exposure_ms
+        self._lock = threading.Lock()
+        self._shares = {}
+        self._credit = {}
+        self._current = None
+        self._slot_start = None
+        self._slot_count = 0
+        self._period = None  # s, running average of the time between measurements
+        self._last_time = None
+        self._saved_states = {}
+        for channel, share in shares.items():
+            self.set_share(channel, share)
+
+    def _use(self, channel, use):
+        self.dll.SetSwitcherSignalStates(channel, int(use), int(use))
+
+    def start(self):
+        """ Takes over the switch, remembering which channels were in use """
+        use = ctypes.c_long(0)
+        show = ctypes.c_long(0)
+        with self._lock:
+            for channel in SWITCH_CHANNELS:
+                self.dll.GetSwitcherSignalStates(channel, ctypes.byref(use), ctypes.byref(show))
+                self._saved_states[channel] = (use.value, show.value)
+            self._next_slot(time.monotonic())
+            for channel in SWITCH_CHANNELS:
+                if channel != self._current:
+                    self._use(channel, False)
+
+    def stop(self):
+        """ Gives the switch back, with the channels in use before start """
+        with self._lock:
+            for channel, (use, show) in self._saved_states.items():
+                self.dll.SetSwitcherSignalStates(channel, use, show)
+            self._current = None
+
+    def set_share(self, channel, share):
+        """ Sets the share of channel, 0 to stop measuring it """
+        with self._lock:
+            if share > 0:
+                self._shares[channel] = share
+                self._credit.setdefault(channel, 0)
+            else:
+                self._shares.pop(channel, None)
+                self._credit.pop(channel, None)
+
+    @property
+    def shares(self):
+        return dict(self._shares)
+
+    def _next_slot(self, now):
+        """ Hands the switch to the next channel of the smooth weighted round robin """
+        self._slot_start = now
+        self._slot_count = 0
+        if not self._shares:
+            return
+        total = sum(self._shares.values())
+        for channel, share in self._shares.items():
+            self._credit[channel] += share
+        channel = max(self._credit, key=self._credit.get)
+        self._credit[channel] -= total
+        if channel != self._current:
+            self._use(channel, True)
+            if self._current is not None:
+                self._use(self._current, False)
+            self._current = channel
+
+    def _adapt_exposure(self, channel, error):
+        if self.dll.GetExposureModeNum(channel, 0):
+            return  # the wavemeter adjusts it
+        exposure = self.dll.GetExposureNum(channel, 1, 0)
+        if error == wlmConst.ErrLowSignal:
+            exposure *= EXPOSURE_STEP
+        else:
+            exposure /= EXPOSURE_STEP
+        exposure = min(max(exposure, self.exposure_ms[0]), self.exposure_ms[1])
+        self.dll.SetExposureNum(channel, 1, int(round(exposure)))
+
+    def on_measurement(self, channel, error):
+        """ Counts a new measurement of channel, called by the event thread """
+        now = time.monotonic()
+        with self._lock:
+            if self._last_time is not None:
+                dt = now - self._last_time
+                self._period = dt if self._period is None else 0.9 * self._period + 0.1 * dt
+            self._last_time = now
+            if channel != self._current:
+                return
+            self._slot_count += 1
+            if self.exposure_ms is not None and error in (wlmConst.ErrLowSignal, wlmConst.ErrBigSignal):
+                self._adapt_exposure(channel, error)
+            if self._slot_count >= self.dwell or self._current not in self._shares:
+                self._next_slot(now)
+
+    def tick(self):
+        """ Ends a slot that ran longer than max_slot_s, called regularly by the event thread """
+        now = time.monotonic()
+        with self._lock:
+            if self._slot_start is not None and now - self._slot_start > self.max_slot_s:
+                self._next_slot(now)
+
+    def update_interval(self, channel):
+        """
+        Returns (mean, max) time in s between readings of channel that the schedule
+        gives at the current measurement rate, or None if channel has no share or no
+        measurement was made yet.
+        """
+        with self._lock:
+            share = self._shares.get(channel)
+            if share is None or self._period is None:
+                return None
+            total = sum(self._shares.values())
+            mean = self._period * total / share
+            longest = self._period * (self.dwell * (total - share) + 1)
+            return mean, longest
@@ -31,88 +31,225 @@ sys.path.append(script_directory)
 # wlmData.dll related imports
 from wlmData import LoadDLL
 import wlmConst as wlmConst
+import wm_protocol
+from wm_protocol import WMError, WMProtocolError, WMRemoteError, WMTimeoutError
 
 
 # others
 import time
 import ctypes
+import functools
+import itertools
+import threading
 import zmq
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from zmq_publisher import zmqPublisher
+from measurement_cache import MeasurementCache, frequency_reading, frequency_snapshot
 import matplotlib.animation as animation
     
 ##
 
+# quantities that can be requested in one WM.read_snapshot call
+SNAPSHOT_QUANTITIES = ("frequency","wavelength","power","linewidth","error","seq","timestamp")
+
+# quantities the server reads from the DLL for every new measurement
+MEASURED_QUANTITIES = ("frequency","wavelength","power","linewidth","error")
+
+# idle REQ sockets a client keeps for the next requests, more concurrent requests open and close their own
+MAX_IDLE_SOCKETS = 8
+
+
 class WM:
-    def __init__(self,mode='client',port=9000,publish=False,stream_port=5563,):
+    def __init__(self,mode='client',port=9000,publish=False,stream_port=5563,timeout=2.0,retries=2,host="192.168.0.103",dll=None):
+        """
+        host: address of the wavemeter computer that clients connect to.
+        dll: server mode only, use this object instead of loading wlmData,
+            e.g. wm_simulator.SimulatedDLL to run without the wavemeter.
+        timeout: default time (s) a client waits for each reply. Calls can override it with
+            the rpc_timeout keyword argument.
+        retries: how often a client reconnects and resends a request that timed out
+            before raising WMTimeoutError.
+        """
         
         self.port = port
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
         self.mode = mode
         self.publish = publish
         
         if mode=='server':
             
-            self.dll = LoadDLL()
-            from bristol_fos_windows import FOS
-            self.fos = FOS()
+            self.cache = MeasurementCache() #filled by the event thread of wm_server.WMServer
+            self.arbiter = None #switch_arbiter.SwitchArbiter set by wm_server.WMServer if the switch is time-sliced
+            if dll is None:
+                self.dll = LoadDLL()
+                from bristol_fos_windows import FOS
+                self.fos = FOS()
+            else:
+                self.dll = dll
 
 
         elif mode=='client':
-            zmq_context = zmq.Context()
-            self.socket = zmq_context.socket(zmq.REQ)
-            self.socket.connect("tcp://192.168.0.103:%s"%self.port) #wavemeter comp
-            #self.socket.connect("tcp://192.168.0.102:%s"%self.port) # fancy windows comp
-            print("Connected to handler at 192.168.0.103:%s"%self.port)
+            # every request checks a REQ socket out of a pool, so threads never share one
+            self._context = zmq.Context.instance()
+            self._address = "tcp://%s:%s"%(host,self.port) #wavemeter comp, fancy windows comp is 192.168.0.102
+            self._sockets = [] #all open sockets
+            self._idle_sockets = [] #sockets in the pool, at most MAX_IDLE_SOCKETS
+            self._sockets_lock = threading.Lock()
+            print("Connected to handler at %s:%s"%(host,self.port))
         
             if publish:
                 self.publisher = zmqPublisher(port=stream_port,topic='wavemeter')
                 
         self.interferogram_enable=False
+        self._request_ids = itertools.count(1)
+
+    def _checkout_socket(self):
+        """ Idle REQ socket of the pool, or a new one if none is idle """
+        with self._sockets_lock:
+            if self._idle_sockets:
+                return self._idle_sockets.pop()
+        socket = self._context.socket(zmq.REQ)
+        socket.connect(self._address)
+        with self._sockets_lock:
+            self._sockets.append(socket)
+        return socket
+
+    def _return_socket(self,socket,reusable=True):
+        """ Put a socket back into the pool, or close it if it is not reusable (e.g. after a lost reply) or the pool is full """
+        with self._sockets_lock:
+            if socket not in self._sockets:
+                return #closed by close()
+            if reusable and len(self._idle_sockets)<MAX_IDLE_SOCKETS:
+                self._idle_sockets.append(socket)
+                return
+            self._sockets.remove(socket)
+        socket.close(linger=0)
+
+    def close(self):
+        """ Close all sockets """
+        with self._sockets_lock:
+            for socket in self._sockets:
+                socket.close(linger=0)
+            self._sockets = []
+            self._idle_sockets = []
         
     def _mode_check(func):
-        def wrapper(self,*args,**kwargs):
+        @functools.wraps(func)
+        def wrapper(self,*args,rpc_timeout=None,**kwargs):
             if self.mode=='client':
-                msg = func.__name__+';'+str(args)+';'+str(kwargs)
-                resp = self._ask(msg)
-                return resp
+                return self._ask(func.__name__,args,kwargs,rpc_timeout)
             else:
                 return func(self,*args,**kwargs)
+        wrapper.remote_method = True #served by wm_server.WMServer
         return wrapper
         
 
-    def _ask(self,message):
-        """ Send request to zmq server to pass message to wavemeter client """
-        if isinstance(message,str): message = message.encode()
-        self.socket.send(message)
-        
-        reply = self.socket.recv()
-        try:
-            reply = float(reply.decode()) #convert answers to floats when applicable
-        except:
-            reply = reply.decode()
-        return reply
+    def _ask(self,method,args=(),kwargs={},timeout=None):
+        """
+        Send a request to the wavemeter server and return the decoded reply.
+
+        If no reply arrives within timeout (s, default self.timeout), the socket is
+        closed, a new one is connected and the request is sent again ("lazy pirate").
+        Raises WMTimeoutError after self.retries failed retries.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        for attempt in range(1+self.retries):
+            request_id = next(self._request_ids) & 0xFFFFFFFF
+            socket = self._checkout_socket()
+            reusable = False #a REQ socket without the reply cannot send again
+            try:
+                socket.send_multipart(wm_protocol.encode_request(method,args,kwargs,request_id))
+                if socket.poll(1e3*timeout,zmq.POLLIN):
+                    reply = socket.recv_multipart(copy=False)
+                    reusable = True
+                    return wm_protocol.decode_reply(reply,wm_protocol.method_id(method),request_id)
+            finally:
+                self._return_socket(socket,reusable)
+        raise WMTimeoutError("No reply to %s within %.3g s after %i attempts"%(method,timeout,1+self.retries))
         
 
 
     # for webapp:
     @property
     def wavelengths(self):
-        return [self.read_wavelength(i+1) for i in range(8)]
+        return self.read_snapshot(quantities=["wavelength"])["wavelength"]
         
     @property
     def frequencies(self):
-        return [self.read_frequency(i+1) for i in range(8)]
+        return self.read_snapshot(quantities=["frequency"])["frequency"]
         
     @property
     def powers(self):
-        return [self.read_laser_power(i+1) for i in range(8)]
+        return self.read_snapshot(quantities=["power"])["power"]
         
+    def read_snapshot(self,channels=range(1,9),quantities=SNAPSHOT_QUANTITIES):
+        """
+        Read several quantities for several channels with a single request.
+
+        quantities: any of "frequency" (GHz, or error string like read_frequency),
+        "wavelength" (nm), "power" (uW), "linewidth" (GHz), "error"
+        (measurement error code, None if the reading is valid), "seq" (sequence
+        number of the reading) and "timestamp" (DLL timestamp in ms of the reading).
+        seq and timestamp are None if the server is not caching measurements.
+
+        Returns a dict mapping each quantity to a list with one value per channel.
+        """
+        channels = [int(channel) for channel in channels]
+        quantities = list(quantities)
+        for quantity in quantities:
+            if quantity not in SNAPSHOT_QUANTITIES:
+                raise ValueError("Unknown snapshot quantity %s"%quantity)
+        return self._read_snapshot(channels,quantities)
+
+    @_mode_check
+    def _read_snapshot(self,channels,quantities):
+        """ Server side of read_snapshot, answered from the measurement cache when possible """
+        snapshot = {quantity:[] for quantity in quantities}
+        for channel in channels:
+            reading = self.cache.get(channel)
+            if reading is None:
+                reading = self._read_dll(channel,quantities)
+            for quantity in quantities:
+                snapshot[quantity].append(reading.get(quantity))
+        return snapshot
+
+    def _read_dll(self,channel,quantities=MEASURED_QUANTITIES):
+        """ Server side: read the measured quantities of channel directly from the DLL """
+        reading = {}
+        if "frequency" in quantities or "error" in quantities:
+            frequency = float(self.dll.GetFrequencyNum(ctypes.c_long(channel),ctypes.c_double(0.0)))
+            if frequency<0:
+                reading["error"] = int(frequency)
+                reading["frequency"] = wlmConst.meas_error_to_str(frequency)
+            else:
+                reading["error"] = None
+                reading["frequency"] = 1e3*frequency
+        if "wavelength" in quantities:
+            reading["wavelength"] = float(self.dll.GetWavelengthNum(channel,0.0))
+        if "power" in quantities:
+            reading["power"] = float(self.dll.GetPowerNum(channel,0))
+        if "linewidth" in quantities:
+            reading["linewidth"] = float(self.dll.GetLinewidthNum(channel,0))
+        return reading
+
+    def _cached(self,channel,quantity):
+        """ Server side: latest cached value of a quantity, None if there is none """
+        reading = self.cache.get(channel)
+        if reading is None:
+            return None
+        return reading[quantity]
         
     @_mode_check    
     def read_frequency(self,channel):
         """ Return frequency of channel in GHz """
+        cached = self._cached(channel,"frequency")
+        if cached is not None:
+            return cached
         frequency = self.dll.GetFrequencyNum(ctypes.c_long(channel),ctypes.c_double(0.0))
         frequency = float(frequency)
         if frequency<0:
@@ -120,9 +257,73 @@ class WM:
         else:
             return 1e3*float(frequency)
     
+    @_mode_check
+    def wait_new_frequency(self,channel,last_seq=0,timeout=1.0):
+        """
+        Wait up to timeout (s) for a frequency reading of channel newer than the
+        reading numbered last_seq.
+
+        Returns [seq, DLL timestamp in ms, frequency] of the newest reading, where
+        frequency is in GHz or an error string like read_frequency, or None if no
+        new reading arrived within timeout.
+        If the server does not cache measurements (its event thread is not running),
+        the current reading is returned at once, with seq and timestamp None.
+        Clients waiting longer than the WM timeout should pass a larger rpc_timeout.
+        """
+        if not self.cache.live:
+            return [None,None,self._read_dll(channel,["frequency"])["frequency"]]
+        reading = self.cache.wait_newer(channel,last_seq,timeout)
+        if reading is None:
+            return None
+        return frequency_reading(reading)
+
+    @_mode_check
+    def wait_new_snapshot(self,channels,last_seqs,timeout=1.0):
+        """
+        Wait up to timeout (s) for a frequency reading of any of channels newer than
+        its reading numbered in last_seqs (one entry per channel, 0 for none).
+
+        Returns the newest readings of all channels as a dict of lists like
+        read_snapshot(channels,["seq","timestamp","frequency"]), with None for a
+        channel without a reading, or None if no new reading arrived within timeout.
+        If the server does not cache measurements, the current readings are returned
+        at once, with seq and timestamp None.
+        Clients waiting longer than the WM timeout should pass a larger rpc_timeout.
+        """
+        if len(channels)!=len(last_seqs):
+            raise ValueError("One last_seq per channel is needed")
+        if not self.cache.live:
+            return self._read_snapshot(channels,["seq","timestamp","frequency"])
+        readings = self.cache.wait_newer_any(channels,last_seqs,timeout)
+        if readings is None:
+            return None
+        return frequency_snapshot(readings)
+
+    @_mode_check
+    def get_update_interval(self,channel):
+        """
+        Return the time between new readings of channel as a dict:
+        "mean" and "max" (s) are given by the switch arbiter schedule (None if the
+        switch is not time-sliced or channel has no share), "measured" (s) is the
+        recent average of the cached readings (None without the event thread).
+        """
+        schedule = self.arbiter.update_interval(channel) if self.arbiter is not None else None
+        mean,longest = schedule if schedule is not None else (None,None)
+        return {"mean":mean,"max":longest,"measured":self.cache.interval(channel)}
+
+    @_mode_check
+    def set_switch_share(self,channel,share):
+        """ Set the share of the switch measurements that channel gets, 0 to stop measuring it """
+        if self.arbiter is None:
+            raise WMError("The switch is not time-sliced by this server")
+        self.arbiter.set_share(channel,share)
+
     @_mode_check
     def read_wavelength(self,channel):
         """ Return the wavelength of channel in nm """
+        cached = self._cached(channel,"wavelength")
+        if cached is not None:
+            return cached
         wavelength = self.dll.GetWavelengthNum(channel,0.0)
         return float(wavelength)
         
@@ -197,12 +398,18 @@ class WM:
     @_mode_check 
     def read_laser_power(self,channel):
         """ Returns laser power of channel in uW """
+        cached = self._cached(channel,"power")
+        if cached is not None:
+            return cached
         power = self.dll.GetPowerNum(channel,0)
         return float(power)
 
     @_mode_check 
     def read_linewidth(self,channel):
         """ Returns linewidth of channel in GHz."""
+        cached = self._cached(channel,"linewidth")
+        if cached is not None:
+            return cached
         linewidth = self.dll.GetLinewidthNum(channel, 0)
         return float(linewidth)
     
@@ -290,26 +497,31 @@ class WM:
         
         item_count = self.dll.GetPatternItemCount(wlmConst.cSignal1WideInterferometer)
         self.interferogram_itemcount = item_count
+        # the DLL writes interferograms straight into this buffer, reused for every fetch
+        self._interferogram_buffer = np.zeros(item_count,dtype=np.dtype(ctypes.c_ulong))
+        self._interferogram_pointer = self._interferogram_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_ulong))
         
         return ret
 
     @_mode_check
     def _fetch_interferogram(self,channel):
+        """
+        Returns the wide interferogram of channel as a uint32 array.
+        The array is sent as a raw frame, decode it with _format_str_array.
+        """
         if not self.interferogram_enable:
             self._setup_interferogram()
             
         loc = self.dll.GetPatternNum(channel,wlmConst.cSignal1WideInterferometer)
-
-        c_arr = ctypes.c_ulong*self.interferogram_itemcount
-        arr_init = self.interferogram_itemcount*[0]
-        PArray = ctypes.pointer(c_arr(*arr_init))
-        self.dll.GetPatternDataNum.argtypes = [ ctypes.c_long, ctypes.c_long, ctypes.POINTER(c_arr) ]
-        #PArray = ctypes.pointer(ctypes.c_ulong(0))
-        ret = self.dll.GetPatternDataNum(channel,wlmConst.cSignal1WideInterferometer,PArray)
+        ret = self.dll.GetPatternDataNum(channel,wlmConst.cSignal1WideInterferometer,self._interferogram_pointer)
         
-        arr = [PArray.contents[i] for i in range(self.interferogram_itemcount)]
-        return arr
-        #return PArray
+        # the reply gets its own copy, so the buffer can be refilled while the reply is being sent
+        return self._interferogram_buffer.astype(np.uint32)
+
+    @_mode_check
+    def _fetch_interferograms(self,channels):
+        """ Returns the interferograms of several channels with one request """
+        return [self._fetch_interferogram(channel) for channel in channels]
     
     @_mode_check
     def change_bristol_channel(self,chan):
@@ -317,8 +529,8 @@ class WM:
 
     def _format_str_array(self,arr):
         if isinstance(arr,str):
-            st = arr.strip('[').strip(']').split(',')
-            arr = np.array(st,dtype=int)
+            arr = np.array(arr.strip('[').strip(']').split(','),dtype=int)
+        if isinstance(arr,np.ndarray):
             arr = np.trim_zeros(arr,trim='b')
             arr = arr.astype('float')
         return arr
@@ -336,9 +548,8 @@ class WM:
             channels = [channels]
             lines = [lines]
         
-        for i in range(len(channels)):
-            new_data = self._format_str_array(self._fetch_interferogram(channels[i]))
-            lines[i].set_ydata(new_data)
+        for i,arr in enumerate(self._fetch_interferograms(channels)):
+            lines[i].set_ydata(self._format_str_array(arr))
         return lines,
         
     def live_plot_interferogram(self,channels):
@@ -348,8 +559,8 @@ class WM:
         fig = plt.figure()
         lines = []
         
-        for i in range(len(channels)):
-            new_data = self._format_str_array(self._fetch_interferogram(channels[i]))
+        for i,arr in enumerate(self._fetch_interferograms(channels)):
+            new_data = self._format_str_array(arr)
        
             lines.append(plt.plot(new_data,label="Channel %i"%(channels[i]))[0])
         ani = animation.FuncAnimation(fig,self._update_live_plot_interferogram,fargs=(channels,lines),frames=50,blit=False)
@@ -442,35 +653,61 @@ class WM:
         ret = self.dll.ClearPIDHistory(channel)
         return ret
 
-    def stream_some_frequencies(self,channels=[3,4,5,7,8],sleep_time = None):
+    def stream_some_frequencies(self,channels=[3,4,5,7,8],sleep_time = None,rates=None,priorities=None,max_in_flight=4):
         """
         Display a constant stream of frequency readings for selected channels. 
         If publishing is on, publish values to zmq port. 
+        Every channel is read by its own task of a wm_scheduler.ChannelScheduler, at
+        rates[channel] readings per second (default 1/(sleep_time*len(channels)), i.e. 1 Hz),
+        with priorities[channel] (default 0) deciding who goes first when more than
+        max_in_flight reads are due. A reading is only published again if it is a new measurement.
+        Returns the per-channel statistics (reads, errors, missed deadlines) when stopped.
         """
-        
-        go = True
-        while go:
-            for i in channels:
+        import asyncio
+        from async_wm import AsyncWM
+        from wm_scheduler import ChannelScheduler
+        if(sleep_time==None):
+            sleep_time = 1.0/len(channels)
+        rates = rates or {}
+        priorities = priorities or {}
+        last_seqs = {}
+        scheduler = None
+
+        def on_reading(channel,reading):
+            seq = reading["seq"]
+            if seq is not None and seq==last_seqs.get(channel):
+                return
+            last_seqs[channel] = seq
+            error = reading["error"] or 0
+            frequency = reading["frequency"] if not error else np.nan
+            if self.publish:
+                self.publisher.publish_record(channel,frequency,error,seq or 0)
+            else:
+                print((channel,frequency,error,seq or 0))
+
+        async def run():
+            nonlocal scheduler
+            async with AsyncWM(port=self.port,host=self.host,timeout=self.timeout) as wm:
+                scheduler = ChannelScheduler(wm,max_in_flight=max_in_flight,on_reading=on_reading)
+                for channel in channels:
+                    scheduler.add_channel(channel,rates.get(channel,1.0/(sleep_time*len(channels))),priorities.get(channel,0))
                 try:
-                    #print("Test")
-                    new_data = self.read_frequency(i)
-                    if self.publish:
-                        self.publisher.publish_data((i,round(new_data,6)),prnt=True)
-                    else:
-                        print(new_data)
-                    if(sleep_time==None):
-                        sleep_time = 1.0/len(channels)
-                    time.sleep(sleep_time)
-
-                except(KeyboardInterrupt):
-                    go=False
-                    break
-
-                except Exception as e:
-                    print(e)
+                    await scheduler.run()
+                except asyncio.CancelledError: #stopped with ctrl-c
+                    pass
+
+        try:
+            asyncio.run(run())
+        except(KeyboardInterrupt): #asyncio.run raises it again after cancelling run
+            pass
+        if scheduler is None:
+            return {}
+        return {channel: stats.as_dict() for channel, stats in scheduler.stats.items()}
 
 if __name__=='__main__':
+    from wm_server import WMServer
     wm = WM(mode = 'server')
+    WMServer(wm,port=wm.port).serve_forever()
     
 
 
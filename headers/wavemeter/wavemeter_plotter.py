@@ -7,11 +7,21 @@ from matplotlib.ticker import ScalarFormatter
 from matplotlib import rcParams
 rcParams.update({'figure.autolayout':True})
 from wavemeter import WM
+from zmq_subscriber import zmqSubscriber
 
 class LivePlotter:
-    def __init__(self):
+    def __init__(self,subscribe=False):
+        """
+        subscribe: read the frequencies from the wavemeter server event stream instead
+        of requesting them from the server every frame
+        """
         
-        self.wm = WM()
+        if subscribe:
+            self.subscriber = zmqSubscriber()
+            time.sleep(0.5) #let the first readings arrive
+        else:
+            self.subscriber = None
+            self.wm = WM()
         
 
         self.freqs = np.array([np.array([0]) for i in range(8)])
@@ -22,7 +32,11 @@ class LivePlotter:
         self.times = self.times[1:]
     
     def get_freq(self,channel):
-        freq = self.wm.read_frequency(channel)
+        if self.subscriber is not None:
+            latest = self.subscriber.latest(channel)
+            freq = latest[1] if latest is not None and not latest[2] else 0.0
+        else:
+            freq = self.wm.read_frequency(channel)
         try:
             freq = float(freq)
         except:
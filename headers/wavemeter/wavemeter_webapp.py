@@ -23,7 +23,8 @@ def send_data():
     if len(clients)>0:
         #data = wlmeter.wavelengths
         #data = wlmeter.frequencies
-        data = wlmeter.frequencies + wlmeter.powers
+        snapshot = wlmeter.read_snapshot(quantities=["frequency","power"])
+        data = snapshot["frequency"] + snapshot["power"]
         str = json.dumps(data) #converts to JavaScript friendly form
         for c in clients:
             c.write_message(str) #tornado websocket function to send message to client
@@ -0,0 +1,236 @@
+"""
+Binary wire protocol between WM clients and the wavemeter server.
+
+Every message is a zmq multipart message:
+    [header, body, array_0, array_1, ...]
+
+header: magic b"WM", protocol version, message kind, method id and request id.
+body: a tagged binary encoding of the request arguments or the reply value.
+array_n: raw numpy array data referenced from the body by index, so arrays
+(e.g. interferograms) are never converted to text and decode with np.frombuffer.
+
+Method ids are the crc32 of the method name, so the id of a method does not
+depend on the order the methods are defined in.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+
+PROTOCOL_VERSION = 1
+MAGIC = b"WM"
+
+KIND_REQUEST = 0
+KIND_REPLY = 1
+KIND_ERROR = 2
+
+HEADER = struct.Struct("<2sBBII")  # magic, version, kind, method id, request id
+
+_LENGTH = struct.Struct("<I")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_ARRAY = struct.Struct("<BBI")  # dtype string length, ndim, frame index
+_DIM = struct.Struct("<Q")
+
+# numpy dtype kinds allowed in array frames: bool, signed, unsigned, float
+_ARRAY_KINDS = "biuf"
+
+
+class WMError(Exception):
+    """Base class of errors raised by WM clients."""
+
+
+class WMProtocolError(WMError):
+    """A message does not follow the wire protocol."""
+
+
+class WMRemoteError(WMError):
+    """The wavemeter server raised an exception while handling a request."""
+
+
+class WMTimeoutError(WMError):
+    """The wavemeter server did not reply in time, even after retrying."""
+
+
+def method_id(name):
+    """ Returns the wire id of a method name """
+    return zlib.crc32(name.encode()) & 0xFFFFFFFF
+
+
+def _encode_value(value, parts, arrays):
+    if value is None:
+        parts.append(b"N")
+    elif isinstance(value, (bool, np.bool_)):
+        parts.append(b"T" if value else b"F")
+    elif isinstance(value, (int, np.integer)):
+        parts.append(b"i" + _INT.pack(int(value)))
+    elif isinstance(value, (float, np.floating)):
+        parts.append(b"d" + _FLOAT.pack(float(value)))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        parts.append(b"s" + _LENGTH.pack(len(data)) + data)
+    elif isinstance(value, (bytes, bytearray)):
+        parts.append(b"b" + _LENGTH.pack(len(value)) + bytes(value))
+    elif isinstance(value, np.ndarray):
+        if value.dtype.kind not in _ARRAY_KINDS:
+            raise WMProtocolError("Cannot send arrays of dtype %s" % value.dtype)
+        dtype = value.dtype.str.encode("ascii")
+        parts.append(b"a" + _ARRAY.pack(len(dtype), value.ndim, len(arrays)) + dtype)
+        parts.extend(_DIM.pack(n) for n in value.shape)
+        arrays.append(np.ascontiguousarray(value))
+    elif isinstance(value, (list, tuple, range)):
+        parts.append(b"l" + _LENGTH.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts, arrays)
+    elif isinstance(value, dict):
+        parts.append(b"m" + _LENGTH.pack(len(value)))
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise WMProtocolError("Dict keys must be str, got %r" % (key,))
+            _encode_value(key, parts, arrays)
+            _encode_value(item, parts, arrays)
+    else:
+        raise WMProtocolError("Cannot send values of type %s" % type(value).__name__)
+
+
+class _Decoder:
+    def __init__(self, body, arrays):
+        self.body = body
+        self.arrays = arrays
+        self.pos = 0
+
+    def _take(self, n):
+        if self.pos + n > len(self.body):
+            raise WMProtocolError("Message body is truncated")
+        data = self.body[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def _unpack(self, fmt):
+        return fmt.unpack(self._take(fmt.size))
+
+    def value(self):
+        tag = bytes(self._take(1))
+        if tag == b"N":
+            return None
+        if tag == b"T":
+            return True
+        if tag == b"F":
+            return False
+        if tag == b"i":
+            return self._unpack(_INT)[0]
+        if tag == b"d":
+            return self._unpack(_FLOAT)[0]
+        if tag == b"s":
+            length, = self._unpack(_LENGTH)
+            return bytes(self._take(length)).decode("utf-8")
+        if tag == b"b":
+            length, = self._unpack(_LENGTH)
+            return bytes(self._take(length))
+        if tag == b"a":
+            return self._array()
+        if tag == b"l":
+            length, = self._unpack(_LENGTH)
+            return [self.value() for i in range(length)]
+        if tag == b"m":
+            length, = self._unpack(_LENGTH)
+            items = {}
+            for i in range(length):
+                key = self.value()
+                if not isinstance(key, str):
+                    raise WMProtocolError("Dict keys must be str")
+                items[key] = self.value()
+            return items
+        raise WMProtocolError("Unknown value tag %r" % tag)
+
+    def _array(self):
+        dtype_length, ndim, index = self._unpack(_ARRAY)
+        dtype = np.dtype(bytes(self._take(dtype_length)).decode("ascii"))
+        if dtype.kind not in _ARRAY_KINDS:
+            raise WMProtocolError("Arrays of dtype %s are not allowed" % dtype)
+        shape = tuple(self._unpack(_DIM)[0] for i in range(ndim))
+        if index >= len(self.arrays):
+            raise WMProtocolError("Array frame %i is missing" % index)
+        buffer = self.arrays[index]
+        if len(buffer) != dtype.itemsize * int(np.prod(shape)):
+            raise WMProtocolError("Array frame %i does not match its dtype and shape" % index)
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+    def done(self):
+        if self.pos != len(self.body):
+            raise WMProtocolError("Unexpected data after the message body")
+
+
+def _buffer(frame):
+    """ Returns a memoryview of a zmq.Frame or bytes-like object """
+    return memoryview(getattr(frame, "buffer", frame)).cast("B")
+
+
+def encode(kind, method, request_id, value):
+    """ Returns the frames of a message carrying value """
+    parts = []
+    arrays = []
+    _encode_value(value, parts, arrays)
+    header = HEADER.pack(MAGIC, PROTOCOL_VERSION, kind, method, request_id)
+    return [header, b"".join(parts)] + arrays
+
+
+def decode(frames):
+    """ Returns (kind, method id, request id, value) of a received message """
+    if len(frames) < 2:
+        raise WMProtocolError("Message has %i frames, expected at least 2" % len(frames))
+    header = _buffer(frames[0])
+    if len(header) != HEADER.size:
+        raise WMProtocolError("Bad header size %i" % len(header))
+    magic, version, kind, method, request_id = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise WMProtocolError("Bad magic %r" % magic)
+    if version != PROTOCOL_VERSION:
+        raise WMProtocolError("Protocol version %i is not supported, expected %i" % (version, PROTOCOL_VERSION))
+    if kind not in (KIND_REQUEST, KIND_REPLY, KIND_ERROR):
+        raise WMProtocolError("Unknown message kind %i" % kind)
+    decoder = _Decoder(_buffer(frames[1]), [_buffer(frame) for frame in frames[2:]])
+    value = decoder.value()
+    decoder.done()
+    return kind, method, request_id, value
+
+
+def encode_request(name, args, kwargs, request_id):
+    return encode(KIND_REQUEST, method_id(name), request_id, [list(args), kwargs])
+
+
+def decode_request(frames):
+    """ Returns (method id, request id, args, kwargs) of a request message """
+    kind, method, request_id, value = decode(frames)
+    if kind != KIND_REQUEST:
+        raise WMProtocolError("Expected a request, got message kind %i" % kind)
+    if not (isinstance(value, list) and len(value) == 2
+            and isinstance(value[0], list) and isinstance(value[1], dict)):
+        raise WMProtocolError("Request body must be [args, kwargs]")
+    return method, request_id, value[0], value[1]
+
+
+def encode_reply(method, request_id, value):
+    return encode(KIND_REPLY, method, request_id, value)
+
+
+def encode_error(method, request_id, message):
+    return encode(KIND_ERROR, method, request_id, str(message))
+
+
+def decode_reply(frames, method=None, request_id=None):
+    """
+    Returns the value of a reply message.
+    Raises WMRemoteError if the server replied with an error.
+    """
+    kind, reply_method, reply_id, value = decode(frames)
+    if kind == KIND_REQUEST:
+        raise WMProtocolError("Expected a reply, got a request")
+    if method is not None and reply_method != method:
+        raise WMProtocolError("Reply is for method id %i, expected %i" % (reply_method, method))
+    if request_id is not None and reply_id != request_id:
+        raise WMProtocolError("Reply is for request %i, expected %i" % (reply_id, request_id))
+    if kind == KIND_ERROR:
+        raise WMRemoteError(value)
+    return value
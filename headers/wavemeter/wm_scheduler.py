@@ -0,0 +1,124 @@
+"""
+asyncio scheduler that reads each wavemeter channel at its own rate.
+
+Every channel runs its own task with a target rate and a priority. Reads of
+different channels run concurrently on one AsyncWM, so a slow read of one
+channel does not delay the others. At most max_in_flight reads are in flight;
+when more are due, channels with higher priority go first. A read that cannot
+finish before the channel's next deadline counts as a missed deadline, and the
+channel skips to its next free slot instead of bursting to catch up.
+
+    scheduler = ChannelScheduler(AsyncWM(), on_reading=print)
+    scheduler.add_channel(3, rate=20, priority=1)  # lock channel
+    scheduler.add_channel(5, rate=1)  # monitor channel
+    asyncio.run(scheduler.run())
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+from wm_protocol import WMError
+
+
+class PriorityGate:
+    """Limits the number of concurrent holders; waiting holders with higher priority enter first."""
+
+    def __init__(self, slots):
+        self._free = slots
+        self._waiting = []  # heap of (-priority, order, future)
+        self._order = itertools.count()
+
+    async def acquire(self, priority=0):
+        if self._free > 0 and not self._waiting:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (-priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over just before cancelling
+            raise
+
+    def release(self):
+        while self._waiting:
+            priority, order, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)  # hand the slot over
+                return
+        self._free += 1
+
+
+class ChannelStats:
+    def __init__(self):
+        self.reads = 0
+        self.errors = 0
+        self.missed_deadlines = 0
+        self.last_latency = None  # s, from the deadline to the reply
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class ChannelScheduler:
+    def __init__(self, wm, max_in_flight=4, on_reading=None, quantities=("frequency", "error", "seq")):
+        """
+        wm: AsyncWM.
+        max_in_flight: maximum number of concurrent reads.
+        on_reading: called as on_reading(channel, reading) for every read, where reading
+            maps each of quantities to its value.
+        """
+        self.wm = wm
+        self.on_reading = on_reading
+        self.quantities = list(quantities)
+        self._gate = PriorityGate(max_in_flight)
+        self._channels = {}  # channel -> (rate, priority)
+        self.stats = {}
+
+    def add_channel(self, channel, rate, priority=0):
+        """ Reads channel rate times per second. Higher priority channels are read first when busy. """
+        self._channels[channel] = (rate, priority)
+        self.stats[channel] = ChannelStats()
+
+    async def _read(self, channel, priority):
+        await self._gate.acquire(priority)
+        try:
+            snapshot = await self.wm.read_snapshot([channel], self.quantities)
+        finally:
+            self._gate.release()
+        return {quantity: values[0] for quantity, values in snapshot.items()}
+
+    async def _run_channel(self, channel, rate, priority, end):
+        stats = self.stats[channel]
+        period = 1 / rate
+        deadline = time.monotonic()
+        while end is None or deadline < end:
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+            next_deadline = deadline + period
+            try:
+                reading = await asyncio.wait_for(self._read(channel, priority), max(period, self.wm.timeout))
+            except (WMError, asyncio.TimeoutError):
+                stats.errors += 1
+                reading = None
+            now = time.monotonic()
+            stats.last_latency = now - deadline
+            if reading is not None:
+                stats.reads += 1
+                if self.on_reading is not None:
+                    self.on_reading(channel, reading)
+            if now > next_deadline:
+                missed = int((now - deadline) // period)
+                stats.missed_deadlines += missed
+                next_deadline = deadline + (missed + 1) * period
+            deadline = next_deadline
+
+    async def run(self, duration=None):
+        """ Runs until cancelled, or for duration seconds """
+        end = None if duration is None else time.monotonic() + duration
+        await asyncio.gather(*[
+            self._run_channel(channel, rate, priority, end)
+            for channel, (rate, priority) in self._channels.items()
+        ])
+        return {channel: stats.as_dict() for channel, stats in self.stats.items()}
@@ -0,0 +1,342 @@
+"""
+Request server for WM clients, runs on the wavemeter computer.
+
+A ROUTER socket accepts requests from any number of WM clients. Requests that
+change wavemeter settings or touch the interferogram buffers are executed one
+at a time on a single DLL thread. Measurement reads only look at the wlmData
+shared memory and are answered by a pool of worker threads, so a slow request
+from one client does not hold up the others.
+
+Workers hand their replies back to the main thread, which owns the ROUTER socket.
+
+An event thread waits on the DLL new-measurement events, reads the quantities of
+every fresh measurement once into the WM measurement cache, which then answers
+all measurement reads, and publishes every new frequency as a binary zmqPublisher
+record (channel, error, sequence number, time, frequency) on a PUB socket, so
+consumers can react to a new measurement without polling. With switch_shares the
+event thread also drives a switch_arbiter.SwitchArbiter that time-slices the
+fiber switch between the channels.
+
+wait_new_frequency and wait_new_snapshot requests are parked in the main thread
+until the event thread reports a newer reading or the request times out, so long
+polls from many clients do not occupy any worker. While the event thread is not
+running, e.g. after the DLL ended the event notification, they are answered by
+the workers at once from the DLL instead.
+"""
+import ctypes
+import inspect
+import queue
+import threading
+import time
+
+import numpy as np
+import zmq
+
+import wlmConst
+import wm_protocol
+from measurement_cache import frequency_reading, frequency_snapshot
+from switch_arbiter import SwitchArbiter
+from zmq_publisher import zmqPublisher
+
+
+# measurement reads that are safe to run concurrently with each other and with the DLL thread
+CONCURRENT_METHODS = {
+    "read_frequency",
+    "read_wavelength",
+    "read_laser_power",
+    "read_linewidth",
+    "read_temperature",
+    "_read_snapshot",
+    "get_update_interval",
+}
+
+# DLL event mode -> channel of the new-measurement events
+WAVELENGTH_EVENT_CHANNELS = {getattr(wlmConst, "cmiWavelength%i" % n): n for n in range(1, 18)}
+
+# how long WaitForWLMEventEx blocks before the event thread checks for shutdown
+EVENT_TIMEOUT_MS = 200
+
+# long-poll requests answered by the main thread when a new reading arrives
+PARKED_METHODS = {"wait_new_frequency", "wait_new_snapshot"}
+
+
+def remote_methods(cls):
+    """ Returns {method id: method name} for every method of cls that clients can call """
+    methods = {}
+    for name in dir(cls):
+        if getattr(getattr(cls, name), "remote_method", False):
+            method = wm_protocol.method_id(name)
+            if method in methods:
+                raise ValueError("Method id of %s collides with %s" % (name, methods[method]))
+            methods[method] = name
+    return methods
+
+
+def _split_envelope(frames):
+    """ Splits ROUTER frames into (routing envelope including the empty delimiter, message) """
+    for i, frame in enumerate(frames):
+        if len(frame.buffer) == 0:
+            return frames[:i + 1], frames[i + 1:]
+    return frames[:1], frames[1:]
+
+
+class WMServer:
+    def __init__(self, wm, port=9000, workers=4, event_port=9001, switch_shares=None, dwell=2):
+        """
+        wm: WM in server mode.
+        port: port of the request ROUTER socket.
+        workers: number of threads answering measurement reads.
+        event_port: port of the new-measurement PUB socket, None to disable publishing.
+        switch_shares: channel -> share of the switch measurements, None to leave the switch alone.
+        dwell: measurements per switch slot, see SwitchArbiter.
+        """
+        self.wm = wm
+        self.port = port
+        self.n_workers = workers
+        self.event_port = event_port
+        self.methods = remote_methods(type(wm))
+
+        self._context = zmq.Context.instance()
+        self._reply_address = "inproc://wm-replies-%i" % id(self)
+        self._event_address = "inproc://wm-events-%i" % id(self)
+        self._waiting = []  # parked long-poll requests
+        self._dll_queue = queue.Queue()
+        self._pool_queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+        if switch_shares is not None:
+            wm.arbiter = SwitchArbiter(wm.dll, switch_shares, dwell)
+
+    def _lane(self, method):
+        """ Returns the queue that executes a method """
+        if self.methods.get(method) in CONCURRENT_METHODS:
+            return self._pool_queue
+        return self._dll_queue
+
+    def _handle(self, message):
+        """ Executes one request and returns the reply frames """
+        try:
+            method, request_id, args, kwargs = wm_protocol.decode_request(message)
+        except wm_protocol.WMProtocolError as e:
+            method, request_id = wm_protocol.HEADER.unpack(message[0].buffer)[3:]
+            return wm_protocol.encode_error(method, request_id, e)
+        name = self.methods.get(method)
+        if name is None:
+            return wm_protocol.encode_error(method, request_id, "Unknown method id %i" % method)
+        try:
+            value = getattr(self.wm, name)(*args, **kwargs)
+            return wm_protocol.encode_reply(method, request_id, value)
+        except Exception as e:
+            return wm_protocol.encode_error(method, request_id, "%s: %s" % (type(e).__name__, e))
+
+    def _worker(self, requests):
+        replies = self._context.socket(zmq.PUSH)
+        replies.connect(self._reply_address)
+        try:
+            while True:
+                item = requests.get()
+                if item is None:
+                    break
+                envelope, message = item
+                replies.send_multipart(envelope + self._handle(message), copy=False)
+        finally:
+            replies.close(linger=0)
+
+    def _start_workers(self):
+        lanes = [self._dll_queue] + self.n_workers * [self._pool_queue]
+        for requests in lanes:
+            thread = threading.Thread(target=self._worker, args=(requests,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop_threads(self):
+        self._dll_queue.put(None)
+        for i in range(self.n_workers):
+            self._pool_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+        if self.event_port is not None:
+            self._publisher.close()
+
+    def _on_measurement(self, channel, timestamp):
+        reading = self.wm._read_dll(channel)
+        seq = self.wm.cache.update(channel, timestamp, reading)
+        if self.wm.arbiter is not None:
+            self.wm.arbiter.on_measurement(channel, reading["error"])
+        self._events.send(bytes([channel]))
+        if self.event_port is not None:
+            error = reading["error"] or 0
+            self._publisher.publish_record(channel, reading["frequency"] if not error else np.nan, error, seq)
+
+    def _event_loop(self):
+        """ Waits for new-measurement events of the DLL and publishes the new readings """
+        self._events = self._context.socket(zmq.PUSH)
+        self._events.connect(self._event_address)
+        dll = self.wm.dll
+        timeout = ctypes.cast(EVENT_TIMEOUT_MS, ctypes.POINTER(ctypes.c_long))
+        dll.Instantiate(wlmConst.cInstNotification, wlmConst.cNotifyInstallWaitEventEx, timeout, 0)
+        version = ctypes.c_long(0)
+        mode = ctypes.c_long(0)
+        timestamp = ctypes.c_long(0)
+        value = ctypes.c_double(0)
+        res1 = ctypes.c_long(0)
+        self.wm.cache.live = True
+        if self.wm.arbiter is not None:
+            self.wm.arbiter.start()
+        try:
+            while not self._stop.is_set():
+                ret = dll.WaitForWLMEventEx(
+                    ctypes.byref(version), ctypes.byref(mode), ctypes.byref(timestamp), ctypes.byref(value), ctypes.byref(res1)
+                )
+                if ret < 0:
+                    print("Wavemeter event notification ended (%i)" % ret)
+                    break
+                if self.wm.arbiter is not None:
+                    self.wm.arbiter.tick()
+                channel = WAVELENGTH_EVENT_CHANNELS.get(mode.value)
+                if ret == 0 or channel is None:
+                    continue
+                self._on_measurement(channel, timestamp.value)
+        finally:
+            self.wm.cache.live = False
+            if self.wm.arbiter is not None:
+                self.wm.arbiter.stop()
+            dll.Instantiate(wlmConst.cInstNotification, wlmConst.cNotifyRemoveWaitEvent, None, 0)
+            self._events.close(linger=0)
+
+    def _start_event_thread(self):
+        if self.event_port is not None:
+            self._publisher = zmqPublisher(port=self.event_port, topic="wavemeter")
+        thread = threading.Thread(target=self._event_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _newer_reply(self, name, args):
+        """ Returns a function giving the reply of a parked request once a newer reading exists, None until then """
+        cache = self.wm.cache
+        if name == "wait_new_frequency":
+            channel, last_seq = args
+
+            def reply():
+                reading = cache.newer(channel, last_seq)
+                return None if reading is None else frequency_reading(reading)
+        else:
+            channels, last_seqs = [int(channel) for channel in args[0]], list(args[1])
+            if len(channels) != len(last_seqs):
+                raise ValueError("One last_seq per channel is needed")
+
+            def reply():
+                readings = cache.newer_any(channels, last_seqs)
+                return None if readings is None else frequency_snapshot(readings)
+        return reply
+
+    def _park(self, frontend, envelope, message):
+        """ Answers a long-poll request now if a newer reading exists, otherwise parks it """
+        if not self.wm.cache.live:
+            self._pool_queue.put((envelope, message))  # no new readings will arrive in the cache
+            return
+        try:
+            method, request_id, args, kwargs = wm_protocol.decode_request(message)
+            wait = inspect.signature(getattr(self.wm, self.methods[method])).bind(*args, **kwargs)
+            wait.apply_defaults()
+            *args, timeout = wait.args
+            timeout = float(timeout)
+            newer_reply = self._newer_reply(self.methods[method], args)
+        except (wm_protocol.WMProtocolError, TypeError, ValueError):
+            frontend.send_multipart(envelope + self._handle(message), copy=False)
+            return
+        reply = newer_reply()
+        if reply is not None:
+            frontend.send_multipart(envelope + wm_protocol.encode_reply(method, request_id, reply), copy=False)
+        else:
+            deadline = time.monotonic() + timeout
+            self._waiting.append((deadline, newer_reply, envelope, message, method, request_id))
+
+    def _answer_waiting(self, frontend):
+        """ Replies to parked requests that have a newer reading or timed out, hands them to the workers if the cache stopped """
+        now = time.monotonic()
+        waiting = []
+        for item in self._waiting:
+            deadline, newer_reply, envelope, message, method, request_id = item
+            reply = newer_reply()
+            if reply is not None:
+                frontend.send_multipart(envelope + wm_protocol.encode_reply(method, request_id, reply), copy=False)
+            elif not self.wm.cache.live:
+                self._pool_queue.put((envelope, message))
+            elif now >= deadline:
+                frontend.send_multipart(envelope + wm_protocol.encode_reply(method, request_id, None), copy=False)
+            else:
+                waiting.append(item)
+        self._waiting = waiting
+
+    def _poll_timeout(self):
+        """ Returns the poll timeout in ms, short enough to expire parked requests on time """
+        if not self._waiting:
+            return 100
+        next_deadline = min(item[0] for item in self._waiting)
+        return max(0, min(100, 1e3 * (next_deadline - time.monotonic())))
+
+    def _dispatch(self, frontend, frames):
+        envelope, message = _split_envelope(frames)
+        try:
+            header = wm_protocol.HEADER.unpack(message[0].buffer)
+        except Exception:
+            reply = wm_protocol.encode_error(0, 0, "Malformed request header")
+            frontend.send_multipart(envelope + reply, copy=False)
+            return
+        if self.methods.get(header[3]) in PARKED_METHODS:
+            self._park(frontend, envelope, message)
+        else:
+            self._lane(header[3]).put((envelope, message))
+
+    def serve_forever(self):
+        """ Serve requests until stop() is called or the process is interrupted """
+        frontend = self._context.socket(zmq.ROUTER)
+        frontend.bind("tcp://*:%s" % self.port)
+        replies = self._context.socket(zmq.PULL)
+        replies.bind(self._reply_address)
+        events = self._context.socket(zmq.PULL)
+        events.bind(self._event_address)
+        self._start_workers()
+        self._start_event_thread()
+        print("Serving wavemeter requests on port %s" % self.port)
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+        poller.register(events, zmq.POLLIN)
+        try:
+            while not self._stop.is_set():
+                ready = dict(poller.poll(self._poll_timeout()))
+                if events in ready:
+                    while True:
+                        try:
+                            events.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                if self._waiting:
+                    self._answer_waiting(frontend)
+                if replies in ready:
+                    while True:
+                        try:
+                            frontend.send_multipart(replies.recv_multipart(zmq.NOBLOCK, copy=False), copy=False)
+                        except zmq.Again:
+                            break
+                if frontend in ready:
+                    while True:
+                        try:
+                            self._dispatch(frontend, frontend.recv_multipart(zmq.NOBLOCK, copy=False))
+                        except zmq.Again:
+                            break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            self._stop_threads()
+            frontend.close(linger=0)
+            replies.close(linger=0)
+            events.close(linger=0)
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,434 @@
+"""
+Simulated HighFinesse wavemeter, for testing and benchmarking without the hardware.
+
+SimulatedDLL implements the wlmData functions used by WM in server mode and by
+WMServer, backed by one LaserModel per switch channel. Pass it to WM and serve it
+like the real wavemeter, so clients use exactly the same protocol:
+
+    wm = WM(mode='server', dll=SimulatedDLL({3: LaserModel(710962.7)}))
+    WMServer(wm).serve_forever()
+
+or run this file to start a simulated server on the usual ports, and connect with
+WM(host="localhost").
+
+The switch measures the channels in turn at a fixed measurement rate. Each laser
+has drift, white and 1/f frequency noise, piezo and current tuning, mode hops, and
+returns under/over-exposure errors when its signal leaves the usable range.
+Network latency can be added with a delaying proxy in front of the server.
+"""
+import ctypes
+import heapq
+import queue
+import threading
+import time
+
+import numpy as np
+import zmq
+
+import wlmConst
+
+
+SPEED_OF_LIGHT = 299792458  # m/s, so wavelength in nm = SPEED_OF_LIGHT / frequency in GHz
+
+# number of points of the simulated interferogram
+PATTERN_ITEM_COUNT = 1024
+
+
+class LaserModel:
+    """Frequency model of one ECDL seen by the wavemeter.
+
+    The frequency is
+        frequency_GHz + drift + noise + piezo_GHz_per_V * piezo_V + current_GHz_per_mA * current_mA
+        - mode * mode_hop_GHz
+    where mode is the number of mode hops away from the starting mode. The laser hops when
+    the mode mismatch piezo_V + mode_hop_V_per_mA * current_mA moves more than half of
+    mode_hop_span_V away from the center of the current mode. A current bias slope of
+    -1 / mode_hop_V_per_mA mA/V cancels the mismatch of piezo tuning.
+    """
+
+    def __init__(
+        self,
+        frequency_GHz: float,
+        drift_GHz_per_s: float = 0,
+        white_noise_GHz: float = 0.002,
+        flicker_noise_GHz: float = 0.01,
+        piezo_GHz_per_V: float = 0.6,
+        current_GHz_per_mA: float = -0.4,
+        mode_hop_span_V: float = 6,
+        mode_hop_V_per_mA: float = 5,
+        mode_hop_GHz: float = 4.5,
+        power_uW: float = 10,
+        min_signal: float = 20,
+        max_signal: float = 2000,
+        linewidth_GHz: float = 0.001,
+        seed: int = None,
+    ):
+        """
+        Args:
+            frequency_GHz: frequency at zero piezo and current offsets.
+            drift_GHz_per_s: linear frequency drift.
+            white_noise_GHz: rms of the white frequency noise of each measurement.
+            flicker_noise_GHz: rms of the 1/f frequency noise, between 0.1 s and 1000 s.
+            piezo_GHz_per_V, current_GHz_per_mA: tuning coefficients.
+            mode_hop_span_V, mode_hop_V_per_mA, mode_hop_GHz: mode hop model, see the class docstring.
+            power_uW: power at the wavemeter.
+            min_signal, max_signal: usable range of power_uW * exposure_ms. Outside of it the
+                wavemeter returns ErrLowSignal / ErrBigSignal.
+            seed: random seed of the noise.
+        """
+        self.frequency_GHz = frequency_GHz
+        self.drift_GHz_per_s = drift_GHz_per_s
+        self.white_noise_GHz = white_noise_GHz
+        self.flicker_noise_GHz = flicker_noise_GHz
+        self.piezo_GHz_per_V = piezo_GHz_per_V
+        self.current_GHz_per_mA = current_GHz_per_mA
+        self.mode_hop_span_V = mode_hop_span_V
+        self.mode_hop_V_per_mA = mode_hop_V_per_mA
+        self.mode_hop_GHz = mode_hop_GHz
+        self.power_uW = power_uW
+        self.min_signal = min_signal
+        self.max_signal = max_signal
+        self.linewidth_GHz = linewidth_GHz
+
+        self.piezo_V = 0.0  # offsets from the operating point, set by the simulated actuators
+        self.current_mA = 0.0
+        self.mode = 0
+
+        self._rng = np.random.default_rng(seed)
+        # 1/f noise as a sum of equal-variance AR(1) processes with log-spaced time constants
+        self._flicker_taus = np.logspace(-1, 3, 5)
+        self._flicker = self._rng.normal(0, 1, len(self._flicker_taus)) * self._flicker_sigma()
+        self._time = None
+
+    def _flicker_sigma(self):
+        return self.flicker_noise_GHz / np.sqrt(len(self._flicker_taus))
+
+    def _update_mode(self):
+        mismatch = self.piezo_V + self.mode_hop_V_per_mA * self.current_mA
+        if abs(mismatch - self.mode * self.mode_hop_span_V) > self.mode_hop_span_V / 2:
+            self.mode = int(np.round(mismatch / self.mode_hop_span_V))
+
+    def signal(self, exposure_ms: float) -> float:
+        return self.power_uW * exposure_ms
+
+    def measure(self, t: float, exposure_ms: float) -> float:
+        """Returns the frequency in GHz measured at time t (s), or a negative wavemeter error code."""
+        if self._time is not None:
+            decay = np.exp(-max(t - self._time, 0) / self._flicker_taus)
+            self._flicker = self._flicker * decay + self._rng.normal(0, 1, len(decay)) * self._flicker_sigma() * np.sqrt(1 - decay**2)
+        self._time = t
+        signal = self.signal(exposure_ms)
+        if signal < self.min_signal:
+            return wlmConst.ErrLowSignal
+        if signal > self.max_signal:
+            return wlmConst.ErrBigSignal
+        self._update_mode()
+        return (
+            self.frequency_GHz
+            + self.drift_GHz_per_s * t
+            + self.piezo_GHz_per_V * self.piezo_V
+            + self.current_GHz_per_mA * self.current_mA
+            - self.mode * self.mode_hop_GHz
+            + self._flicker.sum()
+            + self._rng.normal(0, self.white_noise_GHz)
+        )
+
+
+def _value(x):
+    """ ctypes or python number to python number """
+    return getattr(x, "value", x)
+
+
+def _address(pointer):
+    """ Address of a ctypes pointer, c_char_p or integer address """
+    if isinstance(pointer, int):
+        return pointer
+    return ctypes.cast(pointer, ctypes.c_void_p).value
+
+
+def _set_pointer(pointer, value):
+    """ Writes value through a byref() or pointer() argument """
+    if hasattr(pointer, "contents"):
+        pointer.contents.value = value
+    else:
+        pointer._obj.value = value
+
+
+class SimulatedDLL:
+    """Stand-in for the wlmData DLL with a simulated multi-channel switch."""
+
+    def __init__(self, lasers: dict, measurement_rate: float = 20, exposure_ms: float = 10, switch_time_ms: float = 10):
+        """
+        Args:
+            lasers: switch channel -> LaserModel.
+            measurement_rate: measurements per second, shared by all channels in use.
+            exposure_ms: initial exposure of every channel.
+            switch_time_ms: settling time of the fiber switch when it changes channel.
+        """
+        self.lasers = lasers
+        self.measurement_rate = measurement_rate
+        self.switch_time_ms = switch_time_ms
+        self._lock = threading.Lock()
+        self._readings = {}  # channel -> (frequency in THz or error code, timestamp in ms)
+        self._exposure = {channel: exposure_ms for channel in lasers}
+        self._auto_exposure = {channel: False for channel in lasers}
+        self._use = {channel: True for channel in lasers}
+        self._events = None
+        self._pid_course = {}
+        self._pid_settings = {}
+        self._t0 = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._measure_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def _now(self):
+        return time.monotonic() - self._t0
+
+    def _measure_loop(self):
+        """ The switch: measures one channel in use per measurement period """
+        next_time = time.monotonic()
+        index = 0
+        last_channel = None
+        while not self._stop.is_set():
+            next_time += 1 / self.measurement_rate
+            self._stop.wait(max(0, next_time - time.monotonic()))
+            channels = [channel for channel in sorted(self.lasers) if self._use[channel]]
+            if not channels:
+                continue
+            channel = channels[index % len(channels)]
+            index += 1
+            if channel != last_channel:
+                next_time += 1e-3 * self.switch_time_ms
+                self._stop.wait(1e-3 * self.switch_time_ms)
+                last_channel = channel
+            self._measure(channel)
+
+    def _measure(self, channel):
+        laser = self.lasers[channel]
+        t = self._now()
+        with self._lock:
+            exposure = self._exposure[channel]
+            frequency_GHz = laser.measure(t, exposure)
+            if self._auto_exposure[channel]:
+                # aim for the geometric center of the usable signal range
+                target = np.sqrt(laser.min_signal * laser.max_signal)
+                self._exposure[channel] = float(np.clip(exposure * (target / laser.signal(exposure)) ** 0.5, 1, 9999))
+            timestamp = int(1e3 * t)
+            value = frequency_GHz * 1e-3 if frequency_GHz > 0 else float(frequency_GHz)
+            self._readings[channel] = (value, timestamp)
+        if self._events is not None:
+            wavelength = SPEED_OF_LIGHT / frequency_GHz if frequency_GHz > 0 else float(frequency_GHz)
+            mode = getattr(wlmConst, "cmiWavelength%i" % channel)
+            try:
+                self._events.put_nowait((mode, timestamp, wavelength, channel))
+            except queue.Full:
+                pass
+
+    def _reading(self, channel):
+        return self._readings.get(_value(channel), (wlmConst.ErrNoValue, 0))[0]
+
+    # measurement results
+    def GetFrequencyNum(self, channel, f):
+        return self._reading(channel)
+
+    def GetWavelengthNum(self, channel, wl):
+        frequency_THz = self._reading(channel)
+        return SPEED_OF_LIGHT * 1e-3 / frequency_THz if frequency_THz > 0 else frequency_THz
+
+    def GetPowerNum(self, channel, p):
+        laser = self.lasers.get(_value(channel))
+        return 0.0 if laser is None else float(laser.power_uW)
+
+    def GetLinewidthNum(self, channel, lw):
+        laser = self.lasers.get(_value(channel))
+        return 0.0 if laser is None else float(laser.linewidth_GHz)
+
+    def GetTemperature(self, t):
+        return 25.0
+
+    # exposure
+    def GetExposureNum(self, channel, arr, e):
+        return int(self._exposure.get(_value(channel), 0))
+
+    def SetExposureNum(self, channel, arr, e):
+        with self._lock:
+            self._exposure[_value(channel)] = _value(e)
+        return wlmConst.ResERR_NoErr
+
+    def GetExposureModeNum(self, channel, em):
+        return int(self._auto_exposure.get(_value(channel), False))
+
+    def SetExposureModeNum(self, channel, em):
+        with self._lock:
+            self._auto_exposure[_value(channel)] = bool(_value(em))
+        return wlmConst.ResERR_NoErr
+
+    # switch
+    def GetSwitcherSignalStates(self, signal, use, show):
+        _set_pointer(use, int(self._use.get(_value(signal), False)))
+        _set_pointer(show, int(self._use.get(_value(signal), False)))
+        return wlmConst.ResERR_NoErr
+
+    def SetSwitcherSignalStates(self, signal, use, show):
+        if _value(signal) not in self.lasers:
+            return wlmConst.ResERR_ChannelNotAvailable
+        self._use[_value(signal)] = bool(_value(use))
+        return wlmConst.ResERR_NoErr
+
+    # new measurement events
+    def Instantiate(self, rfc, mode, p1, p2):
+        if _value(rfc) == wlmConst.cInstNotification:
+            if _value(mode) in (wlmConst.cNotifyInstallWaitEvent, wlmConst.cNotifyInstallWaitEventEx):
+                self._event_timeout = 1e-3 * (_address(p1) or 0)
+                self._events = queue.Queue(maxsize=1000)
+            elif _value(mode) == wlmConst.cNotifyRemoveWaitEvent:
+                self._events = None
+        return None
+
+    def WaitForWLMEventEx(self, ver, mode, int_val, dbl_val, res1):
+        events = self._events
+        if events is None:
+            return -1
+        try:
+            event_mode, timestamp, wavelength, channel = events.get(timeout=self._event_timeout or None)
+        except queue.Empty:
+            return 0
+        _set_pointer(ver, 0)
+        _set_pointer(mode, event_mode)
+        _set_pointer(int_val, timestamp)
+        _set_pointer(dbl_val, wavelength)
+        _set_pointer(res1, channel)
+        return 1
+
+    # interferograms
+    def SetPattern(self, index, enable):
+        return wlmConst.ResERR_NoErr
+
+    def GetPatternItemCount(self, index):
+        return PATTERN_ITEM_COUNT
+
+    def GetPatternNum(self, channel, index):
+        return 1
+
+    def GetPatternDataNum(self, channel, index, array):
+        """ Writes a fringe pattern of the channel into array, a buffer of c_ulong """
+        laser = self.lasers.get(_value(channel))
+        x = np.arange(PATTERN_ITEM_COUNT)
+        if laser is None:
+            pattern = np.zeros(PATTERN_ITEM_COUNT)
+        else:
+            signal = min(laser.signal(self._exposure[_value(channel)]), laser.max_signal)
+            period = 2e-5 * (SPEED_OF_LIGHT / laser.frequency_GHz) ** 1.5
+            envelope = np.exp(-(((x - PATTERN_ITEM_COUNT / 2) / (PATTERN_ITEM_COUNT / 4)) ** 2))
+            pattern = 1000 * signal / laser.max_signal * envelope * (1 + np.cos(2 * np.pi * x / period))
+        pattern = pattern.astype(np.dtype(ctypes.c_ulong))
+        ctypes.memmove(_address(array), pattern.ctypes.data, pattern.nbytes)
+        return wlmConst.ResERR_NoErr
+
+    # PID regulation of the wavemeter, only stored
+    def GetPIDCourseNum(self, channel, info):
+        course = self._pid_course.get(_value(channel), "0").encode() + b"\0"
+        ctypes.memmove(_address(info), course, len(course))
+        return wlmConst.ResERR_NoErr
+
+    def SetPIDCourseNum(self, channel, info):
+        self._pid_course[_value(channel)] = info.value.decode()
+        return wlmConst.ResERR_NoErr
+
+    def GetPIDSetting(self, const, channel, lref, dref):
+        setting = self._pid_settings.get((_value(const), _value(channel)), 0)
+        if wlmConst.pid_datatypes[_value(const)] == "double":
+            _set_pointer(dref, float(setting))
+        else:
+            _set_pointer(lref, int(setting))
+        return wlmConst.ResERR_NoErr
+
+    def SetPIDSetting(self, const, channel, lval, dval):
+        dtype = wlmConst.pid_datatypes[_value(const)]
+        self._pid_settings[(_value(const), _value(channel))] = _value(dval) if dtype == "double" else _value(lval)
+        return wlmConst.ResERR_NoErr
+
+    def ClearPIDHistory(self, channel):
+        return 1
+
+    def GetDeviationSignalNum(self, channel, v):
+        return 0.0
+
+
+class LatencyProxy:
+    """Forwards requests from a public port to a server, delaying each direction by latency / 2."""
+
+    def __init__(self, port, backend_address, latency):
+        self.port = port
+        self.backend_address = backend_address
+        self.latency = latency
+        self._stop = threading.Event()
+
+    def run(self):
+        context = zmq.Context.instance()
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind("tcp://*:%s" % self.port)
+        backend = context.socket(zmq.DEALER)
+        backend.connect(self.backend_address)
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        delayed = []  # heap of (release time, order, destination, frames)
+        order = 0
+        try:
+            while not self._stop.is_set():
+                timeout = 100 if not delayed else max(0, 1e3 * (delayed[0][0] - time.monotonic()))
+                ready = dict(poller.poll(timeout))
+                for source, destination in ((frontend, backend), (backend, frontend)):
+                    if source in ready:
+                        frames = source.recv_multipart()
+                        heapq.heappush(delayed, (time.monotonic() + self.latency / 2, order, destination, frames))
+                        order += 1
+                while delayed and delayed[0][0] <= time.monotonic():
+                    release, i, destination, frames = heapq.heappop(delayed)
+                    destination.send_multipart(frames)
+        finally:
+            frontend.close(linger=0)
+            backend.close(linger=0)
+
+    def stop(self):
+        self._stop.set()
+
+
+def serve_simulated_wavemeter(lasers, port=9000, event_port=9001, measurement_rate=20, latency=0, switch_shares=None):
+    """
+    Runs a wavemeter server backed by SimulatedDLL until interrupted.
+
+    latency: simulated network round trip time in s. If not zero, the server listens on
+        port + 1000 and a LatencyProxy forwards requests from port.
+    switch_shares: time-slice the switch with these shares, see WMServer.
+    """
+    from wavemeter import WM
+    from wm_server import WMServer
+
+    dll = SimulatedDLL(lasers, measurement_rate)
+    wm = WM(mode="server", dll=dll)
+    if latency > 0:
+        server = WMServer(wm, port=port + 1000, event_port=event_port, switch_shares=switch_shares)
+        proxy = LatencyProxy(port, "tcp://127.0.0.1:%s" % (port + 1000), latency)
+        threading.Thread(target=proxy.run, daemon=True).start()
+    else:
+        server = WMServer(wm, port=port, event_port=event_port, switch_shares=switch_shares)
+    try:
+        server.serve_forever()
+    finally:
+        dll.close()
+
+
+if __name__ == "__main__":
+    lasers = {
+        3: LaserModel(710962.7, drift_GHz_per_s=1e-4, seed=3),  # 422 nm
+        4: LaserModel(394721.2, seed=4),
+        5: LaserModel(384230.4, flicker_noise_GHz=0.02, seed=5),
+        7: LaserModel(446799.9, power_uW=1, seed=7),  # underexposed at the default exposure
+        8: LaserModel(325250.0, seed=8),
+    }
+    serve_simulated_wavemeter(lasers)
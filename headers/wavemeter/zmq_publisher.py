@@ -1,23 +1,61 @@
+import struct
+
 import zmq
 import numpy as np
 import time
 
+# channel, wavemeter error code (0 if valid), sequence number (0 if unknown), unix timestamp, value (nan if error)
+RECORD = struct.Struct("<HhIdd")
+
+
+def channel_topic(topic, channel):
+    """Topic frame of the records of one channel. Subscribe to topic + '/' for all channels."""
+    return ("%s/%i/" % (topic, channel)).encode()
+
+
 class zmqPublisher:
-    """Publishes a python dictionary on a port with a given topic."""
+    """Publishes wavemeter readings on a port with a given topic.
 
-    def __init__(self, port=5550, topic='test'):
+    Each reading is a two-frame message [topic frame, RECORD], with one topic per channel,
+    so subscribers can subscribe to only the channels they need. At most sndhwm messages
+    are queued per subscriber; further samples are dropped for a slow subscriber instead
+    of growing an unbounded queue.
+    """
+
+    def __init__(self, port=5550, topic='test', sndhwm=100):
         zmq_context = zmq.Context()
         self.topic = topic
         self.pub_socket = zmq_context.socket(zmq.PUB)
         self.pub_socket.setsockopt(zmq.LINGER, 100) #100 ms after the socket is closed it will clear the buffer
+        self.pub_socket.setsockopt(zmq.SNDHWM, sndhwm)
         self.pub_socket.bind("tcp://*:%s" % port)
+        self._topics = {}
         print('Broadcasting on port {0} with topic {1}'.format(port,topic))
 
 
     def close(self):
         self.pub_socket.close()
 
+    def publish_record(self, channel, value, error=0, seq=0, timestamp=None):
+        """Publishes one reading of channel. value is ignored (sent as nan) if error is not 0."""
+        if timestamp is None:
+            timestamp = time.time()
+        topic = self._topics.get(channel)
+        if topic is None:
+            topic = self._topics[channel] = channel_topic(self.topic, channel)
+        if error:
+            value = np.nan
+        self.pub_socket.send_multipart([topic, RECORD.pack(channel, error, seq, timestamp, value)], flags=zmq.NOBLOCK)
+
+    def publish_records(self, records, timestamp=None):
+        """Publishes (channel, value, error, seq) readings with one shared timestamp."""
+        if timestamp is None:
+            timestamp = time.time()
+        for channel, value, error, seq in records:
+            self.publish_record(channel, value, error, seq, timestamp)
+
     def publish_data(self,data,prnt=False):
+        """Publishes data as a "topic, timestamp, data" string (legacy text format)."""
         try:
             timestamp = time.time()
             data = str(data).strip('(').strip(')')
@@ -34,11 +72,10 @@ class zmqPublisher:
             try:
                 newval1 = np.random.rand()
                 newval2 = np.random.rand()
-                data = (newval1,newval2)
-                self.publish_data(data)
+                self.publish_records([(1, newval1, 0, 0), (2, newval2, 0, 0)])
             except KeyboardInterrupt:
                 break
             time.sleep(1)
 
 #publisher = zmq_pub_dict()
-#publisher.test_stream()
\ No newline at end of file
+#publisher.test_stream()
@@ -0,0 +1,105 @@
+import threading
+
+import numpy as np
+import zmq
+
+from zmq_publisher import RECORD, channel_topic
+
+# one reading in the ring buffers of zmqSubscriber
+READING_DTYPE = np.dtype([("timestamp", "f8"), ("value", "f8"), ("error", "i2"), ("seq", "u4")])
+
+
+class zmqSubscriber:
+    """Receives zmqPublisher records on a background thread.
+
+    For every channel it keeps the latest reading, a ring buffer of the last `history`
+    readings, and lets callers block until the next reading arrives. Reading the
+    latest value or the history never takes a lock, so readers do not slow down
+    the receive thread. Readings are (timestamp, value, error, seq) tuples, see
+    zmq_publisher.RECORD.
+
+        subscriber = zmqSubscriber(channels=[3, 5])
+        timestamp, frequency, error, seq = subscriber.wait_next(3)
+    """
+
+    def __init__(self, port=9001, host="192.168.0.103", topic="wavemeter", channels=None, history=1000, rcvhwm=100):
+        """
+        port, host: address of the publisher, by default the wavemeter server event stream.
+        channels: channels to subscribe to, None for all.
+        history: number of readings kept per channel.
+        rcvhwm: receive queue length; older samples are dropped if the thread falls behind.
+        """
+        self.history_length = history
+        self._socket = zmq.Context.instance().socket(zmq.SUB)
+        self._socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self._socket.connect("tcp://%s:%s" % (host, port))
+        if channels is None:
+            self._socket.subscribe(("%s/" % topic).encode())
+        else:
+            for channel in channels:
+                self._socket.subscribe(channel_topic(topic, channel))
+
+        self._latest = {}  # channel -> reading tuple, replaced on every reading
+        self._rings = {}  # channel -> READING_DTYPE array of length history
+        self._counts = {}  # channel -> total number of readings written to the ring
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+        self._socket.close(linger=0)
+
+    def _receive_loop(self):
+        while not self._stop.is_set():
+            if not self._socket.poll(100):
+                continue
+            frames = self._socket.recv_multipart()
+            if len(frames) != 2 or len(frames[1]) != RECORD.size:
+                continue
+            channel, error, seq, timestamp, value = RECORD.unpack(frames[1])
+            self._store(channel, (timestamp, value, error, seq))
+
+    def _store(self, channel, reading):
+        ring = self._rings.get(channel)
+        if ring is None:
+            ring = self._rings[channel] = np.zeros(self.history_length, dtype=READING_DTYPE)
+            self._counts[channel] = 0
+        count = self._counts[channel]
+        ring[count % self.history_length] = reading
+        self._counts[channel] = count + 1
+        self._latest[channel] = reading
+        with self._condition:
+            self._condition.notify_all()
+
+    @property
+    def channels(self):
+        return sorted(self._latest)
+
+    def latest(self, channel):
+        """Returns the latest (timestamp, value, error, seq) of channel, None before the first reading."""
+        return self._latest.get(channel)
+
+    def history(self, channel):
+        """Returns the buffered readings of channel as a READING_DTYPE array, oldest first."""
+        ring = self._rings.get(channel)
+        if ring is None:
+            return np.zeros(0, dtype=READING_DTYPE)
+        count = self._counts[channel]
+        n = min(count, self.history_length)
+        start = count % self.history_length
+        readings = np.concatenate([ring[start:], ring[:start]])[self.history_length - n:]
+        # readings overwritten while copying may be torn, drop them. New readings first fill the
+        # history_length - n free slots, the oldest copied readings are overwritten after that.
+        overwritten = max(0, self._counts[channel] - count - (self.history_length - n))
+        return readings[min(overwritten, len(readings)):]
+
+    def wait_next(self, channel, timeout=None):
+        """Blocks until the next reading of channel arrives and returns it, None on timeout."""
+        with self._condition:
+            count = self._counts.get(channel, 0)
+            if self._condition.wait_for(lambda: self._counts.get(channel, 0) > count, timeout):
+                return self._latest[channel]
+        return None
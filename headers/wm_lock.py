@@ -5,7 +5,22 @@ from typing import Literal
 from heros import LocalHERO, event, RemoteHERO
 import numpy as np
 
-from wavemeter.wavemeter import WM
+from wavemeter.wavemeter import WM, WMError
+from tuning_map import TuningMap
+import controllers
+import flight_recorder
+from flight_recorder import FlightRecorder
+from lock_metrics import LockMetrics, MetricsServer, ReadingAge
+import wlmConst
+
+
+WM_WAIT_TIMEOUT = 0.5  # s, shortest wait for a new wavemeter reading before checking for shutdown
+WM_STALL_WAITS = 5  # waits in a row without a new reading before the lock polls read_frequency instead
+WM_STALL_POLL_TIME = 10  # s of polling read_frequency before the lock waits for new readings again
+WM_POLL_INTERVAL = 0.01  # s between read_frequency polls
+WM_ERROR_PRINT_INTERVAL = 10  # s, shortest time between two printed wavemeter errors
+TUNING_MAP_SAVE_INTERVAL = 60  # s
+WM_ERROR_CODES = {name: code for code, name in wlmConst.meas_errors.items()}  # error string of a reading -> code
 
 
 class WMLockConfig:
@@ -22,6 +37,8 @@ class WMLockConfig:
         max_tuning_range_mA: float,
         attenuation_factor: float = 1,
         bias_slope_mA_per_V: float = 0,
+        hero: str = "ecdl_current_control",
+        resolution_V: float = 0,
     ):
         """
         Args:
@@ -33,6 +50,8 @@ class WMLockConfig:
                 For example, if a 10:1 voltage divider is used, this factor should be set to 10.
                 Default 1 (no attenuation).
             bias_slope_mA_per_V: current bias given piezo voltage applied.
+            hero: name of the ECDLCurrentControl HERO.
+            resolution_V: function generator output changes up to this are not sent, see add_piezo_config.
         """
         self._config["current"] = {
             "channel": channel,
@@ -40,18 +59,134 @@ class WMLockConfig:
             "max_tuning_range_mA": max_tuning_range_mA,
             "attenuation_factor": attenuation_factor,
             "bias_slope_mA_per_V": bias_slope_mA_per_V,
+            "hero": hero,
+            "resolution_V": resolution_V,
         }
 
-    def add_piezo_config(self, axis: Literal["x", "y", "z"], min_voltage: float = 0, max_voltage: float = 150):
-        self._config["piezo"] = {"axis": axis, "min_voltage": min_voltage, "max_voltage": max_voltage}
+    def add_piezo_config(
+        self,
+        axis: Literal["x", "y", "z"],
+        min_voltage: float = 0,
+        max_voltage: float = 150,
+        hero: str = "piezo_control",
+        resolution_V: float = 0,
+    ):
+        """
+        Args:
+            hero: name of the PiezoControl HERO. Locks on different axes can share one.
+            resolution_V: output changes up to this are not sent to the controller. The change is
+                taken from the last voltage sent, so small changes add up until they are sent, and the
+                lock reports the last voltage sent as its output. Unchanged outputs are never sent again.
+        """
+        self._config["piezo"] = {
+            "axis": axis,
+            "min_voltage": min_voltage,
+            "max_voltage": max_voltage,
+            "hero": hero,
+            "resolution_V": resolution_V,
+        }
 
-    def add_feedback_config(self, p_gain: float, i_time: float, max_integral_time_step: float = 1):
+    def add_feedback_config(
+        self,
+        p_gain: float,
+        i_time: float,
+        max_integral_time_step: float = 1,
+        controller: Literal["pi", "pid", "setpoint_weighted_pi", "lead_lag"] = "pi",
+        controller_params: dict = None,
+    ):
         """
         Args:
             p_gain: unit is V / GHz. Conversion from frequency offset to piezo voltage change.
             i_time: integral term time constant in s.
+            controller: feedback controller, see controllers.py.
+            controller_params: extra parameters of the controller:
+                "pid": d_time (s), d_filter_time (s, low-pass filter of the derivative).
+                "setpoint_weighted_pi": setpoint_weight (0 to 1, share of a setpoint change seen by the
+                    proportional term).
+                "lead_lag": lead_time, lag_time (s) of the filter on the proportional term.
+        """
+        controller_params = {} if controller_params is None else controller_params
+        controllers.check_params(controller, controller_params)
+        self._config["feedback"] = {
+            "p_gain": p_gain,
+            "i_time": i_time,
+            "max_integral_time_step": max_integral_time_step,
+            "controller": controller,
+            "controller_params": controller_params,
+        }
+
+    def add_feedforward_config(
+        self,
+        tuning_GHz_per_V: float = None,
+        learn: bool = True,
+        settle_threshold_GHz: float = 0.01,
+        settle_time: float = 1,
+    ):
+        """Optional. Setpoint changes while locked step the outputs by the expected piezo change at once.
+
+        Without it, the tuning coefficient is learned from the setpoint changes that settled.
+
+        Args:
+            tuning_GHz_per_V: frequency change per volt of piezo, with the current following at the bias slope.
+                None to learn it from the first setpoint change, which then has no feedforward.
+            learn: update the tuning coefficient after every setpoint change that settled without a relock.
+            settle_threshold_GHz, settle_time: the lock has settled at a new setpoint once the error
+                stays below settle_threshold_GHz for settle_time s.
+        """
+        self._config["feedforward"] = {
+            "tuning_GHz_per_V": tuning_GHz_per_V,
+            "learn": learn,
+            "settle_threshold_GHz": settle_threshold_GHz,
+            "settle_time": settle_time,
+        }
+
+    def add_relock_config(
+        self,
+        tuning_map_path: str = None,
+        sample_interval: float = 1,
+        piezo_step_V: float = 0.5,
+        current_step_mA: float = 0.05,
+        start_at_operating_point: bool = False,
+    ):
+        """Optional. Relocks starting at the points predicted by a TuningMap learned while locked.
+
+        Without it, a relock steps through a fixed grid of current and piezo offsets.
+
+        Args:
+            tuning_map_path: .npz file that keeps the tuning map across restarts, None to only keep it in memory.
+                Use one file per laser.
+            sample_interval: time in s between samples of the operating point while locked.
+            piezo_step_V, current_step_mA: grid steps of the search around the predicted point.
+            start_at_operating_point: when the lock is switched on away from the setpoint, and when the
+                setpoint changes by more than the mode hop free range while locked, move the piezo and
+                current to the operating point recorded for the setpoint. The outputs are never moved
+                while the lock is off.
+        """
+        self._config["relock"] = {
+            "tuning_map_path": tuning_map_path,
+            "sample_interval": sample_interval,
+            "piezo_step_V": piezo_step_V,
+            "current_step_mA": current_step_mA,
+            "start_at_operating_point": start_at_operating_point,
+        }
+
+    def add_flight_recorder_config(self, path: str, capacity: int = 1000000):
+        """Optional. Records every feedback iteration to a ring file, see flight_recorder.py.
+
+        Args:
+            path: ring file, continued across restarts. Use one file per lock.
+            capacity: number of iterations kept, 88 bytes each. The default keeps about 14 hours at 20 readings per s.
+        """
+        self._config["flight_recorder"] = {"path": path, "capacity": capacity}
+
+    def add_metrics_config(self, http_port: int = None, window_size: int = 1000):
+        """Optional. The lock always times its wavemeter reads and device writes, see get_metrics.
+
+        Args:
+            http_port: serve the metrics as text at http://<host>:<http_port>/metrics, None for no endpoint.
+            window_size: number of latest calls of each stage used for the latency quantiles.
         """
-        self._config["feedback"] = {"p_gain": p_gain, "i_time": i_time, "max_integral_time_step": max_integral_time_step}
+        self._config["metrics"] = {"http_port": http_port, "window_size": window_size}
 
     @property
     def data(self):
@@ -66,23 +201,62 @@ class WMLock(LocalHERO):
     It does not use the build-in PID of the HighFinesse wavemeter.
     """
 
-    def __init__(self, config: WMLockConfig, name: str):
-        self.wm = WM()
+    def __init__(
+        self,
+        config: WMLockConfig,
+        name: str,
+        wm: WM = None,
+        frequency_source=None,
+        devices: dict = None,
+        clock=None,
+    ):
+        """
+        Args:
+            config: lock configuration.
+            name: HERO name of the lock.
+            wm: wavemeter client, a new WM by default.
+            frequency_source: delivers the wavemeter readings with the signature of
+                WM.wait_new_frequency, e.g. a shared wm_lock_manager.BatchedFrequencyReader.
+                Default wm.
+            devices: HERO name -> entered RemoteHERO of devices shared with other locks,
+                which the lock does not close. Shared devices are called from several
+                threads, see wm_lock_manager.SerializedDevice. By default the lock connects
+                to its own.
+            clock: function returning the time in s used by the feedback, time.time by default.
+        """
+        self._init_lock(config, wm, frequency_source, devices, clock)
+        LocalHERO.__init__(self, name)
+        print(f"{name} server is running now...")
+
+    def _init_lock(self, config: WMLockConfig, wm: WM, frequency_source, devices: dict, clock):
+        """Everything of __init__ but the HERO, so that lock_simulator can run the lock offline."""
+        self._own_wm = wm is None
+        self.wm = WM() if wm is None else wm
+        self.frequency_source = self.wm if frequency_source is None else frequency_source
+        self._devices = devices
+        self._time = time.time if clock is None else clock
         self.config = config.data
         self._t1 = None
         self._stop = threading.Event()
         self._t2 = None
-        LocalHERO.__init__(self, name)
-        print(f"{name} server is running now...")
+        self.tuning_map = None
+        self.flight_recorder = None
+        self.metrics = None
+        self._metrics_server = None
 
     def __enter__(self):
         super().__enter__()
-        self.current = RemoteHERO("ecdl_current_control").__enter__()
-        self.piezo = RemoteHERO("piezo_control").__enter__()
-        self._setup_wm()
-        self._setup_piezo_controller()
-        self._setup_current_controller()
-        self._setup_feedback_params()
+        if self._devices is None:
+            self.current = RemoteHERO(self.config["current"]["hero"]).__enter__()
+            self.piezo = RemoteHERO(self.config["piezo"]["hero"]).__enter__()
+        else:
+            self.current = self._devices[self.config["current"]["hero"]]
+            self.piezo = self._devices[self.config["piezo"]["hero"]]
+        self._setup()
+        http_port = self.config.get("metrics", {}).get("http_port")
+        if http_port is not None:
+            self._metrics_server = MetricsServer({self._name: self.metrics}, http_port)
+            self._metrics_server.start()
         self._t1 = threading.Thread(target=self._feedback_loop, daemon=True)
         self._t1.start()
         self._t2 = threading.Thread(target=self._update_loop, daemon=True)
@@ -96,12 +270,31 @@ class WMLock(LocalHERO):
                 self._t1.join(timeout=2)
             if self._t2 is not None:
                 self._t2.join(timeout=2)
-            self.current.__exit__(exc_type, exc, tb)
-            self.piezo.__exit__(exc_type, exc, tb)
+            if self.tuning_map is not None:
+                self.tuning_map.save()
+            if self.flight_recorder is not None:
+                self.flight_recorder.close()
+            if self._metrics_server is not None:
+                self._metrics_server.stop()
+            if self._devices is None:
+                self.current.__exit__(exc_type, exc, tb)
+                self.piezo.__exit__(exc_type, exc, tb)
+            if self._own_wm:
+                self.wm.close()
         finally:
             return super().__exit__(exc_type, exc, tb)
 
     # device setup
+    def _setup(self):
+        self.metrics = LockMetrics(self.config.get("metrics", {}).get("window_size", 1000))
+        self._setup_wm()
+        self._setup_piezo_controller()
+        self._setup_current_controller()
+        self._setup_feedback_params()
+        self._setup_relock()
+        self._setup_feedforward()
+        self._setup_flight_recorder()
+
     def _setup_piezo_controller(self):
         channel = self.config["piezo"]["axis"]
         self.piezo.set_min_voltage(channel, self.config["piezo"]["min_voltage"])
@@ -110,6 +303,8 @@ class WMLock(LocalHERO):
         self._piezo_offset = self.piezo.get_voltage(channel)
         self._piezo_railed = False
         self._piezo_output = self._piezo_offset
+        self._piezo_resolution = self.config["piezo"].get("resolution_V", 0)
+        self._piezo_sent = self._piezo_offset
 
     def _voltage_offset_to_current_offset(self, voltage: float) -> float:
         """Function generator voltage to laser diode current."""
@@ -125,7 +320,9 @@ class WMLock(LocalHERO):
         channel = self.config["current"]["channel"]
         self._current_max_tuning_range = self.config["current"]["max_tuning_range_mA"]
         self._current_bias_slope = self.config["current"]["bias_slope_mA_per_V"]
-        self._current_offset = self._voltage_offset_to_current_offset(self.current.get_output(channel))
+        self._current_sent = self.current.get_output(channel)  # function generator voltage
+        self._current_resolution = self.config["current"].get("resolution_V", 0)
+        self._current_offset = self._voltage_offset_to_current_offset(self._current_sent)
         self._current_railed = False
         self._current_output = self._current_offset
 
@@ -134,29 +331,181 @@ class WMLock(LocalHERO):
         self._freq_setpoint_GHz = self.config["wm"]["freq_setpoint_GHz"]
         self._mode_hop_range_GHz = self.config["wm"]["mode_hop_range_GHz"]
         self._last_freq_GHz = None
+        self._wm_seq = 0
+        self._wm_wait_timeout = self._get_wm_wait_timeout()
+        self._empty_waits = 0  # waits in a row without a new reading
+        self._polling_until = 0  # time.monotonic() until which read_frequency is polled
+        self._unprinted_wm_errors = 0
+        self._next_wm_error_print = 0  # time.monotonic() of the next printed wavemeter error
         self._mode_hopped = False
         self._error_GHz = None
+        self._error = None  # wavemeter error of the latest reading
+        self._reading_age = ReadingAge()
+
+    def _get_wm_wait_timeout(self) -> float:
+        """Wait timeout that covers the longest gap between readings that the wavemeter server schedules."""
+        try:
+            interval = self.wm.get_update_interval(self._wm_port)
+        except WMError:
+            return WM_WAIT_TIMEOUT  # server without get_update_interval or not reachable
+        longest = interval["max"] or interval["measured"]
+        if longest is None:
+            return WM_WAIT_TIMEOUT
+        return max(WM_WAIT_TIMEOUT, 2 * longest)
 
     def _setup_feedback_params(self):
         self._p_gain = self.config["feedback"]["p_gain"]
         self._i_time = self.config["feedback"]["i_time"]
         self._max_integral_time_step = self.config["feedback"]["max_integral_time_step"]
-        self._feedback_output = 0
-        self._integral = 0
-        self._last_integral_time = None
+        self._controller_name = self.config["feedback"].get("controller", "pi")
+        self._controller = controllers.CONTROLLERS[self._controller_name]
+        self._controller_params = dict(self.config["feedback"].get("controller_params", {}))
+        self._pending_controller = None  # (name, params) set by set_controller, applied by the feedback loop
+        self._controller_lock = threading.Lock()
+        self._reset_controller()
         self._lock_on = False
         self._wm_good = False
 
+    def _setup_relock(self):
+        self._relock_time = 0  # s spent relocking in total
+        relock_config = self.config.get("relock")
+        if relock_config is None:
+            self.tuning_map = None
+            self._start_at_operating_point = False
+            return
+        self.tuning_map = TuningMap(relock_config["tuning_map_path"], clock=self._time)
+        self._tuning_sample_interval = relock_config["sample_interval"]
+        self._last_tuning_sample_time = 0
+        self._relock_piezo_step_V = relock_config["piezo_step_V"]
+        self._relock_current_step_mA = relock_config["current_step_mA"]
+        self._start_at_operating_point = relock_config["start_at_operating_point"]
+
+    def _setup_feedforward(self):
+        feedforward_config = self.config.get("feedforward", {})
+        self._tuning_GHz_per_V = feedforward_config.get("tuning_GHz_per_V")
+        self._learn_tuning = feedforward_config.get("learn", True)
+        self._settle_threshold_GHz = feedforward_config.get("settle_threshold_GHz", 0.01)
+        self._settle_time = feedforward_config.get("settle_time", 1)
+        self._pending_setpoint_GHz = None
+        self._settling = None
+        self._settled_report = None
+
+    def _setup_flight_recorder(self):
+        recorder_config = self.config.get("flight_recorder")
+        if recorder_config is not None:
+            self.flight_recorder = FlightRecorder(recorder_config["path"], recorder_config["capacity"])
+
+    def _near_setpoint(self) -> bool:
+        """True if the latest good reading is within the mode hop free range of the setpoint."""
+        return self._wm_good and abs(self._last_freq_GHz - self._freq_setpoint_GHz) < self._mode_hop_range_GHz
+
+    def _go_to_operating_point(self, setpoint_GHz: float) -> bool:
+        """Moves the outputs to the operating point of setpoint_GHz in the tuning map.
+
+        Returns:
+            False if the map has no operating point within the mode hop free range of setpoint_GHz.
+        """
+        point = self.tuning_map.operating_point(setpoint_GHz, self._mode_hop_range_GHz)
+        if point is None:
+            return False
+        self._reset_controller()
+        self._piezo_output = self._set_piezo_output(point["piezo_V"])
+        self._current_output = self._set_current_output(point["current_mA"])
+        self._piezo_offset = self._piezo_output
+        self._current_offset = self._current_output
+        return True
+
     # feedback
     def _get_frequency_GHz(self):
-        freq_GHz = self.wm.read_frequency(self._wm_port)
+        """Waits for the next wavemeter reading. Returns None if there is none within the wait timeout.
+
+        A wavemeter server that does not reply (WMTimeoutError) or fails is reported like a bad
+        reading, so the loop holds the outputs instead of hanging. The next request is sent no sooner
+        than one wait timeout after the failed one started, so an error that comes back at once does
+        not spin the loop. If no new reading arrives in WM_STALL_WAITS waits in a row, e.g. because
+        the server stopped numbering its readings, the lock reports it and polls read_frequency for
+        WM_STALL_POLL_TIME before it waits again.
+        """
+        if time.monotonic() < self._polling_until:
+            return self._poll_frequency_GHz()
+        start = time.monotonic()
+        try:
+            with self.metrics.probe("wm_wait"):
+                reading = self.frequency_source.wait_new_frequency(
+                    self._wm_port, self._wm_seq, self._wm_wait_timeout, rpc_timeout=self._wm_wait_timeout + self.wm.timeout
+                )
+        except WMError as e:
+            return self._failed_request(e, start)
+        if reading is None:
+            self._empty_waits += 1
+            if self._empty_waits >= WM_STALL_WAITS:
+                print(f"No new wavemeter reading in {self._empty_waits} waits, polling read_frequency")
+                self.metrics.increment("wm_stalls")
+                self._empty_waits = 0
+                self._polling_until = time.monotonic() + WM_STALL_POLL_TIME
+            return None
+        self._empty_waits = 0
+        seq, timestamp, freq_GHz = reading
+        if seq is None:  # the server does not number its readings and answered at once
+            self._stop.wait(WM_POLL_INTERVAL)
+            return self._distinct_reading(freq_GHz)
+        self._wm_seq = seq
+        if timestamp is not None:
+            self.metrics.add("wm_reading_age", self._reading_age.age(self._time(), 1e-3 * timestamp))
+        return self._to_reading(freq_GHz)
+
+    def _to_reading(self, freq_GHz):
+        """(frequency, None) of a valid wavemeter value, (0, error) otherwise."""
         if isinstance(freq_GHz, (float, int)) and freq_GHz > 0:
             return (freq_GHz, None)
         else:
             return (0, freq_GHz)
 
+    def _distinct_reading(self, freq_GHz):
+        """Reading of a value without sequence number, None if it is the last value again."""
+        if freq_GHz == self._last_freq_GHz:
+            return None
+        return self._to_reading(freq_GHz)
+
+    def _poll_frequency_GHz(self):
+        """Reads the frequency with read_frequency. Returns None if it did not change since the last reading."""
+        self._stop.wait(WM_POLL_INTERVAL)
+        start = time.monotonic()
+        try:
+            freq_GHz = self.wm.read_frequency(self._wm_port)
+        except WMError as e:
+            return self._failed_request(e, start)
+        return self._distinct_reading(freq_GHz)
+
+    def _failed_request(self, error: WMError, start: float):
+        """Bad reading of a failed wavemeter request started at start (time.monotonic()), returned
+        one wait timeout after the start at the earliest."""
+        self._stop.wait(start + self._wm_wait_timeout - time.monotonic())
+        return (0, f"{type(error).__name__}: {error}")
+
+    def _report_wm_error(self):
+        """Counts the bad reading and prints it, at most once every WM_ERROR_PRINT_INTERVAL s."""
+        self.metrics.increment("wavemeter_errors")
+        self._unprinted_wm_errors += 1
+        now = time.monotonic()
+        if now < self._next_wm_error_print:
+            return
+        repeats = f" ({self._unprinted_wm_errors} errors since the last message)" if self._unprinted_wm_errors > 1 else ""
+        print(f"Wavemeter error: {self._error}{repeats}")
+        self._unprinted_wm_errors = 0
+        self._next_wm_error_print = now + WM_ERROR_PRINT_INTERVAL
+
+    def _reset_controller(self):
+        self._last_integral_time = None
+        self._controller_state = controllers.initial_state()
+        self._feedback_output = 0
+
+    def _feedback_limits(self):
+        """Feedback outputs that the piezo can follow."""
+        return (self._piezo_range[0] - self._piezo_offset, self._piezo_range[1] - self._piezo_offset)
+
     def _get_feedback_output(self, error_GHz):
-        time_now = time.time()
+        time_now = self._time()
         if self._last_integral_time is None:
             integral_time_step = 0
         else:
@@ -165,27 +514,33 @@ class WMLock(LocalHERO):
             integral_time_step = self._max_integral_time_step
         self._last_integral_time = time_now
 
-        p_term = error_GHz * self._p_gain
-        i_term_change = error_GHz * self._p_gain * integral_time_step / self._i_time
-        self._integral += i_term_change
-        return p_term + self._integral
+        output, self._controller_state = self._controller(
+            self._controller_state,
+            error_GHz,
+            integral_time_step,
+            self._feedback_limits(),
+            self._freq_setpoint_GHz,
+            self._p_gain,
+            self._i_time,
+            **self._controller_params,
+        )
+        return output
 
     def _set_piezo_output(self, output):
         if output < self._piezo_range[0]:
             self._piezo_railed = True
             output = self._piezo_range[0]
-            min_integral = output - self._piezo_offset
-            if self._lock_on and self._integral < min_integral:
-                self._integral = min_integral
         elif output > self._piezo_range[1]:
             self._piezo_railed = True
             output = self._piezo_range[1]
-            max_integral = output - self._piezo_offset
-            if self._lock_on and self._integral > max_integral:
-                self._integral = max_integral
         else:
             self._piezo_railed = False
-        self.piezo.set_voltage(self.config["piezo"]["axis"], output)
+        if abs(output - self._piezo_sent) <= self._piezo_resolution:
+            self.metrics.increment("piezo_writes_skipped")
+            return self._piezo_sent
+        with self.metrics.probe("piezo_write"):
+            self.piezo.set_voltage(self.config["piezo"]["axis"], output)
+        self._piezo_sent = output
         return output
 
     def _update_piezo(self, feedback_output):
@@ -202,107 +557,311 @@ class WMLock(LocalHERO):
         else:
             self._current_railed = False
         func_gen_voltage = self._current_offset_to_voltage_offset(output)
-        self.current.set_output(self.config["current"]["channel"], func_gen_voltage)
+        if abs(func_gen_voltage - self._current_sent) <= self._current_resolution:
+            self.metrics.increment("current_writes_skipped")
+            return self._voltage_offset_to_current_offset(self._current_sent)
+        with self.metrics.probe("current_write"):
+            self.current.set_output(self.config["current"]["channel"], func_gen_voltage)
+        self._current_sent = func_gen_voltage
         return output
 
     def _update_current(self, feedback_output):
         desired_current = feedback_output * self._current_bias_slope + self._current_offset
         return self._set_current_output(desired_current)
 
-    def _get_next_frequency(self):
-        distinct_output = False
-        while not distinct_output:
-            self._stop.wait(0.01)
-            freq_GHz, self._error = self._get_frequency_GHz()
+    def _get_next_frequency(self) -> bool:
+        """Waits for the next wavemeter reading. Returns False if the lock stopped before it arrived."""
+        reading = None
+        while reading is None and not self._stop.is_set():
+            reading = self._get_frequency_GHz()
+        if reading is not None:
+            freq_GHz, self._error = reading
             if freq_GHz > 0:
                 self._wm_good = True
             else:
                 self._wm_good = False
-            distinct_output = freq_GHz != self._last_freq_GHz
             self._last_freq_GHz = freq_GHz
-        return self._last_freq_GHz
+        return reading is not None
 
     def _feedback_loop(self):
         while not self._stop.is_set():
-            self._get_next_frequency()
+            self._feedback_step()
+
+    def _feedback_step(self):
+        """Waits for the next wavemeter reading and acts on it. A relock runs within one step."""
+        if not self._get_next_frequency():
+            return  # stopped, do not act on the previous reading again
+        self._act_on_reading()
+
+    def _act_on_reading(self):
+        """Acts on the latest reading.
+
+        Setpoint steps and relocks wait for further readings, so they are timed as their own stages
+        ("setpoint_step", "relock") after the work on the reading ("iteration").
+        """
+        with self.metrics.probe("iteration"):
+            stage = self._feedback_on_reading()
+        if stage == "setpoint_step":
+            with self.metrics.probe("setpoint_step"):
+                self._step_setpoint()
+                self._record_flight()
+        elif stage == "relock":
+            with self.metrics.probe("relock"):
+                self._relock()
+
+    def _feedback_on_reading(self):
+        """Feedback on the latest reading. Returns "setpoint_step" or "relock" if the reading calls for one, else None."""
+        self._apply_pending_controller()
+
+        if not self._wm_good:
+            self._report_wm_error()
+            self._record_flight()
+            return None
+        if self._lock_on:
+            if self._pending_setpoint_GHz is not None:
+                return "setpoint_step"
+            self._error_GHz = self._last_freq_GHz - self._freq_setpoint_GHz
+            if np.abs(self._error_GHz) < self._mode_hop_threshold_GHz():
+                self._mode_hopped = False
+                self._feedback_output = self._get_feedback_output(self._error_GHz)
+                self._piezo_output = self._update_piezo(self._feedback_output)
+                if self._current_bias_slope != 0:
+                    self._current_output = self._update_current(self._feedback_output)
+                self._record_flight(self._error_GHz, self._feedback_output - self._controller_state["integral"])
+                self._record_tuning_sample()
+                self._check_settled()
+            else:
+                return "relock"
+        else:
+            self._record_flight()
+        return None
+
+    def _record_flight(self, error_GHz: float = np.nan, p_term_V: float = np.nan, relocking: bool = False):
+        """Writes the latest reading and the outputs after it to the flight recorder.
+
+        Args:
+            error_GHz: error of the reading, if the feedback or the relock used it.
+            p_term_V: feedback output minus the integral, if the feedback ran on the reading.
+            relocking: the reading was taken at a relock candidate.
+        """
+        if self.flight_recorder is None:
+            return
+        flags = (
+            flight_recorder.FLAG_WM_GOOD * self._wm_good
+            | flight_recorder.FLAG_LOCK_ON * self._lock_on
+            | flight_recorder.FLAG_PIEZO_RAILED * self._piezo_railed
+            | flight_recorder.FLAG_CURRENT_RAILED * self._current_railed
+            | flight_recorder.FLAG_MODE_HOPPED * self._mode_hopped
+            | flight_recorder.FLAG_RELOCKING * relocking
+        )
+        self.flight_recorder.record(
+            self._time(),
+            self._wm_seq,
+            self._last_freq_GHz if self._wm_good else np.nan,
+            self._wm_error_code(),
+            self._freq_setpoint_GHz,
+            error_GHz,
+            p_term_V,
+            self._controller_state["integral"],
+            self._feedback_output,
+            self._piezo_output,
+            self._current_output,
+            flags,
+        )
+
+    def _wm_error_code(self) -> int:
+        """wlmConst measurement error code of the latest reading, 0 if it is valid and
+        flight_recorder.WM_ERROR_REQUEST if the wavemeter request failed."""
+        if self._wm_good:
+            return 0
+        if isinstance(self._error, (int, float)):
+            return int(self._error)
+        code = WM_ERROR_CODES.get(self._error)
+        if code is None and isinstance(self._error, str) and self._error.startswith("unknown: "):
+            code = int(float(self._error[len("unknown: ") :]))
+        return flight_recorder.WM_ERROR_REQUEST if code is None else code
+
+    def _step_setpoint(self):
+        """Changes to the pending setpoint, moving the outputs by the expected change at once.
+
+        The integrator takes the feedforward step, so it only has to remove the residual error.
+        """
+        setpoint_GHz, self._pending_setpoint_GHz = self._pending_setpoint_GHz, None
+        step_GHz = setpoint_GHz - self._freq_setpoint_GHz
+        self._freq_setpoint_GHz = setpoint_GHz
+        piezo_before = self._piezo_output
+        feedforward_V = 0
+        if (
+            abs(step_GHz) > self._mode_hop_range_GHz
+            and self._start_at_operating_point
+            and self._go_to_operating_point(setpoint_GHz)
+        ):
+            feedforward_V = self._piezo_output - piezo_before
+        elif self._tuning_GHz_per_V is not None:
+            feedforward_V = step_GHz / self._tuning_GHz_per_V
+            integral = self._controller_state["integral"] + feedforward_V
+            self._feedback_output = integral
+            self._controller_state = controllers.anti_windup(
+                dict(self._controller_state, integral=integral), integral, self._feedback_limits()
+            )
+            self._piezo_output = self._update_piezo(self._feedback_output)
+            if self._current_bias_slope != 0:
+                self._current_output = self._update_current(self._feedback_output)
+        self._settling = {
+            "setpoint_GHz": setpoint_GHz,
+            "step_GHz": step_GHz,
+            "feedforward_V": feedforward_V,
+            "piezo_before": piezo_before,
+            "start_time": self._time(),
+            "in_band_since": None,
+            "relocked": False,
+        }
+        self._get_next_frequency()  # throw a frequency measured before the step.
 
-            if not self._wm_good:
-                print(f"Wavemeter error: {self._error}")
-                continue
-            if self._lock_on:
-                self._error_GHz = self._last_freq_GHz - self._freq_setpoint_GHz
-                if np.abs(self._error_GHz) < self._mode_hop_range_GHz:
-                    self._mode_hopped = False
-                    self._feedback_output = self._get_feedback_output(self._error_GHz)
-                    self._piezo_output = self._update_piezo(self._feedback_output)
-                    if self._current_bias_slope != 0:
-                        self._current_output = self._update_current(self._feedback_output)
+    def _mode_hop_threshold_GHz(self) -> float:
+        """Error above which the laser is taken to have mode hopped.
+
+        While a setpoint step without feedforward settles, the error starts at the step size,
+        so the threshold is raised by it.
+        """
+        if self._settling is not None and self._settling["feedforward_V"] == 0:
+            return self._mode_hop_range_GHz + abs(self._settling["step_GHz"])
+        return self._mode_hop_range_GHz
+
+    def _check_settled(self):
+        """Reports the settling of a setpoint change and learns the tuning coefficient from it."""
+        settling = self._settling
+        if settling is None:
+            return
+        time_now = self._time()
+        if np.abs(self._error_GHz) > self._settle_threshold_GHz:
+            settling["in_band_since"] = None
+            return
+        if settling["in_band_since"] is None:
+            settling["in_band_since"] = time_now
+        if time_now - settling["in_band_since"] < self._settle_time:
+            return
+        self._settling = None
+        piezo_change_V = self._piezo_output - settling["piezo_before"]
+        if self._learn_tuning and not settling["relocked"] and abs(piezo_change_V) > 0.01:
+            tuning_GHz_per_V = settling["step_GHz"] / piezo_change_V
+            if tuning_GHz_per_V * self._p_gain < 0:  # only coefficients that give negative feedback
+                if self._tuning_GHz_per_V is None:
+                    self._tuning_GHz_per_V = tuning_GHz_per_V
                 else:
-                    self._mode_hopped = True
-                    currents_to_test = np.arange(0.1, 1, 0.05)
-                    currents_to_test = np.array([currents_to_test, -currents_to_test]).flatten(order="F")
-                    voltages_to_test = np.arange(0, 5, 0.5)
-                    voltages_to_test = np.array([voltages_to_test, -voltages_to_test]).flatten(order="F")
-                    voltage_index = 0
-                    current_index = 0
-                    self._update_piezo_and_current_offsets(skip_lock_on=True)
-                    relocked = np.abs(self._error_GHz) < self._mode_hop_range_GHz
-                    while not relocked and self._lock_on and not self._stop.is_set():
-                        if current_index == len(currents_to_test):
-                            current_index = 0
-                            voltage_index += 1
-                            if voltage_index == len(voltages_to_test):
-                                voltage_index = 0
-                            self.set_piezo_output(
-                                self._piezo_offset + voltages_to_test[voltage_index],
-                                update_current_bias=False,
-                                skip_lock_on=True,
-                            )
-                        self.set_current_output(
-                            self._current_offset + currents_to_test[current_index],
-                            skip_lock_on=True,
-                        )
-                        self._get_next_frequency()  # throw a previously collected frequency.
-                        self._get_next_frequency()
-                        while not self._wm_good and self._lock_on and not self._stop.is_set():
-                            self._get_next_frequency()
-                        self._error_GHz = self._last_freq_GHz - self._freq_setpoint_GHz
-                        relocked = np.abs(self._error_GHz) < self._mode_hop_range_GHz
-                        current_index += 1
-                    if relocked:
-                        self._last_integral_time = None
-                        self._integral = 0
-                        self._feedback_output = 0
-                        self._mode_hopped = False
-                        self._update_piezo_and_current_offsets(skip_lock_on=True)
-                    else:
-                        self.set_piezo_output(self._piezo_offset, update_current_bias=False)
-                        self.set_current_output(self._current_offset)
-                        self._update_piezo_and_current_offsets()
-                    # TODO: relock routine
+                    self._tuning_GHz_per_V = 0.5 * (self._tuning_GHz_per_V + tuning_GHz_per_V)
+        self._settled_report = {
+            "setpoint_GHz": settling["setpoint_GHz"],
+            "step_GHz": settling["step_GHz"],
+            "feedforward_V": settling["feedforward_V"],
+            "piezo_change_V": piezo_change_V,
+            "settling_time": settling["in_band_since"] - settling["start_time"],
+            "relocked": settling["relocked"],
+        }
+
+    def _record_tuning_sample(self):
+        """Adds the present operating point to the tuning map every sample_interval while locked."""
+        if self.tuning_map is None:
+            return
+        time_now = self._time()
+        if time_now - self._last_tuning_sample_time < self._tuning_sample_interval:
+            return
+        self._last_tuning_sample_time = time_now
+        self.tuning_map.add_sample(self._piezo_output, self._current_output, self._last_freq_GHz, time_now)
+        self.tuning_map.update_operating_point(self._freq_setpoint_GHz, self._piezo_output, self._current_output, time_now)
+
+    def _relock_candidates(self):
+        """Yields (piezo output, current output) to try for a relock, best first.
+
+        The points predicted by the tuning map come first. Then current offsets are stepped
+        for each piezo offset around the outputs where the mode hop was detected, repeated
+        until relocked.
+        """
+        if self.tuning_map is not None:
+            yield from self.tuning_map.search(
+                self._freq_setpoint_GHz,
+                self._piezo_offset,
+                self._current_offset,
+                self._mode_hop_range_GHz,
+                self._relock_piezo_step_V,
+                self._relock_current_step_mA,
+            )
+        currents_to_test = np.arange(0.1, 1, 0.05)
+        currents_to_test = np.array([currents_to_test, -currents_to_test]).flatten(order="F")
+        voltages_to_test = np.arange(0, 5, 0.5)
+        voltages_to_test = np.array([voltages_to_test, -voltages_to_test]).flatten(order="F")
+        while True:
+            for voltage in voltages_to_test:
+                for current in currents_to_test:
+                    yield self._piezo_offset + voltage, self._current_offset + current
+
+    def _relock(self):
+        start_time = self._time()
+        self.metrics.increment("relocks")
+        self._mode_hopped = True
+        self._record_flight(self._error_GHz)
+        if self._settling is not None:
+            self._settling["relocked"] = True
+        self._update_piezo_and_current_offsets(skip_lock_on=True)
+        hop_piezo_output = self._piezo_offset
+        hop_current_output = self._current_offset
+        if self.tuning_map is not None:
+            self.tuning_map.add_mode_hop(self._freq_setpoint_GHz, hop_piezo_output)
+        candidates = self._relock_candidates()
+        relocked = False
+        steps = 0
+        while not relocked and self._lock_on and not self._stop.is_set():
+            piezo_output, current_output = next(candidates)
+            if piezo_output != self._piezo_output:
+                self.set_piezo_output(piezo_output, update_current_bias=False, skip_lock_on=True)
+            self.set_current_output(current_output, skip_lock_on=True)
+            self._get_next_frequency()  # throw a previously collected frequency.
+            self._get_next_frequency()
+            while not self._wm_good and self._lock_on and not self._stop.is_set():
+                self._get_next_frequency()
+            self._error_GHz = self._last_freq_GHz - self._freq_setpoint_GHz
+            relocked = np.abs(self._error_GHz) < self._mode_hop_range_GHz
+            steps += 1
+            self._record_flight(self._error_GHz if self._wm_good else np.nan, relocking=True)
+        if relocked:
+            print(f"Relocked after {steps} steps")
+            self._reset_controller()
+            self._mode_hopped = False
+            self._update_piezo_and_current_offsets(skip_lock_on=True)
+            if self.tuning_map is not None:
+                self.tuning_map.add_relock(hop_piezo_output, hop_current_output, self._piezo_output, self._current_output)
+        else:
+            self.set_piezo_output(self._piezo_offset, update_current_bias=False)
+            self.set_current_output(self._current_offset)
+            self._update_piezo_and_current_offsets()
+        self._relock_time += self._time() - start_time
 
     def get_lock_state(self):
         return self._lock_on
 
     def set_lock_state(self, state):
         if state:
+            if self._start_at_operating_point and not self._near_setpoint():
+                self._go_to_operating_point(self._freq_setpoint_GHz)
             self._update_piezo_and_current_offsets()
             self._lock_on = True
         else:
             self._lock_on = False
-            self._last_integral_time = None
-            self._integral = 0
-            self._feedback_output = 0
+            if self._pending_setpoint_GHz is not None:
+                self._freq_setpoint_GHz = self._pending_setpoint_GHz
+                self._pending_setpoint_GHz = None
+            self._settling = None
+            self._reset_controller()
             self._error_GHz = None
 
     def _update_piezo_and_current_offsets(self, skip_lock_on = False):
         if self._lock_on and not skip_lock_on:
             return
-        self._current_offset = self._voltage_offset_to_current_offset(
-            self.current.get_output(self.config["current"]["channel"])
-        )
+        self._current_sent = self.current.get_output(self.config["current"]["channel"])
+        self._current_offset = self._voltage_offset_to_current_offset(self._current_sent)
         self._current_output = self._current_offset
         self._piezo_offset = self.piezo.get_voltage(self.config["piezo"]["axis"])
+        self._piezo_sent = self._piezo_offset
         self._piezo_output = self._piezo_offset
 
     def get_piezo_output(self):
@@ -324,6 +883,32 @@ class WMLock(LocalHERO):
             return
         self._current_output = self._set_current_output(output)
 
+    def _apply_pending_controller(self):
+        """Switches to the controller staged by set_controller, between two feedback iterations."""
+        with self._controller_lock:
+            pending, self._pending_controller = self._pending_controller, None
+        if pending is None:
+            return
+        self._controller_name, self._controller_params = pending
+        self._controller = controllers.CONTROLLERS[self._controller_name]
+        self._controller_state = {"integral": self._controller_state["integral"]}
+
+    def get_controller(self):
+        with self._controller_lock:
+            pending = self._pending_controller
+        name, params = (self._controller_name, self._controller_params) if pending is None else pending
+        return {"controller": name, "controller_params": params}
+
+    def set_controller(self, controller, controller_params=None):
+        """Changes the feedback controller, keeping the integral so that the output does not jump.
+
+        The change is applied by the feedback loop before it acts on the next reading.
+        """
+        controller_params = {} if controller_params is None else controller_params
+        controllers.check_params(controller, controller_params)
+        with self._controller_lock:
+            self._pending_controller = (controller, dict(controller_params))
+
     def get_p_gain(self):
         return self._p_gain
 
@@ -337,11 +922,45 @@ class WMLock(LocalHERO):
         self._i_time = value
 
     def get_frequency_setpoint(self):
+        if self._pending_setpoint_GHz is not None:
+            return self._pending_setpoint_GHz
         return self._freq_setpoint_GHz
 
     def set_frequency_setpoint(self, value):
+        if self._lock_on:
+            self._pending_setpoint_GHz = value  # stepped by the feedback loop
+            return
         self._freq_setpoint_GHz = value
 
+    def get_setpoint_settled(self):
+        """False while the lock settles at a new setpoint."""
+        return self._settling is None and self._pending_setpoint_GHz is None
+
+    def get_tuning_coefficient(self):
+        """Frequency change per volt of piezo used for feedforward, None before it is known."""
+        return self._tuning_GHz_per_V
+
+    def get_tuning_map(self):
+        """Operating points recorded for each setpoint, see TuningMap.operating_points. Empty without a relock config."""
+        if self.tuning_map is None:
+            return []
+        return self.tuning_map.operating_points()
+
+    def get_metrics(self):
+        """Latency quantiles in ms and the counters of the lock, see LockMetrics.summary.
+
+        The stages are the waits for the next wavemeter reading ("wm_wait", close to the wavemeter
+        update interval while the lock waits on the wavemeter), the age of the readings on receipt
+        ("wm_reading_age", see ReadingAge), piezo and current writes, the work on each reading
+        from its receipt ("iteration"), and setpoint steps and relocks, which wait for further
+        readings ("setpoint_step", "relock").
+        """
+        return self.metrics.summary()
+
+    def get_wm_update_interval(self):
+        """Expected time between wavemeter readings of the lock channel, see WM.get_update_interval."""
+        return self.wm.get_update_interval(self._wm_port)
+
     # update / streaming
     @event
     def wm_freq_changed(self, value):
@@ -354,14 +973,26 @@ class WMLock(LocalHERO):
     @event
     def output_updated(self, value):
         return value
+
+    @event
+    def setpoint_settled(self, value):
+        return value
     
     def _update_loop(self):
         previous_freq_GHz = None
         previous_error_GHz = None
         previous_piezo_output = None
         previous_current_output = None
+        last_save_time = time.time()
+        previous_settled_report = None
         while not self._stop.is_set():
             self._stop.wait(0.1)
+            if self._settled_report is not previous_settled_report:
+                previous_settled_report = self._settled_report
+                self.setpoint_settled(previous_settled_report)
+            if self.tuning_map is not None and time.time() - last_save_time > TUNING_MAP_SAVE_INTERVAL:
+                self.tuning_map.save()
+                last_save_time = time.time()
             if self._last_freq_GHz != previous_freq_GHz:
                 self.wm_freq_changed(
                     {
@@ -0,0 +1,217 @@
+import time
+import threading
+
+from heros import RemoteHERO
+
+from wavemeter.wavemeter import WM, WMError
+from wm_lock import WMLock
+from lock_metrics import MetricsServer
+
+
+class BatchedFrequencyReader:
+    """Reads the frequencies of several wavemeter channels with one request at a time.
+
+    Each lock waits on its channel with wait_new_frequency, like on WM, but all locks share
+    one long poll of the wavemeter server, wait_new_snapshot, which returns as soon as any of
+    the channels has a new measurement. If the server does not number its measurements (it
+    runs without the event thread), the channels are read with read_snapshot every period
+    instead, and a reading without a sequence number only counts as new if its frequency
+    changed.
+
+    A failed request is handed to every channel as one error reading when the requests start
+    to fail with that error, so each lock reports it once like a bad wavemeter reading.
+    """
+
+    def __init__(self, wm: WM, channels, period: float = 0.05, timeout: float = 1.0):
+        """
+        Args:
+            wm: wavemeter client.
+            channels: wavemeter channels to read.
+            period: time between reads in s if the server does not number its measurements,
+                and between retries after a failed request.
+            timeout: longest wait of a long poll for a new measurement in s.
+        """
+        self.wm = wm
+        self.channels = sorted(set(channels))
+        self.period = period
+        self.timeout = timeout
+        self._readings = {}  # channel -> [seq, timestamp, frequency], replaced on every new reading
+        self._server_readings = {}  # channel -> (server seq, timestamp, frequency) of the latest reading
+        self._error = None  # error of the failing requests, None while they succeed
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.timeout + self.wm.timeout + 1)
+
+    def _store(self, channel, timestamp, freq_GHz):
+        seq = self._readings.get(channel, [0])[0] + 1
+        self._readings[channel] = [seq, timestamp, freq_GHz]
+
+    def _store_error(self, error: str):
+        with self._condition:
+            self._error = error
+            for channel in self.channels:
+                self._store(channel, None, error)
+            self._condition.notify_all()
+
+    def _store_snapshot(self, snapshot: dict):
+        with self._condition:
+            self._error = None
+            for i, channel in enumerate(self.channels):
+                server_reading = (snapshot["seq"][i], snapshot["timestamp"][i], snapshot["frequency"][i])
+                if server_reading == self._server_readings.get(channel):
+                    continue  # no new measurement of this channel
+                self._server_readings[channel] = server_reading
+                self._store(channel, snapshot["timestamp"][i], snapshot["frequency"][i])
+            self._condition.notify_all()
+
+    def _read(self, numbered: bool) -> dict:
+        """Returns the next snapshot, waiting for a new measurement if the server numbers them."""
+        quantities = ["frequency", "seq", "timestamp"]
+        if numbered:
+            last_seqs = [self._server_readings.get(channel, (0,))[0] or 0 for channel in self.channels]
+            snapshot = self.wm.wait_new_snapshot(self.channels, last_seqs, self.timeout, rpc_timeout=self.timeout + self.wm.timeout)
+            if snapshot is not None:
+                return snapshot
+            # no new measurement within the timeout, check that the server still numbers them
+        return self.wm.read_snapshot(self.channels, quantities)
+
+    def _read_loop(self):
+        numbered = True
+        while not self._stop.is_set():
+            try:
+                snapshot = self._read(numbered)
+            except WMError as e:
+                error = f"{type(e).__name__}: {e}"
+                if error != self._error:
+                    self._store_error(error)
+                self._stop.wait(self.period)
+                continue
+            self._store_snapshot(snapshot)
+            numbered = any(seq is not None for seq in snapshot["seq"])
+            if not numbered:
+                self._stop.wait(self.period)
+
+    def _newer(self, channel, last_seq):
+        reading = self._readings.get(channel)
+        if reading is None or reading[0] == last_seq:
+            return None
+        return reading
+
+    def wait_new_frequency(self, channel: int, last_seq: int = 0, timeout: float = 1.0, rpc_timeout: float = None):
+        """Same as WM.wait_new_frequency, with the sequence numbers of this reader. rpc_timeout is not used."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._newer(channel, last_seq) is not None, timeout)
+            return self._newer(channel, last_seq)
+
+
+class SerializedDevice:
+    """Makes the calls of several threads to a shared RemoteHERO device one at a time.
+
+    The feedback threads of the locks and the HERO threads that serve their remote calls all
+    use the same device connection, and RemoteHERO does not promise that concurrent calls on
+    one connection are safe. Attributes are read and methods called under one lock per device.
+    """
+
+    def __init__(self, device: RemoteHERO):
+        self._device = device
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        with self._lock:
+            attribute = getattr(self._device, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+
+        return call
+
+
+class WMLockManager:
+    """Hosts several WMLocks in one process, sharing one wavemeter connection and the devices.
+
+    Every lock is still its own HERO, named by its key in locks. The frequencies of all lock
+    channels are read by one BatchedFrequencyReader, and locks that use the same device HERO
+    share one RemoteHERO connection to it, which makes one call at a time (SerializedDevice).
+    """
+
+    def __init__(self, locks: dict, period: float = 0.05, wm: WM = None, metrics_port: int = None):
+        """
+        Args:
+            locks: HERO name -> WMLockConfig of each lock.
+            period: time between batched wavemeter reads in s if the wavemeter server does not
+                number its measurements, see BatchedFrequencyReader.
+            wm: wavemeter client, a new WM by default.
+            metrics_port: serve the metrics of all locks as text at http://<host>:<metrics_port>/metrics,
+                None for no endpoint.
+        """
+        self.configs = dict(locks)
+        self._own_wm = wm is None
+        self.wm = WM() if wm is None else wm
+        self.reader = BatchedFrequencyReader(self.wm, [config.data["wm"]["wm_port"] for config in self.configs.values()], period)
+        self._connections = {}  # HERO name -> entered RemoteHERO
+        self.devices = {}  # HERO name -> SerializedDevice of the connection
+        self.locks = {}
+        self.metrics_port = metrics_port
+        self._metrics_server = None
+
+    def __getitem__(self, name: str) -> WMLock:
+        return self.locks[name]
+
+    def __enter__(self):
+        device_names = set()
+        for config in self.configs.values():
+            device_names.add(config.data["piezo"]["hero"])
+            device_names.add(config.data["current"]["hero"])
+        try:
+            for device_name in sorted(device_names):
+                self._connections[device_name] = RemoteHERO(device_name).__enter__()
+                self.devices[device_name] = SerializedDevice(self._connections[device_name])
+            self.reader.start()
+            for name, config in self.configs.items():
+                lock = WMLock(config, name, wm=self.wm, frequency_source=self.reader, devices=self.devices)
+                self.locks[name] = lock.__enter__()
+            if self.metrics_port is not None:
+                self._metrics_server = MetricsServer({name: lock.metrics for name, lock in self.locks.items()}, self.metrics_port)
+                self._metrics_server.start()
+        except BaseException as e:
+            self.__exit__(type(e), e, e.__traceback__)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+            self._metrics_server = None
+        for lock in self.locks.values():
+            lock.__exit__(exc_type, exc, tb)
+        self.locks = {}
+        self.reader.stop()
+        for connection in self._connections.values():
+            connection.__exit__(exc_type, exc, tb)
+        self._connections = {}
+        self.devices = {}
+        if self._own_wm:
+            self.wm.close()
+
+
+if __name__ == "__main__":
+    from wm_lock_422 import WMLockConfig422
+
+    try:
+        with WMLockManager({"wm_lock_422": WMLockConfig422()}) as manager:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
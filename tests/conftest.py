@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules in headers, and those in headers/wavemeter, import each other by their top-level names
+HEADERS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "headers")
+sys.path.insert(0, HEADERS)
+sys.path.append(os.path.join(HEADERS, "wavemeter"))  # after headers, so "wavemeter" stays the package
@@ -0,0 +1,92 @@
+import math
+
+import pytest
+
+import controllers
+
+
+LIMITS = (-10.0, 10.0)
+
+
+def test_pi_step_proportional_and_integral():
+    state = controllers.initial_state()
+    output, state = controllers.pi_step(state, 0.1, 0, LIMITS, 100.0, -0.5, 1.0)
+    assert output == pytest.approx(-0.05)
+    assert state["integral"] == 0
+    output, state = controllers.pi_step(state, 0.1, 0.5, LIMITS, 100.0, -0.5, 1.0)
+    assert state["integral"] == pytest.approx(-0.025)
+    assert output == pytest.approx(-0.075)
+
+
+def test_steps_do_not_change_the_given_state():
+    for name, step in controllers.CONTROLLERS.items():
+        state = controllers.initial_state()
+        state_copy = dict(state)
+        step(state, 0.2, 0.05, LIMITS, 100.0, -0.5, 1.0)
+        assert state == state_copy, name
+
+
+def test_anti_windup_clamps_the_integral_beyond_the_limits():
+    assert controllers.anti_windup({"integral": -12.0}, -13.0, LIMITS)["integral"] == -10.0
+    assert controllers.anti_windup({"integral": 12.0}, 13.0, LIMITS)["integral"] == 10.0
+    assert controllers.anti_windup({"integral": 5.0}, 11.0, LIMITS)["integral"] == 5.0
+    assert controllers.anti_windup({"integral": 12.0}, 9.0, LIMITS)["integral"] == 12.0
+
+
+def test_pi_step_does_not_wind_up_while_railed():
+    state = controllers.initial_state()
+    for _ in range(100):
+        output, state = controllers.pi_step(state, -10.0, 1.0, LIMITS, 100.0, -0.5, 1.0)
+    assert output > LIMITS[1]
+    assert state["integral"] == LIMITS[1]
+
+
+def test_pid_step_derivative_acts_on_the_measurement():
+    state = controllers.initial_state()
+    _, state = controllers.pid_step(state, 0.0, 0, LIMITS, 100.0, -0.5, 1.0, d_time=1.0, d_filter_time=0.0)
+    # a setpoint change alone does not kick the derivative
+    _, changed = controllers.pid_step(state, -1.0, 0.1, LIMITS, 101.0, -0.5, 1.0, d_time=1.0, d_filter_time=0.0)
+    assert changed["derivative"] == 0
+    # a change of the measurement does
+    _, moved = controllers.pid_step(state, 1.0, 0.1, LIMITS, 100.0, -0.5, 1.0, d_time=1.0, d_filter_time=0.0)
+    assert moved["derivative"] == pytest.approx(10.0)
+
+
+def test_setpoint_weighted_pi_step_weights_setpoint_changes():
+    state = controllers.initial_state()
+    _, state = controllers.setpoint_weighted_pi_step(state, 0.0, 0, LIMITS, 100.0, -0.5, 1.0, setpoint_weight=0.5)
+    output, _ = controllers.setpoint_weighted_pi_step(state, -1.0, 0, LIMITS, 101.0, -0.5, 1.0, setpoint_weight=0.5)
+    assert output == pytest.approx(-0.5 * (-1.0 + 0.5 * 1.0))
+    output, _ = controllers.setpoint_weighted_pi_step(state, -1.0, 0, LIMITS, 101.0, -0.5, 1.0, setpoint_weight=1.0)
+    assert output == pytest.approx(0.5)
+
+
+def test_lead_lag_step_without_filter_is_pi():
+    pi_state = lead_lag_state = controllers.initial_state()
+    for error in (0.1, -0.2, 0.3):
+        pi_output, pi_state = controllers.pi_step(pi_state, error, 0.05, LIMITS, 100.0, -0.5, 1.0)
+        lead_lag_output, lead_lag_state = controllers.lead_lag_step(lead_lag_state, error, 0.05, LIMITS, 100.0, -0.5, 1.0)
+        assert lead_lag_output == pytest.approx(pi_output)
+
+
+def test_lead_lag_step_lead_boosts_error_changes():
+    state = controllers.initial_state()
+    _, state = controllers.lead_lag_step(state, 0.0, 0, LIMITS, 100.0, -1.0, math.inf, lead_time=1.0)
+    output, _ = controllers.lead_lag_step(state, 0.1, 0.1, LIMITS, 100.0, -1.0, math.inf, lead_time=1.0)
+    assert output == pytest.approx(-1.0 * (1.1 * 0.1) / 0.1)
+
+
+def test_check_params():
+    controllers.check_params("pi", {})
+    controllers.check_params("pid", {"d_time": 0.1, "d_filter_time": 0.05})
+    controllers.check_params("setpoint_weighted_pi", {"setpoint_weight": 1})
+    with pytest.raises(ValueError):
+        controllers.check_params("p", {})
+    with pytest.raises(ValueError):
+        controllers.check_params("pi", {"d_time": 0.1})
+    with pytest.raises(ValueError):
+        controllers.check_params("pid", {"d_time": -0.1})
+    with pytest.raises(ValueError):
+        controllers.check_params("lead_lag", {"lag_time": math.nan})
+    with pytest.raises(ValueError):
+        controllers.check_params("setpoint_weighted_pi", {"setpoint_weight": 1.5})
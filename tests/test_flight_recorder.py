@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import flight_recorder
+from flight_recorder import FlightRecorder, read_flight_record
+
+
+def record(recorder, i):
+    recorder.record(float(i), i, 710962.7 + i, 0, 710962.7, 1e-3 * i, 0.1, 0.2, 0.3, 37.5, 1.0, flight_recorder.FLAG_LOCK_ON)
+
+
+def test_records_are_read_back_in_order(tmp_path):
+    path = str(tmp_path / "lock.rec")
+    recorder = FlightRecorder(path, capacity=10)
+    for i in range(4):
+        record(recorder, i)
+    records = read_flight_record(path)
+    assert len(recorder) == 4
+    np.testing.assert_array_equal(records["seq"], [0, 1, 2, 3])
+    assert records[2]["freq_GHz"] == 710962.7 + 2
+    assert records[2]["error_GHz"] == pytest.approx(2e-3)
+    assert records[2]["flags"] == flight_recorder.FLAG_LOCK_ON
+    recorder.close()
+
+
+def test_ring_keeps_the_latest_capacity_records(tmp_path):
+    path = str(tmp_path / "lock.rec")
+    recorder = FlightRecorder(path, capacity=5)
+    for i in range(12):
+        record(recorder, i)
+    assert len(recorder) == 5
+    np.testing.assert_array_equal(read_flight_record(path)["seq"], [7, 8, 9, 10, 11])
+    np.testing.assert_array_equal(read_flight_record(path, last=2)["seq"], [10, 11])
+    recorder.close()
+
+
+def test_wm_error_code_is_recorded(tmp_path):
+    path = str(tmp_path / "lock.rec")
+    recorder = FlightRecorder(path, capacity=5)
+    recorder.record(0.0, 1, np.nan, -3, 710962.7, np.nan, np.nan, 0, 0, 37.5, 1.0, 0)
+    recorder.record(0.1, 1, np.nan, flight_recorder.WM_ERROR_REQUEST, 710962.7, np.nan, np.nan, 0, 0, 37.5, 1.0, 0)
+    np.testing.assert_array_equal(read_flight_record(path)["wm_error"], [-3, flight_recorder.WM_ERROR_REQUEST])
+    recorder.close()
+
+
+def test_recording_continues_an_existing_file(tmp_path):
+    path = str(tmp_path / "lock.rec")
+    recorder = FlightRecorder(path, capacity=5)
+    for i in range(3):
+        record(recorder, i)
+    recorder.close()
+    recorder = FlightRecorder(path, capacity=5)
+    for i in range(3, 6):
+        record(recorder, i)
+    np.testing.assert_array_equal(read_flight_record(path)["seq"], [1, 2, 3, 4, 5])
+    recorder.close()
+    with pytest.raises(ValueError, match="holds 5 records"):
+        FlightRecorder(path, capacity=6)
+
+
+def test_version_1_files_are_rejected(tmp_path):
+    path = str(tmp_path / "lock.rec")
+    FlightRecorder(path, capacity=5).close()
+    header = np.memmap(path, dtype=flight_recorder.HEADER_DTYPE, mode="r+", shape=(1,))
+    header[0]["version"] = 1
+    header[0]["record_size"] = 84  # records of version 1 had no wm_error
+    header.flush()
+    del header
+    with pytest.raises(ValueError, match="not a flight record of this version"):
+        read_flight_record(path)
+    with pytest.raises(ValueError, match="not a flight record of this version"):
+        FlightRecorder(path, capacity=5)
@@ -0,0 +1,102 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from measurement_cache import MeasurementCache
+from wavemeter.wavemeter import WM
+from wm_server import WMServer
+from wm_simulator import LaserModel, SimulatedDLL
+
+
+def reading(frequency):
+    return {"frequency": frequency, "error": None}
+
+
+def test_newer_returns_the_latest_reading_unless_it_is_last_seq():
+    cache = MeasurementCache()
+    assert cache.newer(3, 0) is None
+    assert cache.update(3, 1000, reading(710962.7)) == 1
+    assert cache.update(3, 1050, reading(710962.8)) == 2
+    latest = cache.newer(3, 0)
+    assert (latest["seq"], latest["timestamp"], latest["frequency"]) == (2, 1050, 710962.8)
+    assert cache.newer(3, 1)["seq"] == 2
+    assert cache.newer(3, 2) is None
+    assert cache.newer(3, 7)["seq"] == 2  # a seq from before a server restart counts as older
+    assert cache.newer(4, 0) is None
+
+
+def test_newer_any_returns_all_channels_once_one_is_newer():
+    cache = MeasurementCache()
+    cache.update(3, 1000, reading(710962.7))
+    cache.update(4, 1010, reading(650000.0))
+    assert cache.newer_any([3, 4, 5], [1, 1, 0]) is None
+    cache.update(4, 1060, reading(650000.1))
+    readings = cache.newer_any([3, 4, 5], [1, 1, 0])
+    assert [r and r["seq"] for r in readings] == [1, 2, None]
+
+
+def test_wait_newer_wakes_on_update():
+    cache = MeasurementCache()
+    threading.Timer(0.05, cache.update, (3, 1000, reading(710962.7))).start()
+    assert cache.wait_newer(3, 0, 2)["seq"] == 1
+    start = time.monotonic()
+    assert cache.wait_newer(3, 1, 0.1) is None
+    assert time.monotonic() - start >= 0.1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server():
+    dll = SimulatedDLL({3: LaserModel(710962.7, seed=1)}, measurement_rate=50)
+    server = WMServer(WM(mode="server", dll=dll), port=free_port(), event_port=None)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = WM(host="127.0.0.1", port=server.port, timeout=2, retries=0)
+    yield server, client
+    client.close()
+    server.stop()
+    thread.join(timeout=2)
+    dll.close()
+
+
+def test_parked_wait_is_answered_by_a_new_reading(server):
+    server, client = server
+    seq, timestamp, frequency = client.wait_new_frequency(3, 0, 2)
+    assert seq >= 1
+    assert frequency == pytest.approx(710962.7, abs=1)
+    next_seq, next_timestamp, _ = client.wait_new_frequency(3, seq, 2)
+    assert next_seq > seq
+    assert next_timestamp > timestamp
+
+
+def test_parked_wait_times_out_without_a_new_reading(server):
+    server, client = server
+    start = time.monotonic()
+    assert client.wait_new_frequency(5, 0, 0.3) is None  # no laser on channel 5
+    assert time.monotonic() - start >= 0.3
+
+
+def test_parked_snapshot_wait_is_answered_by_any_channel(server):
+    server, client = server
+    snapshot = client.wait_new_snapshot([3, 5], [0, 0], 2)
+    assert snapshot["seq"][0] >= 1
+    assert snapshot["seq"][1] is None
+    assert client.wait_new_snapshot([5], [0], 0.2) is None
+
+
+def test_waits_are_answered_from_the_dll_without_the_event_thread(server):
+    server, client = server
+    client.wait_new_frequency(3, 0, 2)
+    server.wm.cache.live = False
+    start = time.monotonic()
+    seq, timestamp, frequency = client.wait_new_frequency(3, 0, 5)
+    assert time.monotonic() - start < 1
+    assert (seq, timestamp) == (None, None)
+    assert frequency == pytest.approx(710962.7, abs=1)
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pytest
+
+from tuning_map import TuningMap
+
+
+def filled_map(path):
+    tuning_map = TuningMap(path, clock=lambda: 100.0)
+    tuning_map.add_sample(37.5, 1.0, 710962.7)
+    tuning_map.add_sample(37.6, 1.1, 710962.8)
+    tuning_map.add_relock(40.0, 2.0, 35.0, 0.5)
+    tuning_map.update_operating_point(710962.7, 37.5, 1.0)
+    tuning_map.add_mode_hop(710962.7, 30.0)
+    return tuning_map
+
+
+@pytest.mark.parametrize("name", ["map.npz", "map"])
+def test_saved_map_is_loaded_again(tmp_path, name):
+    path = str(tmp_path / name)
+    saved = filled_map(path)
+    saved.save()
+    assert os.listdir(tmp_path) == ["map.npz"]
+    loaded = TuningMap(path)
+    np.testing.assert_array_equal(loaded.samples, saved.samples)
+    np.testing.assert_array_equal(loaded.relocks, saved.relocks)
+    assert loaded.operating_points() == saved.operating_points()
+    assert loaded.operating_point(710962.7, 0.01)["hop_low_piezo_V"] == 30.0
+
+
+def test_path_without_suffix_names_the_saved_file(tmp_path):
+    assert TuningMap(str(tmp_path / "map")).path == str(tmp_path / "map.npz")
+    assert TuningMap(str(tmp_path / "map.npz")).path == str(tmp_path / "map.npz")
+
+
+def test_loading_keeps_the_latest_samples(tmp_path):
+    path = str(tmp_path / "map.npz")
+    saved = TuningMap(path)
+    for i in range(10):
+        saved.add_sample(30.0 + i, 0.0, 710962.7, t=i)
+    saved.save()
+    loaded = TuningMap(path, max_samples=3)
+    np.testing.assert_array_equal(loaded.samples[:, 0], [7, 8, 9])
+
+
+def test_unchanged_map_is_not_written_again(tmp_path):
+    path = str(tmp_path / "map.npz")
+    tuning_map = filled_map(path)
+    tuning_map.save()
+    os.remove(path)
+    tuning_map.save()
+    assert not os.path.exists(path)
+    tuning_map.add_sample(37.7, 1.2, 710962.9)
+    tuning_map.save()
+    assert os.path.exists(path)
+
+
+def test_map_without_path_is_not_saved(tmp_path):
+    tuning_map = filled_map(None)
+    tuning_map.save()
+    assert tuning_map.path is None
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+import wm_protocol
+
+
+def transport(frames):
+    """Frames as a zmq socket receives them."""
+    return [bytes(frame) for frame in frames]
+
+
+def round_trip(value):
+    frames = wm_protocol.encode_reply(7, 42, value)
+    return wm_protocol.decode_reply(transport(frames), 7, 42)
+
+
+def test_values_round_trip():
+    value = {
+        "none": None,
+        "flags": [True, False],
+        "int": -(2**40),
+        "float": 710962.6975310215,
+        "str": "NoSignal",
+        "bytes": b"\x00\xff",
+        "nested": [[1, 2.5, "x"], {"a": None}],
+    }
+    assert round_trip(value) == value
+    assert round_trip((1, 2)) == [1, 2]
+    assert round_trip(range(3)) == [0, 1, 2]
+    assert round_trip(np.int32(3)) == 3
+    assert round_trip(np.float64(0.5)) == 0.5
+
+
+def test_arrays_round_trip_in_their_own_frames():
+    arrays = [np.arange(12, dtype="<f8").reshape(3, 4), np.arange(5, dtype=np.int16), np.zeros((0, 2), dtype=np.uint32)]
+    frames = wm_protocol.encode_reply(7, 42, {"arrays": arrays, "after": 1})
+    assert len(frames) == 2 + len(arrays)
+    value = wm_protocol.decode_reply(transport(frames), 7, 42)
+    assert value["after"] == 1
+    for sent, received in zip(arrays, value["arrays"]):
+        assert received.dtype == sent.dtype
+        np.testing.assert_array_equal(received, sent)
+
+
+def test_non_contiguous_arrays_are_sent_contiguous():
+    array = np.arange(20.0).reshape(4, 5)[:, ::2]
+    np.testing.assert_array_equal(round_trip(array), array)
+
+
+def test_request_round_trip():
+    frames = wm_protocol.encode_request("wait_new_frequency", (3, 17), {"timeout": 0.5}, 9)
+    method, request_id, args, kwargs = wm_protocol.decode_request(frames)
+    assert method == wm_protocol.method_id("wait_new_frequency")
+    assert request_id == 9
+    assert args == [3, 17]
+    assert kwargs == {"timeout": 0.5}
+
+
+def test_error_reply_raises_remote_error():
+    frames = wm_protocol.encode_error(7, 42, "ValueError: bad channel")
+    with pytest.raises(wm_protocol.WMRemoteError, match="bad channel"):
+        wm_protocol.decode_reply(frames, 7, 42)
+
+
+def test_reply_to_another_request_is_rejected():
+    frames = wm_protocol.encode_reply(7, 42, 1.0)
+    with pytest.raises(wm_protocol.WMProtocolError):
+        wm_protocol.decode_reply(frames, 7, 43)
+    with pytest.raises(wm_protocol.WMProtocolError):
+        wm_protocol.decode_reply(frames, 8, 42)
+
+
+def with_header(frames, **fields):
+    magic, version, kind, method, request_id = wm_protocol.HEADER.unpack(frames[0])
+    header = dict(magic=magic, version=version, kind=kind, method=method, request_id=request_id)
+    header.update(fields)
+    return [wm_protocol.HEADER.pack(*header.values())] + frames[1:]
+
+
+def test_bad_magic_is_rejected():
+    frames = with_header(wm_protocol.encode_reply(7, 42, 1.0), magic=b"XX")
+    with pytest.raises(wm_protocol.WMProtocolError, match="magic"):
+        wm_protocol.decode(frames)
+
+
+def test_other_protocol_version_is_rejected():
+    frames = with_header(wm_protocol.encode_reply(7, 42, 1.0), version=wm_protocol.PROTOCOL_VERSION + 1)
+    with pytest.raises(wm_protocol.WMProtocolError, match="version"):
+        wm_protocol.decode(frames)
+
+
+def test_missing_frames_are_rejected():
+    frames = transport(wm_protocol.encode_reply(7, 42, np.arange(3.0)))
+    with pytest.raises(wm_protocol.WMProtocolError, match="frames"):
+        wm_protocol.decode(frames[:1])
+    with pytest.raises(wm_protocol.WMProtocolError, match="missing"):
+        wm_protocol.decode(frames[:2])
+
+
+def test_array_frame_of_the_wrong_size_is_rejected():
+    frames = transport(wm_protocol.encode_reply(7, 42, np.arange(3.0)))
+    with pytest.raises(wm_protocol.WMProtocolError, match="does not match"):
+        wm_protocol.decode(frames[:2] + [frames[2][:-8]])
+
+
+def test_truncated_and_trailing_bodies_are_rejected():
+    header, body = wm_protocol.encode_reply(7, 42, [1, 2, 3])
+    with pytest.raises(wm_protocol.WMProtocolError, match="truncated"):
+        wm_protocol.decode([header, body[:-1]])
+    with pytest.raises(wm_protocol.WMProtocolError, match="Unexpected data"):
+        wm_protocol.decode([header, body + b"N"])
+
+
+def test_unsupported_values_are_not_sent():
+    with pytest.raises(wm_protocol.WMProtocolError):
+        wm_protocol.encode_reply(7, 42, object())
+    with pytest.raises(wm_protocol.WMProtocolError):
+        wm_protocol.encode_reply(7, 42, {1: "int key"})
+    with pytest.raises(wm_protocol.WMProtocolError):
+        wm_protocol.encode_reply(7, 42, np.array(["str"]))